@@ -1,18 +1,33 @@
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, Request, Form, Query
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-
-import uvicorn
 
 from ln_address import LNAddress
-from aiohttp.client import ClientSession
-from io import BytesIO
-
-import pyqrcode
+from utils import create_session
+from invoice_pool import InvoicePool
+from payment_watcher import PaymentWatcher
+from cache import ByteCache
+from disk_cache import TieredByteCache, get_store
+from contextlib import asynccontextmanager
+from qr_render import FastRenderer, encode, get_renderer
+from qr_executor import RenderExecutor
+from bolt11 import expiry_time, is_invoice
+from fastjson import dumpb, dumps
+from metrics import MetricsMiddleware, registry, stats_samples
+from tracing import TracingMiddleware, span
+import ratelimit
+from ratelimit import RateLimitMiddleware, make_limiter
+import ln_address
+import utils
+from pydantic import BaseModel
+import asyncio
+import hashlib
+import re
+import time
 import os
 
 import logging
@@ -40,6 +55,31 @@ content = [
 description = ''.join(content)
 title = "sendsats.to"
 
+# QR rendering engine, 'fast' (default) or 'pyqrcode'
+renderer = get_renderer()
+fast_renderer = FastRenderer()
+# QR encoding/serialisation runs off the event loop: 'thread', 'process' or 'inline'
+qr_executor = RenderExecutor(kind=os.getenv('QR_EXECUTOR', 'thread'),
+                             workers=int(os.getenv('QR_WORKERS', '0')) or None,
+                             max_queue=int(os.getenv('QR_MAX_QUEUE', '64')))
+PNG_COLORS = {'module_color': (0, 0, 0, 128), 'background': (0xff, 0xff, 0xff)}
+# Rendered QR images, bounded by total bytes
+image_cache_config = { 'max_bytes': int(os.getenv('IMAGE_CACHE_BYTES', str(32 * 1024 * 1024))),
+                       'ttl': float(os.getenv('IMAGE_CACHE_TTL', '600')) }
+if get_store() is not None:
+    # backed by the disk cache shared between workers (L2_CACHE_PATH)
+    image_cache = TieredByteCache(get_store(), 'images', **image_cache_config)
+else:
+    image_cache = ByteCache(**image_cache_config)
+# Batch invoice endpoint limits
+batch_config = { 'concurrency': int(os.getenv('BATCH_CONCURRENCY', '16')),
+                 'per_domain': int(os.getenv('BATCH_PER_DOMAIN', '4')),
+                 'max_items': int(os.getenv('BATCH_MAX_ITEMS', '1000')) }
+# QR formats each page template actually embeds
+TEMPLATE_QR_FORMATS = {'sats.html': ('svg',), 'qr_clean.html': ('png',)}
+# stream sats.html pages: the head is sent while the QR code is still rendering
+template_streaming = os.getenv('TEMPLATE_STREAMING', '0').lower() in ('1', 'true', 'yes')
+
 # Get environment variables if using LNBits as backend
 invoice_key = os.getenv('INVOICE_KEY')
 admin_key = os.getenv('ADMIN_KEY')
@@ -49,6 +89,54 @@ config = { 'invoice_key': invoice_key,
             'admin_key': admin_key,
             'base_url': base_url }
 
+# Upstream connection pool, shared by all requests for the app lifespan
+session_config = { 'limit': int(os.getenv('SESSION_LIMIT', '100')),
+                   'limit_per_host': int(os.getenv('SESSION_LIMIT_PER_HOST', '20')),
+                   'keepalive_timeout': float(os.getenv('SESSION_KEEPALIVE', '30')),
+                   'ttl_dns_cache': int(os.getenv('SESSION_DNS_TTL', '300')) }
+
+
+# Optional pool of pre-generated invoices for hot tip links, 0 disables it
+invoice_pool_size = int(os.getenv('INVOICE_POOL_SIZE', '0'))
+
+# Payment status polling for /status, shared by all watching clients
+status_config = { 'interval': float(os.getenv('STATUS_POLL_INTERVAL', '2')),
+                  'max_interval': float(os.getenv('STATUS_POLL_MAX_INTERVAL', '30')),
+                  'backoff': float(os.getenv('STATUS_POLL_BACKOFF', '1.5')),
+                  'concurrency': int(os.getenv('STATUS_POLL_CONCURRENCY', '10')) }
+STATUS_KEEPALIVE = float(os.getenv('STATUS_KEEPALIVE', '15'))
+
+# on shutdown, seconds to wait for upstream calls before closing the session
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '10'))
+PAYMENT_HASH = re.compile('^[0-9a-f]{64}$')
+
+
+class FastJSONResponse(JSONResponse):
+    """
+        JSON responses serialised with the fast JSON backend
+    """
+    def render(self, content) -> bytes:
+        return dumpb(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.session = create_session(**session_config)
+    yield
+    # the server has stopped taking requests and waited for open ones;
+    # stop the pool refills and status polls first so that nothing new
+    # starts while background refreshes drain
+    if invoice_pool is not None:
+        await invoice_pool.close()
+    await payment_watcher.close()
+    left = await ln_address.drain(DRAIN_TIMEOUT)
+    if left:
+        logging.error("closing with " + str(left) + " upstream calls still in flight")
+    await app.state.session.close()
+    qr_executor.shutdown()
+    if get_store() is not None:
+        get_store().close()
+
 
 app = FastAPI(
     title=title,
@@ -62,6 +150,8 @@ app = FastAPI(
         "name": "MIT License",
         "url": "https://mit-license.org/",
     },
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
 
 origins = [
@@ -73,6 +163,11 @@ origins = [
 ]
 
 
+# innermost of the middleware, so refusals still get CORS headers,
+# metrics and a request id
+client_limiter = make_limiter(ratelimit.CLIENT_RATE, ratelimit.CLIENT_BURST)
+domain_limiter = make_limiter(ratelimit.DOMAIN_RATE, ratelimit.DOMAIN_BURST)
+app.add_middleware(RateLimitMiddleware, clients=client_limiter, domains=domain_limiter)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -80,6 +175,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 import pathlib
 # Get the project root directory (works both locally and on Vercel)
@@ -87,8 +184,110 @@ BASE_DIR = pathlib.Path(__file__).parent
 static_dir = BASE_DIR / "static"
 templates_dir = BASE_DIR / "templates"
 
-app.mount("/static", StaticFiles(directory=str(static_dir)), name='static')
-templates = Jinja2Templates(directory=str(templates_dir))
+
+class LazyStaticFiles:
+    """
+        StaticFiles built on the first /static request, so serverless
+        cold starts for API calls skip the import and directory checks
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._app = None
+
+
+    async def __call__(self, scope, receive, send):
+        if self._app is None:
+            from fastapi.staticfiles import StaticFiles
+            self._app = StaticFiles(directory=self.directory)
+        await self._app(scope, receive, send)
+
+
+app.mount("/static", LazyStaticFiles(directory=str(static_dir)), name='static')
+templates = None
+stream_env = None
+
+
+def get_templates():
+    """
+        Jinja2 environment, created by the first page that renders one,
+        loading compiled templates from the bytecode cache
+    """
+    global templates
+    if templates is None:
+        from fastapi.templating import Jinja2Templates
+        from templating import create_environment
+        templates = Jinja2Templates(env=create_environment(str(templates_dir)))
+    return templates
+
+
+def get_stream_env():
+    """
+        async Jinja2 environment for streamed pages
+    """
+    global stream_env
+    if stream_env is None:
+        from templating import create_environment
+        stream_env = create_environment(str(templates_dir), enable_async=True)
+    return stream_env
+
+
+def precompile_templates():
+    """
+        compile every template now; serve.py calls this once before
+        forking, serverless runtimes load the committed bytecode cache
+    """
+    try:
+        from templating import precompile
+        precompile(get_templates().env)
+        if template_streaming:
+            precompile(get_stream_env())
+    except Exception as e:
+        logging.error("template precompile failed: " + str(e))
+
+
+async def stream_page(name: str, context: dict):
+    from templating import stream_template
+    with span('template'):
+        async for chunk in stream_template(get_stream_env().get_template(name), context):
+            yield chunk
+
+
+def render_template(request: Request, name: str, context: dict, stream: bool = False):
+    """
+        TemplateResponse, timed as the 'template' phase; with stream, a
+        StreamingResponse that may await deferred values in the context
+    """
+    if stream:
+        return StreamingResponse(stream_page(name, context), media_type="text/html; charset=utf-8")
+    with span('template'):
+        return get_templates().TemplateResponse(request, name, context=context)
+
+
+def get_session():
+    """
+        shared upstream session, created on first use if
+        the lifespan hooks did not run (e.g. some serverless runtimes)
+    """
+    session = getattr(app.state, 'session', None)
+    if session is None or session.closed:
+        session = create_session(**session_config)
+        app.state.session = session
+    return session
+
+
+client = None
+
+
+def get_client():
+    """
+        shared LNAddress client; it is stateless, so one instance
+        serves every request for as long as the session lives
+    """
+    global client
+    session = get_session()
+    if client is None or client._session is not session:
+        client = LNAddress(config, session)
+    return client
 
 
 async def get_bolt(email, amount):
@@ -97,54 +296,78 @@ async def get_bolt(email, amount):
         returns bolt11
     """
     try:
-        async with ClientSession() as session:
-            lnaddy = LNAddress(config, session)
-            bolt11 = await lnaddy.get_bolt11(email, amount)
-            logging.info(bolt11)
-            return bolt11
+        lnaddy = get_client()
+        bolt11 = await lnaddy.get_bolt11(email, amount)
+        logging.info(bolt11)
+        return bolt11
     except Exception as e:
         logging.error(e)
         return None
 
 
+async def check_payment(payment_hash):
+    """
+        LNbits payment status for the watcher, None when LNbits does not
+        know the payment hash
+    """
+    return await get_client().payment(payment_hash)
+
+
+payment_watcher = PaymentWatcher(check_payment, **status_config)
+
+
+invoice_pool = None
+if invoice_pool_size > 0:
+    invoice_pool = InvoicePool(get_bolt, max_size=invoice_pool_size,
+                               max_age=float(os.getenv('INVOICE_POOL_MAX_AGE', '600')),
+                               expiry_margin=float(os.getenv('INVOICE_POOL_EXPIRY_MARGIN', '60')),
+                               refill_rate=float(os.getenv('INVOICE_POOL_REFILL_RATE', '5')))
 
-async def get_qr_page_data(lightning_address, amount):
+
+async def get_qr_page_data(lightning_address, amount, pooled=False, formats=('svg', 'png'), defer_qr=False):
+        """
+            callback data, invoice and QR code for a page, the QR code is
+            encoded once and only rendered in the requested formats;
+            with defer_qr the inline SVG is a task for a streamed page to await
+        """
         print("inside get_qr_page_data amount: " + str(amount))
         if lightning_address is not None:
-            async with ClientSession() as session:
-                lnaddy = LNAddress(config, session)
-                callback_data = await lnaddy.callback_data(lightning_address)
-                #print(callback_data)
-                # need to update option for None as user specified value
-                url = lnaddy.get_payurl(lightning_address)
-                #print("url: " + str(url))
-                bolt11 = await lnaddy.get_bolt11(lightning_address, amount)
-                #print("bolt11: " + str(bolt11))
-
-                # Create QR code with lightning: prefix and uppercase bolt11
-                lightning_uri = "lightning:" + bolt11
-                qr = pyqrcode.create(lightning_uri)
-
+            lnaddy = get_client()
+            params = await lnaddy.pay_params(lightning_address)
+            # need to update option for None as user specified value
+            url = lnaddy.get_payurl(lightning_address)
+            #print("url: " + str(url))
+            bolt11 = None
+            pr_dict = {}
+            if pooled and invoice_pool is not None:
+                bolt11 = invoice_pool.take(lightning_address, amount)
+            if bolt11 is None:
+                invoice = await lnaddy.fetch_invoice(lightning_address, amount)
+                bolt11, pr_dict = invoice.bolt11, invoice.raw
+            #print("bolt11: " + str(bolt11))
+
+            # Create QR code with lightning: prefix and uppercase bolt11
+            lightning_uri = "lightning:" + bolt11
+            qr = PendingQR(lightning_uri)
+
+            qr_png_base64 = None
+            if 'png' in formats:
                 # Generate PNG base64 for more reliable scanning
                 qr_png_base64 = await get_png_base64_from_qr(qr)
 
-                # default colors for svg are black and white
-                svgdata = await get_svg_from_qr(qr, None, None)
-                svgxml = svgdata[0].decode('UTF-8')
-                # Get the SVG content properly (skip XML declaration)
-                lines = svgxml.split('\n')
-                svgxml_image = lines[1] if len(lines) > 1 else svgxml
-                # Remove width and height attributes from SVG for proper CSS sizing
-                svgxml_image = svgxml_image.replace(' height="315"', '').replace(' width="315"', '')
-                svgxml_image = svgxml_image.replace(' height="105"', '').replace(' width="105"', '')
-                min_send = str(int(callback_data['minSendable']/1000))
-                max_send = str(int(callback_data['maxSendable']/1000))
-                data = {"url": url, "bolt11": bolt11.lower(),
-                        "min": min_send, "max": max_send,
-                        "qr": svgxml_image, "qr_png": qr_png_base64,
-                        "callback_data": callback_data,
-                        "pr_dict": lnaddy.pr_dict, "amount": amount}
-                return data
+            svgxml_image = None
+            if 'svg' in formats:
+                svgxml_image = asyncio.ensure_future(get_inline_svg(qr))
+                if not defer_qr:
+                    svgxml_image = await svgxml_image
+            min_send = str(params.min_sendable // 1000)
+            max_send = str(params.max_sendable // 1000)
+            data = {"url": url, "bolt11": bolt11.lower(),
+                    "min": min_send, "max": max_send,
+                    "qr": svgxml_image, "qr_png": qr_png_base64,
+                    "callback_data": params.raw,
+                    "pr_dict": pr_dict, "amount": amount}
+            return data
 
 
 
@@ -153,12 +376,54 @@ async def index_get(request: Request):
     result = "Fill in above to get a QR code"
     lightning_address = "bitkarrot@nostr.com"
     amount = "100"
-    return templates.TemplateResponse('index.html', context={'request': request,
+    return render_template(request, 'index.html', context={'request': request,
                                                               'result': result,
                                                               'lnaddress': lightning_address,
                                                               'amount': amount})
 
 
+MAX_CIRCUIT_SAMPLES = int(os.getenv('METRICS_MAX_CIRCUITS', '50'))
+
+
+def collect_stats():
+    """
+        cache, pool, executor and breaker state sampled at scrape time
+    """
+    yield from stats_samples('sendsats_cache', ln_address.metadata_cache.stats(), {'cache': 'metadata'})
+    yield from stats_samples('sendsats_cache', ln_address.negative_cache.stats(), {'cache': 'negative'})
+    yield from stats_samples('sendsats_image_cache', image_cache.stats())
+    if get_store() is not None:
+        yield from stats_samples('sendsats_disk_cache', get_store().stats())
+    yield from stats_samples('sendsats_qr_executor', qr_executor.stats(), {'kind': qr_executor.kind})
+    yield from stats_samples('sendsats_payment_watcher', payment_watcher.stats())
+    if invoice_pool is not None:
+        yield from stats_samples('sendsats_invoice_pool', invoice_pool.stats())
+    for limit, limiter in (('client', client_limiter), ('domain', domain_limiter)):
+        if limiter is not None:
+            yield from stats_samples('sendsats_rate_limit', limiter.stats(), {'limit': limit})
+    yield ('sendsats_metadata_in_flight', 'metadata fetches currently coalesced', {},
+           len(ln_address.metadata_flight))
+    not_closed = [(key, breaker.state) for key, breaker in reversed(utils.breakers.items())
+                  if breaker.state != 'closed']
+    yield ('sendsats_circuits_not_closed', 'upstream circuit breakers open or half-open', {}, len(not_closed))
+    # upstreams come from user input, only the most recently used get a series
+    for key, state in not_closed[:MAX_CIRCUIT_SAMPLES]:
+        yield ('sendsats_circuit_open', 'upstream circuit breakers open (1) or half-open (0.5)',
+               {'domain': key}, 1 if state == 'open' else 0.5)
+
+
+registry.add_collector(collect_stats)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """
+    Prometheus metrics: per-phase and per-upstream-domain latency histograms,
+    upstream status codes, in-flight requests, cache and pool statistics.
+    """
+    return Response(content=registry.expose(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post('/')
 async def index_post(request: Request, amount: int = Form(...), lnaddress: str = Form(...)):
     # result = {"amount" : amount , "lnaddress" : lnaddress}
@@ -168,10 +433,17 @@ async def index_post(request: Request, amount: int = Form(...), lnaddress: str =
             raise Exception("amount must be an integer")
 
         if '@' in lnaddress:
+            # the address is in the form body, out of the middleware's sight
+            seconds = await ratelimit.admit(domain_limiter, ratelimit.address_domain(lnaddress), 'domain', 503)
+            if seconds:
+                seconds = ratelimit.retry_after(seconds)
+                return FastJSONResponse({'msg': ratelimit.DOMAIN_MESSAGE, 'retry_after': seconds},
+                                        status_code=503, headers={'Retry-After': str(seconds)})
             # print("inside post /")
-            data = await get_qr_page_data(lnaddress, amount)
+            data = await get_qr_page_data(lnaddress, amount, formats=TEMPLATE_QR_FORMATS['sats.html'],
+                                          defer_qr=template_streaming)
 
-            return templates.TemplateResponse('sats.html',
+            return render_template(request, 'sats.html',
                                     context={'request': request,
                                             'lnaddress': lnaddress,
                                             'bolt11': data['bolt11'],
@@ -181,7 +453,8 @@ async def index_post(request: Request, amount: int = Form(...), lnaddress: str =
                                             'callback': data['callback_data'],
                                             'amount': data['amount'],
                                             'pr_dict': data['pr_dict'],
-                                            'qrdata': data['qr']})
+                                            'qrdata': data['qr']},
+                                    stream=template_streaming)
         else:
             return [{
                 "msg" : "Please send a valid Lightning Address",
@@ -219,14 +492,14 @@ async def get_Tip_QR_Code(lightning_address: str, tip_amount: str, request: Requ
 
     try:
         # Get QR page data with the specified amount
-        data = await get_qr_page_data(lightning_address, int(tip_amount))
+        data = await get_qr_page_data(lightning_address, int(tip_amount), pooled=True,
+                                      formats=TEMPLATE_QR_FORMATS['qr_clean.html'])
 
-        return templates.TemplateResponse('qr_clean.html',
+        return render_template(request, 'qr_clean.html',
                 context={'request': request,
                         'lnaddress': lightning_address,
                         'bolt11': data['bolt11'],
-                        'qrdata': data['qr'],
-                        'qr_png': data.get('qr_png', ''),
+                        'qr_png': data['qr_png'],
                         'amount': tip_amount})
     except Exception as e:
         return [{
@@ -235,8 +508,32 @@ async def get_Tip_QR_Code(lightning_address: str, tip_amount: str, request: Requ
         }]
 
 
+def image_response(request: Request, content: bytes, media_type: str, bolt11: str):
+    """
+        in-memory image response with a content-hash ETag, 304 on a
+        matching If-None-Match, cacheable until the invoice expires
+    """
+    etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+    max_age = 0
+    try:
+        max_age = int(expiry_time(bolt11) - time.time())
+    except Exception as e:
+        logging.info("no expiry for image: " + str(e))
+    if max_age > 0:
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=" + str(max_age)}
+    else:
+        headers = {"ETag": etag, "Cache-Control": "no-cache, no-store, must-revalidate"}
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if etag in tags or '*' in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
 @app.get('/qr/{lightning_address}')
-async def get_QR_Code_From_LN_Address(lightning_address: str):
+async def get_QR_Code_From_LN_Address(lightning_address: str, request: Request):
     """
     Returns a QR code PNG image for the Lightning Address.
 
@@ -246,12 +543,11 @@ async def get_QR_Code_From_LN_Address(lightning_address: str):
     """
     try:
         if lightning_address is not None:
-            tip_file = '/tmp/qr_lnaddy.png'
             bolt11 = await get_bolt(lightning_address, None)
             #print(bolt11)
-            qr = pyqrcode.create(bolt11)
-            qr.png(tip_file, scale=3, module_color=[0,0,0,128], background=[0xff, 0xff, 0xff])
-            return FileResponse(tip_file)
+            qr = PendingQR(bolt11)
+            png_data = await get_png_from_qr(qr)
+            return image_response(request, png_data, "image/png", bolt11)
         else:
             return [{
                 "msg" : "Please send a valid Lightning Address"
@@ -263,9 +559,55 @@ async def get_QR_Code_From_LN_Address(lightning_address: str):
         }]
 
 
-async def get_svg_from_qr(qr,  st: str = None, bg: str = None):
+async def encode_qr(data):
+    """
+    encode a QR matrix in the render executor
+    """
+    with span('qr_encode'):
+        return await qr_executor.run(encode, data)
+
+
+class PendingQR:
+    """
+    QR payload that is encoded at most once, and only if
+    some requested image is not in the image cache
+    """
+    __slots__ = ('payload', 'digest', '_matrix')
+
+    def __init__(self, payload: str):
+        self.payload = payload
+        self.digest = hashlib.sha256(payload.encode('utf-8')).digest()
+        self._matrix = None
+
+    async def matrix(self):
+        if self._matrix is None:
+            self._matrix = await encode_qr(self.payload)
+        return self._matrix
+
+
+async def render_cached(qr: PendingQR, fmt: str, render, fallback, **options):
+    """
+        rendered image bytes from the image cache, keyed by payload
+        hash, format and render options; cached until the invoice expires
+    """
+    key = (qr.digest, fmt, renderer.name) + tuple(sorted(options.items()))
+    image = image_cache.get(key)
+    if image is None:
+        image = await image_cache.load(key)
+    if image is None:
+        matrix = await qr.matrix()
+        with span('qr_render'):
+            image = await qr_executor.run(render, matrix, fallback=fallback, **options)
+        try:
+            ttl = expiry_time(qr.payload) - time.time()
+        except Exception:
+            ttl = None
+        image_cache.set(key, image, ttl)
+    return image
+
+
+async def get_svg_from_qr(qr: PendingQR,  st: str = None, bg: str = None, xmldecl: bool = True):
     try:
-        stream = BytesIO()
         bgcolor = "white"
         modcolor = "black"
         if (st is not None):
@@ -273,33 +615,31 @@ async def get_svg_from_qr(qr,  st: str = None, bg: str = None):
         if (bg is not None):
             bgcolor = bg
 
-        qr.svg(stream, scale=3, background=bgcolor, module_color=modcolor)
-
-        return (
-                stream.getvalue(),
-                200,
-                {
-                    "Content-Type": "image/svg+xml",
-                    "Cache-Control": "no-cache, no-store, must-revalidate",
-                    "Pragma": "no-cache",
-                    "Expires": "0",
-                },
-        )
+        return await render_cached(qr, 'svg', renderer.svg, fast_renderer.svg, scale=3,
+                                   background=bgcolor, module_color=modcolor, xmldecl=xmldecl)
     except Exception as e:
         logging.error(e)
-        return [{
-            "msg" : "Not a valid Lightning Address"
-        }]
+        return None
+
 
+async def get_inline_svg(qr: PendingQR):
+    """
+    default colors for svg are black and white, inline svg
+    without xml declaration or fixed size for CSS sizing
+    """
+    return (await get_svg_from_qr(qr, None, None, xmldecl=False)).decode('UTF-8')
 
-async def get_png_base64_from_qr(qr):
+
+async def get_png_from_qr(qr: PendingQR):
+    """PNG bytes of a QR code, same parameters as the /qr endpoint"""
+    return await render_cached(qr, 'png', renderer.png, fast_renderer.png, scale=3, **PNG_COLORS)
+
+
+async def get_png_base64_from_qr(qr: PendingQR):
     """Generate QR code as base64-encoded PNG for HTML embedding"""
     import base64
     try:
-        stream = BytesIO()
-        # Use same parameters as the working /qr endpoint
-        qr.png(stream, scale=3, module_color=[0, 0, 0, 128], background=[0xff, 0xff, 0xff])
-        png_data = stream.getvalue()
+        png_data = await get_png_from_qr(qr)
         base64_data = base64.b64encode(png_data).decode('utf-8')
         return f"data:image/png;base64,{base64_data}"
     except Exception as e:
@@ -323,9 +663,10 @@ async def post_to_QR_Endpoint(lightning_address, request: Request, amount: int =
 
         if '@' in lightning_address:
             #print("inside get /lightningaddress, default amount no value, use None")
-            data = await get_qr_page_data(lightning_address, amount)
+            data = await get_qr_page_data(lightning_address, amount, formats=TEMPLATE_QR_FORMATS['sats.html'],
+                                          defer_qr=template_streaming)
 
-            return templates.TemplateResponse('sats.html',
+            return render_template(request, 'sats.html',
                                     context={'request': request,
                                             'lnaddress': lightning_address,
                                             'bolt11': data['bolt11'],
@@ -335,7 +676,8 @@ async def post_to_QR_Endpoint(lightning_address, request: Request, amount: int =
                                             'callback': data['callback_data'],
                                             'amount': data['amount'],
                                             'pr_dict': data['pr_dict'],
-                                            'qrdata': data['qr']})
+                                            'qrdata': data['qr']},
+                                    stream=template_streaming)
         else:
             return [{
                 "msg" : "Please send a valid Lightning Address",
@@ -378,24 +720,27 @@ async def forward_to_QR_Endpoint(
     """
     try:
         if '@' in lightning_address:
-            # Use provided amount from query param, or None to use min amount
-            data = await get_qr_page_data(lightning_address, amount)
-
             # Use clean template if amount or memo is provided via query params
             use_clean_template = amount is not None or memo is not None
 
             template_name = 'qr_clean.html' if use_clean_template else 'sats.html'
+
+            # Use provided amount from query param, or None to use min amount
+            stream = template_streaming and not use_clean_template
+            data = await get_qr_page_data(lightning_address, amount,
+                                          formats=TEMPLATE_QR_FORMATS[template_name], defer_qr=stream)
             display_amount = amount if amount else data['min']
 
             context = {
                 'request': request,
                 'lnaddress': lightning_address,
                 'bolt11': data['bolt11'],
-                'qrdata': data['qr'],
-                'qr_png': data.get('qr_png', ''),
                 'amount': display_amount,
             }
 
+            if use_clean_template:
+                context['qr_png'] = data['qr_png']
+
             # Add memo to context if provided
             if memo:
                 context['memo'] = memo
@@ -403,6 +748,7 @@ async def forward_to_QR_Endpoint(
             # For the detailed template, add more context
             if not use_clean_template:
                 context.update({
+                    'qrdata': data['qr'],
                     'url': data['url'],
                     'min_send': data['min'],
                     'max_send': data['max'],
@@ -410,7 +756,7 @@ async def forward_to_QR_Endpoint(
                     'pr_dict': data['pr_dict'],
                 })
 
-            return templates.TemplateResponse(template_name, context=context)
+            return render_template(request, template_name, context=context, stream=stream)
         else:
             return [{
                 "msg" : "Please send a valid Lightning Address",
@@ -457,8 +803,131 @@ async def get_qr_via_bolt11(lightning_address: str, amount: str):
         }]
 
 
+class BatchItem(BaseModel):
+    address: str
+    amount: int = None
+
+
+async def resolve_batch(items, concurrency: int, per_domain: int, client: str = None):
+    """
+        resolve invoices concurrently, yielding one NDJSON line per item
+        in completion order; limits apply overall and per LNURL domain,
+        and each item takes a token from the client's and its domain's bucket
+    """
+    limit = asyncio.Semaphore(concurrency)
+    domain_limits = {}
+
+    async def resolve(index, item):
+        result = {"index": index, "address": item.address, "amount": item.amount}
+        domain = item.address.rpartition('@')[2].lower()
+        domain_limit = domain_limits.setdefault(domain, asyncio.Semaphore(per_domain))
+        async with domain_limit, limit:
+            if '@' not in item.address:
+                result["error"] = "Please send a valid Lightning Address"
+                return result
+            # every item is an upstream lookup, charged as a request of its own
+            seconds = await ratelimit.admit(client_limiter, client, 'client', 429)
+            if seconds:
+                result["error"] = ratelimit.CLIENT_MESSAGE
+                result["retry_after"] = ratelimit.retry_after(seconds)
+                return result
+            seconds = await ratelimit.admit(domain_limiter, domain, 'domain', 503)
+            if seconds:
+                result["error"] = ratelimit.DOMAIN_MESSAGE
+                result["retry_after"] = ratelimit.retry_after(seconds)
+                return result
+            bolt11 = await get_bolt(item.address, item.amount)
+        if is_invoice(bolt11):
+            result["bolt11"] = bolt11
+        elif isinstance(bolt11, dict):
+            result["error"] = bolt11.get('msg') or "Not a valid Lightning Address"
+        else:
+            result["error"] = str(bolt11) if bolt11 else "Not a valid Lightning Address"
+        return result
+
+    tasks = [asyncio.ensure_future(resolve(index, item)) for index, item in enumerate(items)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            yield dumps(await done) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post('/bolt11/batch')
+async def post_bolt11_batch(request: Request, items: list[BatchItem]):
+    """
+    Returns BOLT11 invoices for many Lightning Addresses.
+
+    Accepts a JSON list of `{"address": ..., "amount": ...}` and streams back
+    one JSON object per line (NDJSON) as each invoice resolves, in completion
+    order. Each line has the item `index`, and either `bolt11` or `error`.
+
+    **Example body:** `[{"address": "bitkarrot@nostr.com", "amount": 100}]`
+    """
+    if len(items) > batch_config['max_items']:
+        return [{
+            "msg" : "Too many items, at most {0} per batch".format(batch_config['max_items'])
+        }]
+    client = ratelimit.client_key(request.scope)
+    return StreamingResponse(resolve_batch(items, batch_config['concurrency'], batch_config['per_domain'], client),
+                             media_type="application/x-ndjson")
+
+
+async def status_events(payment_hash: str, expires_at: float = None):
+    """
+        Server-Sent Events for one payment hash until it is paid or expires,
+        with keepalive comments while nothing changes
+    """
+    queue = payment_watcher.subscribe(payment_hash, expires_at)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), STATUS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield "event: " + event['status'] + "\ndata: " + dumps(event) + "\n\n"
+            if event['status'] in ('paid', 'expired'):
+                return
+    finally:
+        payment_watcher.unsubscribe(payment_hash, queue)
+
+
+@app.get('/status/{payment_hash}')
+async def get_payment_status(payment_hash: str, bolt11: str = None):
+    """
+    Streams the payment status of an invoice as Server-Sent Events.
+
+    Sends a `pending` event once the invoice is found unpaid, then `paid`
+    or `expired` and closes. Any number of clients can watch the same
+    invoice; it is polled once per interval for all of them.
+
+    **Parameters:**
+    - `payment_hash`: hex payment hash of the invoice
+    - `bolt11`: Optional invoice, used to stop watching when it expires
+
+    **Example:** `const events = new EventSource('/status/<payment_hash>')`
+    """
+    payment_hash = payment_hash.lower()
+    if not PAYMENT_HASH.match(payment_hash):
+        return [{
+            "msg" : "Please send a valid payment hash"
+        }]
+    expires_at = None
+    if bolt11 is not None:
+        try:
+            expires_at = expiry_time(bolt11)
+        except Exception as e:
+            logging.info("no expiry for status watch: " + str(e))
+    return StreamingResponse(status_events(payment_hash, expires_at), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/svg/{lightning_address}/amt/{amount}")
-async def get_svg_LN_address_amt(lightning_address: str, amount: str, st: str = None, bg: str = None):
+async def get_svg_LN_address_amt(lightning_address: str, amount: str, request: Request,
+                                 st: str = None, bg: str = None):
     """
     Returns a QR code in SVG format.
 
@@ -477,28 +946,11 @@ async def get_svg_LN_address_amt(lightning_address: str, amount: str, st: str =
         #print("bgcolor: ", bg, "stroke: ", st)
 
         bolt11 = await get_bolt(lightning_address, int(amount))
-        qr = pyqrcode.create(bolt11)
-
-        stream = BytesIO()
-        bgcolor = "white"
-        modcolor = "black"
-        if (st is not None):
-            modcolor = st
-        if (bg is not None):
-            bgcolor = bg
-
-        qr.svg(stream, scale=3, background=bgcolor, module_color=modcolor)
-
-        return (
-                stream.getvalue(),
-                200,
-                {
-                    "Content-Type": "image/svg+xml",
-                    "Cache-Control": "no-cache, no-store, must-revalidate",
-                    "Pragma": "no-cache",
-                    "Expires": "0",
-                },
-        )
+        qr = PendingQR(bolt11)
+        svg = await get_svg_from_qr(qr, st, bg)
+        if svg is None:
+            raise Exception("could not render svg")
+        return image_response(request, svg, "image/svg+xml", bolt11)
     except Exception as e:
         logging.error(e)
         return [{
@@ -506,6 +958,7 @@ async def get_svg_LN_address_amt(lightning_address: str, amount: str, st: str =
         }]
 
 
-# for local testing
+# for local testing, self-hosted production servers run serve.py
 if __name__ == "__main__":
+  import uvicorn
   uvicorn.run("app:app", host="localhost", port=5000, reload=True)
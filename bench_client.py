@@ -0,0 +1,110 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import fastjson
+from bench_hotpath import CALLBACK_JSON, INVOICES, invoice_json
+from bolt11 import decode
+from ln_address import LNAddress
+from models import Invoice, PayParams
+
+"""
+ per-request cost of the LNURL-pay client: the previous path (a new
+ LNAddress per request, stdlib json, plain dicts) against the shared
+ client with slotted models and the fast JSON backend.
+
+ reports CPU time per request and bytes allocated per request
+ (tracemalloc peak), plus the size of what a cached entry keeps alive.
+
+ usage: python bench_client.py [-n 5000]
+"""
+
+CONFIG = {'invoice_key': 'x' * 32, 'admin_key': 'y' * 32, 'base_url': 'https://legend.lnbits.com'}
+ADDRESS = 'bitkarrot@getalby.com'
+INVOICE_JSON = invoice_json(INVOICES['coffee'])
+INVOICE_BYTES = INVOICE_JSON.encode()
+CALLBACK_BYTES = CALLBACK_JSON.encode()
+
+
+def dict_request():
+    # one client per request, as the handlers did before
+    LNAddress(CONFIG)
+    callback = json.loads(CALLBACK_JSON)
+    msat = max(250000 * 1000, int(callback['minSendable']))
+    url = callback['callback'] + '?amount=' + str(msat)
+    pr_dict = json.loads(INVOICE_JSON)
+    invoice = decode(pr_dict['pr'])
+    assert invoice.amount_msat == msat
+    return json.dumps({'url': url, 'bolt11': pr_dict['pr'], 'callback_data': callback, 'pr_dict': pr_dict})
+
+
+def model_request(client=LNAddress(CONFIG)):
+    params = PayParams.from_json(fastjson.loads(CALLBACK_BYTES))
+    msat = params.amount_msat(250000)
+    url = params.query_url(msat)
+    invoice = Invoice.from_json(fastjson.loads(INVOICE_BYTES))
+    assert invoice.amount_msat == msat
+    return fastjson.dumpb({'url': url, 'bolt11': invoice.pr, 'callback_data': params.raw, 'pr_dict': invoice.raw})
+
+
+def cpu(fn, n):
+    fn()
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'median_us': samples[len(samples) // 2], 'p95_us': samples[min(n - 1, int(n * 0.95))]}
+
+
+def allocations(fn, n):
+    """
+    most bytes live at once during a call, over n calls
+    """
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    peak = 0
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {'peak_bytes': peak}
+
+
+def retained(build, n=1000):
+    """
+    bytes kept alive per cached entry
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build() for _ in range(n)]
+    size = (tracemalloc.get_traced_memory()[0] - before) // n
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5000, help='requests per benchmark')
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in (('dict/json', dict_request), ('models/' + fastjson.BACKEND, model_request)):
+        results[name] = dict(cpu(fn, args.n), **allocations(fn, min(args.n, 500)))
+    # what a metadata cache entry holds: the parsed dict, or the model built from it
+    results['cache_entry/dict'] = {'bytes': retained(lambda: json.loads(CALLBACK_JSON))}
+    results['cache_entry/model'] = {'bytes': retained(lambda: PayParams.from_json(fastjson.loads(CALLBACK_BYTES)))}
+    print(json.dumps({'python': platform.python_version(), 'json_backend': fastjson.BACKEND,
+                      'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+ cold-start benchmark: imports app in fresh interpreters with
+ -X importtime and reports the import cost, the first page render
+ (which pays for the deferred template setup) and the slowest imports.
+
+ usage: python bench_coldstart.py [-n 10] [--baseline cold.json] [--tolerance 0.25]
+"""
+
+# imports app, then serves one GET / over ASGI and prints the ms it took
+FIRST_REQUEST = '''
+import asyncio, time
+import app
+async def first_page():
+    scope = {"type": "http", "method": "GET", "path": "/", "raw_path": b"/", "headers": [],
+             "query_string": b"", "http_version": "1.1", "scheme": "http",
+             "server": ("bench", 80), "client": ("127.0.0.1", 1), "root_path": ""}
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        pass
+    start = time.perf_counter()
+    await app.app(scope, receive, send)
+    return (time.perf_counter() - start) * 1000
+print(asyncio.run(first_page()))
+'''
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def cold_start():
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', FIRST_REQUEST],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                          env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    # importtime lists a module after everything it imported, so
+    # the lines up to 'app' are what a cold start pays before serving
+    imports = {}
+    for match in IMPORT_LINE.finditer(proc.stderr):
+        imports[match.group(4)] = int(match.group(2)) / 1000
+        if match.group(4) == 'app':
+            break
+    return {'import_ms': imports.get('app', 0.0),
+            'first_page_ms': float(proc.stdout.strip().splitlines()[-1]),
+            'process_ms': wall_ms}, imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10, help='fresh interpreters to start')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--baseline', help='JSON output of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed median slowdown')
+    args = parser.parse_args()
+
+    runs = []
+    imports = {}
+    for _ in range(args.n):
+        run, run_imports = cold_start()
+        runs.append(run)
+        for name, ms in run_imports.items():
+            imports.setdefault(name, []).append(ms)
+
+    results = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    slowest = sorted(((statistics.median(ms), name) for name, ms in imports.items() if name != 'app'),
+                     reverse=True)[:args.top]
+    output = {'python': platform.python_version(), 'runs': args.n, 'median': results,
+              'imported_at_startup': {name: name in imports for name in ('uvicorn', 'jinja2', 'pyqrcode', 'segno', 'png')},
+              'slowest_imports_ms': {name: ms for ms, name in slowest}}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            before = json.load(f)['median']
+        output['regressions'] = {key: {'baseline_ms': before[key], 'median_ms': value}
+                                 for key, value in results.items()
+                                 if key in before and value > before[key] * (1 + args.tolerance)}
+        status = 1 if output['regressions'] else 0
+    print(json.dumps(output, indent=2))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
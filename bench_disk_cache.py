@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from bench_hotpath import CALLBACK_JSON, INVOICES
+from disk_cache import DiskCache, TieredByteCache, TieredTTLCache
+from fastjson import dumpb, loads
+from models import PayParams
+from qr_render import FastRenderer, encode
+
+"""
+ what a cold worker pays per entry with and without the disk tier:
+ re-rendering a QR image vs reading it through from disk, and rebuilding
+ LNURL metadata from disk vs an in-memory hit.
+
+ usage: python bench_disk_cache.py [-n 500]
+"""
+
+
+def timed(fn, n):
+    samples = []
+    loop = asyncio.new_event_loop()
+    for i in range(n):
+        start = time.perf_counter()
+        result = fn(i)
+        if asyncio.iscoroutine(result):
+            loop.run_until_complete(result)
+        samples.append((time.perf_counter() - start) * 1e6)
+    loop.close()
+    samples.sort()
+    return {'median_us': round(samples[len(samples) // 2], 2), 'p95_us': round(samples[int(len(samples) * 0.95)], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500)
+    args = parser.parse_args()
+    bolt11 = INVOICES['coffee'].upper()
+    renderer = FastRenderer()
+    params = PayParams.from_json(loads(CALLBACK_JSON))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'l2.sqlite3')
+        store = DiskCache(path)
+        writer = TieredByteCache(store, 'images', ttl=600)
+        metadata = TieredTTLCache(store, 'metadata', lambda p: dumpb(p.raw),
+                                  lambda data: PayParams.from_json(loads(data)), ttl=600)
+        png = renderer.png(encode(bolt11), scale=3)
+        for i in range(args.n):
+            writer.set(('img', i), png)
+            metadata.set('user%d@example.com' % i, params)
+        store.flush()
+
+        results['image/render'] = timed(lambda i: renderer.png(encode(bolt11), scale=3), min(args.n, 100))
+        # every read is a new key, as for a worker that just started
+        cold = TieredByteCache(DiskCache(path), 'images', ttl=600)
+        results['image/l2_read_through'] = timed(lambda i: cold.load(('img', i)), args.n)
+        results['image/l1_hit'] = timed(lambda i: cold.get(('img', i)), args.n)
+        cold = TieredTTLCache(DiskCache(path), 'metadata', lambda p: dumpb(p.raw),
+                              lambda data: PayParams.from_json(loads(data)), ttl=600)
+        results['metadata/l2_read_through'] = timed(lambda i: cold.load('user%d@example.com' % i), args.n)
+        results['metadata/l1_hit'] = timed(lambda i: cold.lookup('user%d@example.com' % i), args.n)
+        # writes are queued to the store's thread, this is what the caller waits for
+        results['write_through/image'] = timed(lambda i: writer.set(('new', i), png), args.n)
+        store.close()
+    print(json.dumps({'python': platform.python_version(), 'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+
+import app
+from bolt11 import decode
+from cache import ByteCache
+from ln_address import LNAddress
+from qr_render import encode
+
+"""
+ offline microbenchmarks for the invoice/QR hot path.
+
+ prints JSON timings per benchmark; with --baseline, compares against a
+ previous run and exits 1 when any median regresses past --tolerance.
+
+ usage: python bench_hotpath.py [-n 200] [--baseline bench.json] [--tolerance 0.25]
+"""
+
+# BOLT11 specification examples, representative sizes
+INVOICES = {
+    'donation': 'lnbc1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq9qrsgq357wnc5r2ueh7ck6q93dj32dlqnls087fxdwk8qakdyafkq3yap9us6v52vjjsrvywa6rt52cm9r9zqt8r2t7mlcwspyetp5h2tztugp9lfyql',
+    'coffee': 'lnbc2500u1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpu9qrsgquk0rl77nj30yxdy8j9vdx85fkpmdla2087ne0xh8nhedh8w27kyke0lp53ut353s06fv3qfegext0eh0ymjpf39tuven09sam30g4vgpfna3rh',
+    'description_hash': 'lnbc20m1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqs9qrsgq7ea976txfraylvgzuxs8kgcw23ezlrszfnh8r6qtfpr6cxga50aj6txm9rxrydzd06dfeawfk6swupvz4erwnyutnjq7x39ymw6j38gp7ynn44',
+}
+
+CALLBACK_JSON = json.dumps({
+    'callback': 'https://getalby.com/lnurlp/bitkarrot/callback',
+    'maxSendable': 100000000000, 'minSendable': 1000,
+    'metadata': json.dumps([['text/identifier', 'bitkarrot@getalby.com'],
+                            ['text/plain', 'Sats for bitkarrot']]),
+    'payerData': {'name': {'mandatory': False}, 'email': {'mandatory': False}},
+    'tag': 'payRequest', 'allowsNostr': True,
+    'nostrPubkey': '79f00d3f5a19ec806189fcab03c1be4ff81d18ee4f653c88fac41fe03570f432',
+    'commentAllowed': 255,
+})
+
+
+def invoice_json(bolt11):
+    return json.dumps({'status': 'OK', 'successAction': {'tag': 'message', 'message': 'Thanks!'},
+                       'verify': 'https://getalby.com/lnurlp/bitkarrot/verify/abc', 'routes': [],
+                       'pr': bolt11})
+
+
+def measure(fn, n):
+    fn()
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'n': n, 'mean_us': statistics.fmean(samples), 'median_us': samples[len(samples) // 2],
+            'p95_us': samples[min(n - 1, int(n * 0.95))], 'min_us': samples[0]}
+
+
+def benchmarks(loop):
+    lnaddy = LNAddress(app.config)
+    # keep every call rendering rather than hitting the image cache
+    app.image_cache = ByteCache(max_bytes=0)
+    bolt11 = INVOICES['coffee'].upper()
+    uri = 'lightning:' + bolt11
+    request = app.Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': [],
+                           'query_string': b'', 'app': app.app})
+    sats = app.get_templates().get_template('sats.html')
+    clean = app.get_templates().get_template('qr_clean.html')
+    svg = loop.run_until_complete(app.get_svg_from_qr(app.PendingQR(uri), None, None, xmldecl=False)).decode()
+    png = loop.run_until_complete(app.get_png_base64_from_qr(app.PendingQR(uri)))
+    callback = json.loads(CALLBACK_JSON)
+
+    yield 'get_payurl', lambda: lnaddy.get_payurl('bitkarrot@getalby.com')
+    yield 'json_callback', lambda: json.loads(CALLBACK_JSON)
+    for name, invoice in INVOICES.items():
+        payload = invoice_json(invoice)
+        yield 'json_invoice/' + name, lambda payload=payload: json.loads(payload)
+        yield 'bolt11_decode/' + name, lambda invoice=invoice: decode(invoice)
+    for encoder in ('pyqrcode', 'segno'):
+        yield 'qr_encode/' + encoder, lambda encoder=encoder: encode(uri, encoder)
+    yield 'get_svg_from_qr', lambda: loop.run_until_complete(
+        app.get_svg_from_qr(app.PendingQR(uri), None, None, xmldecl=False))
+    yield 'get_png_base64_from_qr', lambda: loop.run_until_complete(
+        app.get_png_base64_from_qr(app.PendingQR(uri)))
+    yield 'render/sats.html', lambda: sats.render(
+        request=request, lnaddress='bitkarrot@getalby.com', bolt11=bolt11.lower(),
+        url='https://getalby.com/.well-known/lnurlp/bitkarrot', min_send='1', max_send='100000000',
+        callback=callback, amount=250000, pr_dict={'pr': bolt11.lower()}, qrdata=svg)
+    yield 'render/qr_clean.html', lambda: clean.render(
+        request=request, lnaddress='bitkarrot@getalby.com', bolt11=bolt11.lower(),
+        qr_png=png, amount=250000)
+
+
+def compare(results, baseline, tolerance):
+    regressions = {}
+    for name, result in results.items():
+        before = baseline.get('benchmarks', {}).get(name)
+        if before and result['median_us'] > before['median_us'] * (1 + tolerance):
+            regressions[name] = {'baseline_us': before['median_us'], 'median_us': result['median_us']}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=200, help='iterations per benchmark')
+    parser.add_argument('--only', help='run benchmarks whose name contains this')
+    parser.add_argument('--baseline', help='JSON output of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed median slowdown')
+    args = parser.parse_args()
+    # keep log I/O out of the timings
+    logging.disable(logging.INFO)
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    for name, fn in benchmarks(loop):
+        if args.only and args.only not in name:
+            continue
+        n = args.n if not name.startswith('qr_encode/pyqrcode') else max(5, args.n // 20)
+        results[name] = measure(fn, n)
+    app.qr_executor.shutdown()
+    loop.close()
+
+    output = {'python': platform.python_version(), 'renderer': app.renderer.name,
+              'executor': app.qr_executor.kind, 'benchmarks': results}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            output['regressions'] = compare(results, json.load(f), args.tolerance)
+        status = 1 if output['regressions'] else 0
+    print(json.dumps(output, indent=2))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+
+from aiohttp.client import ClientSession
+
+import utils
+from conftest import lnbits_client, lnbits_routes, stub_server
+from payout import Journal, PayoutEngine, make_payouts
+
+"""
+ payout throughput against the local LNbits stand-in: one recipient at a
+ time (as before) vs concurrent invoice fetches and payments.
+
+ usage: python bench_payout.py [-n 500] [--latency 0.05]
+"""
+
+
+async def run(n, latency, fetch_concurrency, pay_concurrency):
+    routes, state = lnbits_routes(latency=latency)
+    async with stub_server(routes) as url, ClientSession() as session:
+        engine = PayoutEngine(lnbits_client(session, url), Journal(), fetch_concurrency, pay_concurrency)
+        summary = await engine.run(make_payouts([('user%d@x' % i, 10) for i in range(n)]))
+    summary['wallet_payments'] = len(state['paid'])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500, help='payouts per run')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stand-in takes per payment')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    utils.BREAKER_THRESHOLD = 10 ** 6
+
+    results = {}
+    for fetch_concurrency, pay_concurrency in ((1, 1), (20, 5), (50, 20)):
+        name = 'fetch%d_pay%d' % (fetch_concurrency, pay_concurrency)
+        results[name] = asyncio.run(run(args.n, args.latency, fetch_concurrency, pay_concurrency))
+    print(json.dumps({'python': platform.python_version(), 'payouts': args.n,
+                      'payment_latency_s': args.latency, 'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
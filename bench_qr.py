@@ -0,0 +1,50 @@
+import json
+import time
+
+from qr_render import RENDERERS, encode, optional_module
+
+"""
+ benchmark: QR encoders and rendering engines, CPU time and output bytes
+ per image. 'pyqrcode/pyqrcode' is the original code path.
+
+ usage: python bench_qr.py [iterations]
+"""
+
+BOLT11 = ('lightning:LNBC1U1PJ9G5QVPP5QQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQYPQ'
+          'DQ5XYSXXATSYP3K7ENXV4JSXQZPUSP5ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYGS9QRSGQ'
+          'CQZPGXQYZ5VQSP5USYC4LK9CHSFP53KVCNVQ456GANH60D89REYKDNGSMTJ6YW3NHVQ9QYYSSQJCEWM5CJWZ4A6R'
+          'FJX77C490YCED6PEMK0UPKXHY89CMM7SCT66K8GNEANWYKZGDRWRFJE69H9U5U0W57RRCSYSAS7GADWMZXC8C6T0SP')
+
+PNG_COLORS = {'module_color': (0, 0, 0, 128), 'background': (0xff, 0xff, 0xff)}
+
+
+def cpu_ms(fn, n):
+    start = time.process_time()
+    for _ in range(n):
+        out = fn()
+    return (time.process_time() - start) * 1000 / n, out
+
+
+def main(n):
+    results = {}
+    encoders = ['pyqrcode'] + (['segno'] if optional_module('segno') is not None else [])
+    for encoder in encoders:
+        results['encode_cpu_ms/' + encoder] = cpu_ms(lambda: encode(BOLT11, encoder), n)[0]
+        for name, cls in RENDERERS.items():
+            renderer = cls()
+            svg_ms, svg = cpu_ms(lambda: renderer.svg(encode(BOLT11, encoder), scale=3, xmldecl=False), n)
+            png_ms, png = cpu_ms(lambda: renderer.png(encode(BOLT11, encoder), scale=3, **PNG_COLORS), n)
+            matrix = encode(BOLT11, encoder)
+            matrix.rows
+            svg_only_ms, _ = cpu_ms(lambda: renderer.svg(matrix, scale=3, xmldecl=False), n)
+            png_only_ms, _ = cpu_ms(lambda: renderer.png(matrix, scale=3, **PNG_COLORS), n)
+            results[encoder + '/' + name] = {'svg_cpu_ms': svg_ms, 'svg_bytes': len(svg),
+                                             'svg_render_only_cpu_ms': svg_only_ms,
+                                             'png_cpu_ms': png_ms, 'png_bytes': len(png),
+                                             'png_render_only_cpu_ms': png_only_ms}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from ratelimit import RateLimiter, RateLimitMiddleware
+
+"""
+ load generator for the rate limits: one scraper and many ordinary users
+ hitting the middleware at fixed rates for a few seconds, then the cost
+ of a take() and the memory held for a million distinct client keys.
+
+ usage: python bench_ratelimit.py [--seconds 5] [--scraper-rate 200] [--users 200]
+"""
+
+
+async def handler(scope, receive, send):
+    # stands in for an upstream LNURL fetch
+    await asyncio.sleep(0.005)
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def client(middleware, ip, path, rate, seconds, results):
+    """
+    open-loop client: starts a request every 1/rate seconds
+    """
+    async def one():
+        start = time.perf_counter()
+        status = []
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'headers': [], 'client': (ip, 1234)}
+        await middleware(scope, None, send)
+        results.append((status[0], time.perf_counter() - start))
+
+    tasks = []
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        tasks.append(asyncio.ensure_future(one()))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+
+
+def summarise(results, seconds):
+    latencies = sorted(latency for status, latency in results if status == 200)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {'requests': len(results), 'statuses': statuses,
+            'served_per_second': round(len(latencies) / seconds, 1),
+            'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None}
+
+
+async def load(args):
+    clients, domains = RateLimiter(2, 20), RateLimiter(50, 100)
+    middleware = RateLimitMiddleware(handler, clients=clients, domains=domains)
+    scraper, users, popular = [], [], []
+    await asyncio.gather(
+        client(middleware, '198.51.100.7', '/scrape@wallet.example', args.scraper_rate, args.seconds, scraper),
+        # many users tipping the same popular address, one page view every 5s each
+        *[client(middleware, '10.0.%d.%d' % (i // 250, i % 250), '/tips@popular.example', 0.2, args.seconds,
+                 popular) for i in range(args.users)],
+        *[client(middleware, '10.1.%d.%d' % (i // 250, i % 250), '/user%d@wallet%d.example' % (i, i % 10),
+                 0.5, args.seconds, users) for i in range(args.users)])
+    return {'scraper': summarise(scraper, args.seconds), 'users': summarise(users, args.seconds),
+            'popular_domain': summarise(popular, args.seconds),
+            'limiters': {'client': clients.stats(), 'domain': domains.stats()}}
+
+
+def take_cost(n):
+    limiter = RateLimiter(2, 20)
+    keys = ['203.0.%d.%d' % (i // 256 % 256, i % 256) for i in range(n)]
+    start = time.perf_counter()
+    for key in keys:
+        limiter.take(key)
+    return round((time.perf_counter() - start) / n * 1e6, 3)
+
+
+def memory(n, max_keys):
+    tracemalloc.start()
+    limiter = RateLimiter(2, 20, max_keys=max_keys)
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        limiter.take(i)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {'distinct_keys': n, 'max_keys': max_keys, 'keys_held': len(limiter),
+            'bytes_held': held, 'bytes_per_key': round(held / len(limiter), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--scraper-rate', type=float, default=200, help='scraper requests per second')
+    parser.add_argument('--users', type=int, default=200, help='ordinary clients')
+    parser.add_argument('--keys', type=int, default=1000000, help='distinct keys for the memory run')
+    args = parser.parse_args()
+    results = asyncio.run(load(args))
+    results['take_us'] = take_cost(200000)
+    results['memory'] = memory(args.keys, 100000)
+    print(json.dumps({'python': platform.python_version(), 'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
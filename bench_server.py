@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+import serve
+
+"""
+ throughput of the development server (python app.py: one uvicorn worker
+ with reload) against serve.py with one worker, with and without uvloop
+ and httptools, and with a worker per core. each server is started on a
+ free port and loaded by a closed-loop client for a few seconds.
+
+ the client runs on the same host and takes cpu from the servers; on a
+ single core box the per-core row is the same as the one worker row.
+
+ usage: python bench_server.py [--seconds 5] [--concurrency 32] [--path /]
+"""
+
+DEV = 'import uvicorn; uvicorn.run("app:app", host="127.0.0.1", port=%d, reload=True, log_level="warning")'
+
+
+def modes(port):
+    serve_cmd = [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port)]
+    return {
+        'dev_reload': [sys.executable, '-c', DEV % port],
+        'serve_1_asyncio_h11': serve_cmd + ['--workers', '1', '--loop', 'asyncio', '--http', 'h11'],
+        'serve_1': serve_cmd + ['--workers', '1'],
+        'serve_per_core': serve_cmd + ['--workers', '0'],
+    }
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as res:
+                    if res.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('server did not start: ' + url)
+            await asyncio.sleep(0.1)
+
+
+async def load(url, seconds, concurrency):
+    latencies = []
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def client(end):
+            nonlocal errors
+            while time.monotonic() < end:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as res:
+                        await res.read()
+                        ok = res.status == 200
+                except aiohttp.ClientError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        # warm up templates, caches and connections
+        await asyncio.gather(*[client(time.monotonic() + 1) for _ in range(concurrency)])
+        latencies.clear()
+        start = time.monotonic()
+        await asyncio.gather(*[client(start + seconds) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+    latencies.sort()
+    return {'requests_per_second': round(len(latencies) / elapsed, 1), 'errors': errors,
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None}
+
+
+def run_mode(cmd, port, args):
+    env = dict(os.environ, RATE_LIMIT_CLIENT_RATE='0')
+    server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = 'http://127.0.0.1:%d%s' % (port, args.path)
+    try:
+        asyncio.run(wait_ready(url))
+        return asyncio.run(load(url, args.seconds, args.concurrency))
+    finally:
+        # the dev server's reloader passes SIGTERM on to its worker
+        server.terminate()
+        server.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--path', default='/', help='a page that needs no upstream, e.g. / or /metrics')
+    parser.add_argument('--mode', action='append', help='only these modes')
+    args = parser.parse_args()
+    results = {}
+    for name, cmd in modes(0).items():
+        if args.mode and name not in args.mode:
+            continue
+        sock = serve.bind_socket('127.0.0.1', 0)
+        port = sock.getsockname()[1]
+        sock.close()
+        results[name] = run_mode(modes(port)[name], port, args)
+    print(json.dumps({'python': platform.python_version(), 'cores': serve.worker_count(0),
+                      'loop': serve.event_loop(), 'http': serve.http_protocol(),
+                      'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import time
+
+from aiohttp import web
+from aiohttp.client import ClientSession
+from conftest import stub_server
+from utils import create_session, get_url
+
+"""
+ benchmark: new ClientSession per request vs one pooled session.
+ counts TCP connections accepted by a local stub LNURL server.
+
+ usage: python bench_session.py [requests]
+"""
+
+WELL_KNOWN = {"callback": "", "minSendable": 1000, "maxSendable": 100000000,
+              "metadata": "[[\"text/plain\", \"bench\"]]", "tag": "payRequest"}
+
+
+def stub_routes():
+    transports = []
+
+    async def lnurlp(request):
+        if not any(t is request.transport for t in transports):
+            transports.append(request.transport)
+        return web.json_response(WELL_KNOWN)
+
+    return [('GET', '/.well-known/lnurlp/{user}', lnurlp)], transports
+
+
+async def per_request(url, n):
+    for _ in range(n):
+        async with ClientSession() as session:
+            await get_url(session=session, path=url, headers={})
+
+
+async def pooled(url, n):
+    session = create_session()
+    try:
+        for _ in range(n):
+            await get_url(session=session, path=url, headers={})
+    finally:
+        await session.close()
+
+
+async def main(n):
+    results = {}
+    for name, fn in (("per_request_session", per_request), ("pooled_session", pooled)):
+        routes, transports = stub_routes()
+        async with stub_server(routes) as base:
+            start = time.perf_counter()
+            await fn(base + "/.well-known/lnurlp/bench", n)
+            elapsed = time.perf_counter() - start
+        results[name] = {"requests": n,
+                         "connections": len(transports),
+                         "handshakes_per_request": len(transports) / n,
+                         "mean_ms": elapsed * 1000 / n}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
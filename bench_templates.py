@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from qr_render import FastRenderer, encode
+from templating import create_environment, precompile, stream_template
+
+"""
+ template benchmark: compile from source vs loading the bytecode cache,
+ full vs streamed render time, and time to first byte of sats.html
+ while its QR code is still being encoded.
+
+ usage: python bench_templates.py [-n 200]
+"""
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+BOLT11 = ('LNBC2500U1PVJLUEZSP5ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYGSPP5QQQSYQCYQ5RQWZQFQQQSYQ'
+          'CYQ5RQWZQFQQQSYQCYQ5RQWZQFQYPQDQ5XYSXXATSYP3K7ENXV4JSXQZPU9QRSGQUK0RL77NJ30YXDY8J9VDX85FKPMDLA2087'
+          'NE0XH8NHEDH8W27KYKE0LP53UT353S06FV3QFEGEXT0EH0YMJPF39TUVEN09SAM30G4VGPFNA3RH')
+CONTEXT = {'lnaddress': 'bitkarrot@getalby.com', 'amount': 250000, 'bolt11': BOLT11.lower(),
+           'url': 'https://getalby.com/.well-known/lnurlp/bitkarrot', 'min_send': '1',
+           'max_send': '100000000', 'callback': {'callback': 'https://getalby.com/lnurlp/bitkarrot/callback'},
+           'pr_dict': {'pr': BOLT11.lower()}}
+
+
+def make_svg():
+    return FastRenderer().svg(encode('lightning:' + BOLT11), xmldecl=False).decode()
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {'median_ms': samples[len(samples) // 2], 'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))]}
+
+
+def timed(fn, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summary(samples)
+
+
+def compile_benchmarks(n):
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        precompile(create_environment(TEMPLATES, cache_dir=cache_dir))
+        for name in ('index.html', 'sats.html', 'qr_clean.html'):
+            def from_source():
+                env = create_environment(TEMPLATES, cache_dir=cache_dir)
+                env.bytecode_cache = None
+                env.get_template(name)
+
+            def from_cache():
+                create_environment(TEMPLATES, cache_dir=cache_dir).get_template(name)
+
+            results['compile/' + name] = timed(from_source, n)
+            results['bytecode_cache/' + name] = timed(from_cache, n)
+    return results
+
+
+async def render_benchmarks(n, loop):
+    env = create_environment(TEMPLATES)
+    stream_env = create_environment(TEMPLATES, enable_async=True)
+    svg = make_svg()
+    full, streamed, ttfb_full, ttfb_streamed = [], [], [], []
+    for _ in range(n):
+        start = time.perf_counter()
+        env.get_template('sats.html').render(CONTEXT, qrdata=svg)
+        full.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        async for _ in stream_template(stream_env.get_template('sats.html'), dict(CONTEXT, qrdata=svg)):
+            pass
+        streamed.append((time.perf_counter() - start) * 1000)
+
+        # QR encoded off the loop, as in the app; full render waits for it
+        start = time.perf_counter()
+        qr = await loop.run_in_executor(None, make_svg)
+        env.get_template('sats.html').render(CONTEXT, qrdata=qr)
+        ttfb_full.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        pending = loop.run_in_executor(None, make_svg)
+        stream = stream_template(stream_env.get_template('sats.html'), dict(CONTEXT, qrdata=pending))
+        await stream.__anext__()
+        ttfb_streamed.append((time.perf_counter() - start) * 1000)
+        async for _ in stream:
+            pass
+    return {'render/full': summary(full), 'render/streamed': summary(streamed),
+            'ttfb/full': summary(ttfb_full), 'ttfb/streamed': summary(ttfb_streamed)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200, help='iterations per benchmark')
+    args = parser.parse_args()
+
+    results = compile_benchmarks(max(5, args.n // 10))
+    loop = asyncio.new_event_loop()
+    results.update(loop.run_until_complete(render_benchmarks(args.n, loop)))
+    loop.close()
+    print(json.dumps({'python': platform.python_version(), 'benchmarks': results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+ local BOLT11 invoice decoding, no network round trip
+"""
+import re
+import time
+from functools import reduce
+from operator import xor
+
+CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+CHARSET_MAP = {c: i for i, c in enumerate(CHARSET)}
+GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+DEFAULT_EXPIRY = 3600
+
+# tagged field types, as 5-bit values
+TAG_PAYMENT_HASH = CHARSET_MAP['p']
+TAG_PAYMENT_SECRET = CHARSET_MAP['s']
+TAG_DESCRIPTION = CHARSET_MAP['d']
+TAG_DESCRIPTION_HASH = CHARSET_MAP['h']
+TAG_EXPIRY = CHARSET_MAP['x']
+TAG_MIN_FINAL_CLTV = CHARSET_MAP['c']
+TAG_PAYEE = CHARSET_MAP['n']
+DEFAULT_MIN_FINAL_CLTV = 18
+# readers must skip p, h, s and n fields that do not have these lengths
+HASH_WORDS = 52
+PAYEE_WORDS = 53
+SIGNATURE_WORDS = 104
+
+# amount multipliers, in millisatoshi per unit (1 BTC = 10^11 msat)
+MULTIPLIERS = {'m': 10 ** 8, 'u': 10 ** 5, 'n': 10 ** 2}
+HRP = re.compile('^ln([a-z]+?)(?:([0-9]+)([munp]?))?$')
+
+
+class Bolt11Error(ValueError):
+    pass
+
+
+# generator terms XORed together for each value of the 5 bits shifted out
+GENERATOR_TABLE = [reduce(xor, (g for i, g in enumerate(GENERATOR) if (top >> i) & 1), 0)
+                   for top in range(32)]
+
+
+def bech32_polymod(values) -> int:
+    chk = 1
+    table = GENERATOR_TABLE
+    for value in values:
+        chk = (chk & 0x1ffffff) << 5 ^ value ^ table[chk >> 25]
+    return chk
+
+
+def bech32_hrp_expand(hrp: str) -> list:
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def bech32_checksum(hrp: str, data: list) -> list:
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ 1
+    return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+
+
+def bech32_decode(bech: str) -> tuple:
+    """
+    returns (hrp, 5-bit data words without checksum), BOLT11 has no length limit
+    """
+    if bech.lower() != bech and bech.upper() != bech:
+        raise Bolt11Error('mixed case')
+    bech = bech.lower()
+    pos = bech.rfind('1')
+    if pos < 1 or pos + 7 > len(bech):
+        raise Bolt11Error('no separator')
+    hrp = bech[:pos]
+    try:
+        data = [CHARSET_MAP[c] for c in bech[pos + 1:]]
+    except KeyError:
+        raise Bolt11Error('invalid character')
+    if bech32_polymod(bech32_hrp_expand(hrp) + data) != 1:
+        raise Bolt11Error('bad checksum')
+    return hrp, data[:-6]
+
+
+def words_to_int(words) -> int:
+    value = 0
+    for word in words:
+        value = value << 5 | word
+    return value
+
+
+def words_to_bytes(words) -> bytes:
+    """
+    5-bit words to bytes, dropping the trailing padding bits
+    """
+    bits = len(words) * 5
+    return (words_to_int(words) >> bits % 8).to_bytes(bits // 8, 'big')
+
+
+def parse_hrp(hrp: str) -> tuple:
+    """
+    returns (currency, amount in millisatoshi or None) from e.g. 'lnbc2500u'
+    """
+    match = HRP.match(hrp)
+    if match is None:
+        raise Bolt11Error('invalid prefix ' + hrp)
+    currency, digits, multiplier = match.groups()
+    if digits is None:
+        return currency, None
+    if digits[0] == '0':
+        raise Bolt11Error('invalid amount')
+    if multiplier == 'p':
+        if int(digits) % 10:
+            raise Bolt11Error('sub-millisatoshi amount')
+        return currency, int(digits) // 10
+    return currency, int(digits) * MULTIPLIERS.get(multiplier, 10 ** 11)
+
+
+class Invoice:
+    """
+    Decoded BOLT11 invoice; the signature is checksummed but not verified
+    """
+    __slots__ = ('currency', 'amount_msat', 'timestamp', 'expiry', 'payment_hash', 'payment_secret',
+                 'description', 'description_hash', 'payee', 'min_final_cltv_expiry')
+
+    def __init__(self, currency: str, amount_msat: int, timestamp: int):
+        self.currency = currency
+        self.amount_msat = amount_msat
+        self.timestamp = timestamp
+        self.expiry = DEFAULT_EXPIRY
+        self.payment_hash = None
+        self.payment_secret = None
+        self.description = None
+        self.description_hash = None
+        self.payee = None
+        self.min_final_cltv_expiry = DEFAULT_MIN_FINAL_CLTV
+
+    @property
+    def amount_sat(self):
+        return None if self.amount_msat is None else self.amount_msat // 1000
+
+    @property
+    def expires_at(self) -> int:
+        return self.timestamp + self.expiry
+
+    def is_expired(self, now: float = None) -> bool:
+        return (time.time() if now is None else now) >= self.expires_at
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def decode(bolt11: str) -> Invoice:
+    """
+    decode an invoice (optionally 'lightning:' prefixed) without a network call
+    """
+    if bolt11[:10].lower() == 'lightning:':
+        bolt11 = bolt11[10:]
+    hrp, data = bech32_decode(bolt11)
+    currency, amount_msat = parse_hrp(hrp)
+    if len(data) < 7 + SIGNATURE_WORDS:
+        raise Bolt11Error('too short')
+    # 7 words timestamp, tagged fields, 104 words signature
+    invoice = Invoice(currency, amount_msat, words_to_int(data[:7]))
+    i, end = 7, len(data) - SIGNATURE_WORDS
+    while i + 3 <= end:
+        tag, length = data[i], data[i + 1] << 5 | data[i + 2]
+        words = data[i + 3:i + 3 + length]
+        i += 3 + length
+        if i > end:
+            raise Bolt11Error('truncated field')
+        if tag == TAG_PAYMENT_HASH and length == HASH_WORDS:
+            invoice.payment_hash = words_to_bytes(words).hex()
+        elif tag == TAG_PAYMENT_SECRET and length == HASH_WORDS:
+            invoice.payment_secret = words_to_bytes(words).hex()
+        elif tag == TAG_DESCRIPTION_HASH and length == HASH_WORDS:
+            invoice.description_hash = words_to_bytes(words).hex()
+        elif tag == TAG_DESCRIPTION:
+            invoice.description = words_to_bytes(words).decode('utf-8', errors='replace')
+        elif tag == TAG_EXPIRY:
+            invoice.expiry = words_to_int(words)
+        elif tag == TAG_MIN_FINAL_CLTV:
+            invoice.min_final_cltv_expiry = words_to_int(words)
+        elif tag == TAG_PAYEE and length == PAYEE_WORDS:
+            invoice.payee = words_to_bytes(words).hex()
+    if invoice.payment_hash is None:
+        raise Bolt11Error('no payment hash')
+    return invoice
+
+
+def expiry_time(bolt11: str) -> int:
+    """
+    unix time at which the invoice expires (timestamp + expiry tag)
+    """
+    return decode(bolt11).expires_at
+
+
+def is_invoice(text) -> bool:
+    """
+    True for a checksummed bech32 string with a lightning invoice prefix
+    """
+    if not isinstance(text, str) or not text[:2].lower() == 'ln':
+        return False
+    try:
+        bech32_decode(text)
+        return True
+    except Bolt11Error:
+        return False
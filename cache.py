@@ -0,0 +1,199 @@
+import re
+import time
+from collections import OrderedDict
+
+"""
+ in-process caches
+"""
+
+MAX_AGE = re.compile(r'(?:s-maxage|max-age)\s*=\s*"?(\d+)')
+
+
+def cache_control_ttl(header: str, default: float, maximum: float):
+    """
+    ttl in seconds from an upstream Cache-Control header.
+    returns 0 when the response must not be cached.
+    """
+    if not header:
+        return default
+    value = header.lower()
+    if 'no-store' in value or 'no-cache' in value or 'private' in value:
+        return 0
+    ages = [int(age) for age in MAX_AGE.findall(value)]
+    if not ages:
+        return default
+    return min(max(ages), maximum)
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with per-entry ttl.
+
+    Expired entries are kept for another `stale_ttl` seconds so callers
+    can serve them while a refresh runs in the background.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, stale_ttl: float = 0,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+
+    def lookup(self, key):
+        """
+        returns (value, fresh) or (None, False) on a miss
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        value, expires = entry
+        now = self._clock()
+        if now < expires:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value, True
+        if now < expires + self.stale_ttl:
+            self._data.move_to_end(key)
+            self.stale_hits += 1
+            return value, False
+        del self._data[key]
+        self.misses += 1
+        return None, False
+
+
+    def get(self, key, default=None):
+        """
+        fresh value only
+        """
+        value, fresh = self.lookup(key)
+        return value if fresh else default
+
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (value, self._clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+    async def load(self, key):
+        """
+        second tier lookup after a miss, (value, fresh); none here
+        """
+        return None, False
+
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+
+    def items(self) -> list:
+        """
+        (key, value) of fresh entries, without counting lookups
+        """
+        now = self._clock()
+        return [(key, value) for key, (value, expires) in list(self._data.items()) if now < expires]
+
+
+    def clear(self):
+        self._data.clear()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0.0}
+
+
+class ByteCache:
+    """
+    LRU cache of bytes values bounded by total size rather than entry count.
+
+    Each entry carries its own ttl, e.g. the remaining lifetime of the
+    invoice an image encodes.
+    """
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 600,
+                 clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires = entry
+            if self._clock() < expires:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+        self.misses += 1
+        return None
+
+
+    async def load(self, key):
+        """
+        second tier lookup after a miss; none here
+        """
+        return None
+
+
+    def set(self, key, value: bytes, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        if key in self._data:
+            self._remove(key)
+        if ttl <= 0 or len(value) > self.max_bytes:
+            return
+        while self.resident_bytes + len(value) > self.max_bytes:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+        self._data[key] = (value, self._clock() + ttl)
+        self.resident_bytes += len(value)
+
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        self.resident_bytes -= len(value)
+
+
+    def clear(self):
+        self._data.clear()
+        self.resident_bytes = 0
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self._data), 'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+from bolt11 import CHARSET, bech32_checksum, decode
+from cache import TTLCache
+from ln_address import LNAddress
+from models import Invoice, PayParams
+
+# LNAddress config for tests that never reach LNbits
+CONFIG = {'invoice_key': None, 'admin_key': None, 'base_url': None}
+# timestamp of the BOLT11 specification examples
+TIMESTAMP = 1496314658
+
+
+class Clock:
+    """
+    fake clock for the caches and limiters, moved by setting `now`
+    """
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def to_words(data: bytes) -> list:
+    """
+    32 bytes (a payment hash) as the 52 five-bit words of a tagged field
+    """
+    bits = int.from_bytes(data, 'big') << 4
+    return [(bits >> 5 * (51 - i)) & 31 for i in range(52)]
+
+
+def int_words(value: int) -> list:
+    """
+    an integer field (e.g. expiry) as big-endian five-bit words
+    """
+    words = [value & 31]
+    while value > 31:
+        value >>= 5
+        words.insert(0, value & 31)
+    return words
+
+
+def make_invoice(hrp='lnbc10u', timestamp=TIMESTAMP, fields=None):
+    """
+    checksummed, unsigned invoice from (tag, words) fields
+    """
+    if fields is None:
+        fields = [('p', [1] * 52)]
+    data = [(timestamp >> 5 * (6 - i)) & 31 for i in range(7)]
+    for tag, words in fields:
+        data += [CHARSET.index(tag), len(words) >> 5, len(words) & 31] + words
+    data += [0] * 104
+    return hrp + '1' + ''.join(CHARSET[w] for w in data + bech32_checksum(hrp, data))
+
+
+def expiring_invoice(expiry=600):
+    """
+    checksummed (unsigned) invoice that expires `expiry` seconds from now
+    """
+    return make_invoice('lnbc10u', int(time.time()), [('x', int_words(expiry)), ('p', [1] * 52)]).upper()
+
+
+BOLT11 = expiring_invoice()
+
+
+class FakeLNAddress:
+    def __init__(self, config, session=None):
+        self._session = session
+
+    async def pay_params(self, lnaddress):
+        return PayParams.from_json({'callback': 'https://example.com/cb', 'minSendable': 1000,
+                                    'maxSendable': 100000000, 'tag': 'payRequest'})
+
+    def get_payurl(self, email):
+        return 'https://example.com/.well-known/lnurlp/alice'
+
+    async def fetch_invoice(self, email, amount):
+        return Invoice.from_json({'pr': BOLT11.lower()})
+
+    async def get_bolt11(self, email, amount):
+        return (await self.fetch_invoice(email, amount)).bolt11
+
+
+@asynccontextmanager
+async def stub_server(routes):
+    """
+    local aiohttp stand-in for an upstream server, routes are
+    (method, path, handler); yields its base url
+    """
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        yield 'http://127.0.0.1:%d' % runner.addresses[0][1]
+    finally:
+        await runner.cleanup()
+
+
+def local_client(config, session, url, **kwargs) -> LNAddress:
+    """
+    LNAddress that looks every lightning address up on the stub at url
+    """
+    client = LNAddress(config, session, **kwargs)
+    client.get_payurl = lambda email: url + '/.well-known/lnurlp/' + email.split('@')[0]
+    return client
+
+
+def lnbits_routes(latency=0, fail=0, lose=0):
+    """
+    local stand-in for a lightning address server and an LNbits wallet:
+    the first `fail` payments are refused, the next `lose` are made but
+    answered with a 502
+    """
+    state = {'fetches': 0, 'posts': 0, 'paid': set(), 'duplicates': 0, 'paying': 0, 'max_paying': 0}
+
+    async def lnurlp(request):
+        user = request.match_info['user']
+        if user == 'nobody':
+            return web.json_response({'status': 'ERROR', 'reason': 'unknown user'})
+        return web.json_response({'callback': str(request.url.with_path('/cb/' + user)),
+                                  'minSendable': 1000, 'maxSendable': 10 ** 9, 'tag': 'payRequest'})
+
+    async def callback(request):
+        state['fetches'] += 1
+        msat = int(request.query['amount'])
+        payment_hash = hashlib.sha256(b'%d' % state['fetches']).digest()
+        pr = make_invoice('lnbc%dn' % (msat // 100), int(time.time()),
+                          [('p', to_words(payment_hash)), ('x', int_words(600))])
+        return web.json_response({'pr': pr, 'routes': []})
+
+    async def pay(request):
+        state['posts'] += 1
+        post = state['posts']
+        payment_hash = decode((await request.json())['bolt11']).payment_hash
+        state['paying'] += 1
+        state['max_paying'] = max(state['max_paying'], state['paying'])
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            state['paying'] -= 1
+        if post <= fail:
+            return web.json_response({'detail': 'no route found'}, status=520)
+        if payment_hash in state['paid']:
+            state['duplicates'] += 1
+            return web.json_response({'detail': 'invoice already paid'}, status=400)
+        state['paid'].add(payment_hash)
+        if post <= fail + lose:
+            return web.Response(status=502, text='bad gateway')
+        return web.json_response({'payment_hash': payment_hash, 'checking_id': payment_hash}, status=201)
+
+    async def status(request):
+        if request.match_info['hash'] in state['paid']:
+            return web.json_response({'paid': True, 'preimage': '00' * 32})
+        return web.json_response({'detail': 'Payment does not exist.'}, status=404)
+
+    routes = [('GET', '/.well-known/lnurlp/{user}', lnurlp), ('GET', '/cb/{user}', callback),
+              ('POST', '/api/v1/payments', pay), ('GET', '/api/v1/payments/{hash}', status)]
+    return routes, state
+
+
+def lnbits_client(session, url):
+    """
+    LNAddress wired to lnbits_routes() served at url
+    """
+    return local_client({'invoice_key': 'i', 'admin_key': 'a', 'base_url': url + '/api/v1/payments'},
+                        session, url, cache=TTLCache())
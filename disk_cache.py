@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ByteCache, TTLCache
+
+"""
+ second cache tier on disk, shared by every worker on the host and kept
+ across restarts: an SQLite database in WAL mode, so readers in other
+ processes never block on a writer.
+
+ set L2_CACHE_PATH (e.g. /tmp/sendsats-cache.sqlite3) to enable it for the
+ LNURL metadata and rendered QR image caches. the in-process caches stay
+ in front of it: a miss there reads through to disk and promotes the
+ entry back into memory.
+
+ disk I/O never runs on the event loop: reads are awaited on one thread
+ per process, writes are queued to it and not waited for.
+"""
+
+L2_CACHE_PATH = os.getenv('L2_CACHE_PATH', '')
+L2_CACHE_BYTES = int(os.getenv('L2_CACHE_BYTES', str(256 * 1024 * 1024)))
+# writes between expiry sweeps and size checks
+MAINTAIN_EVERY = 64
+# ms to wait on another worker's write before giving up on the disk tier
+BUSY_TIMEOUT = int(os.getenv('L2_CACHE_BUSY_TIMEOUT', '50'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires REAL NOT NULL,
+    keep_until REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+"""
+
+
+class DiskCache:
+    """
+    SQLite key/value store of bytes with an expiry time per entry.
+
+    Times are wall clock so they mean the same in every process. Entries
+    are kept until `keep_until` (expiry plus any stale window), and when
+    the values exceed `max_bytes` the ones closest to expiry go first.
+    Errors such as a lock held too long by another worker are logged and
+    treated as a miss: the disk tier never fails a request.
+
+    get() blocks; from async code use aget(). set() and delete() return
+    at once and run on the store's thread in order, so a later aget()
+    sees them; flush() waits for them.
+    """
+    def __init__(self, path: str, max_bytes: int = L2_CACHE_BYTES, clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._thread = None
+        self._thread_pid = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.evictions = 0
+
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection must not cross a fork, each worker opens its own
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+
+    def _executor(self) -> ThreadPoolExecutor:
+        # threads do not survive a fork either
+        if self._thread is None or self._thread_pid != os.getpid():
+            self._thread = ThreadPoolExecutor(1, thread_name_prefix='disk-cache')
+            self._thread_pid = os.getpid()
+        return self._thread
+
+
+    def _key(self, key) -> str:
+        # keys are strings or tuples of str/bytes/numbers, whose repr is stable
+        return key if isinstance(key, str) else repr(key)
+
+
+    def get(self, namespace: str, key) -> tuple:
+        """
+        (value, expires) or None; the entry may be past `expires` but
+        still within its keep_until window
+        """
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT value, expires FROM entries WHERE namespace = ? AND key = ? AND keep_until > ?',
+                    (namespace, self._key(key), self.clock())).fetchone()
+        except sqlite3.Error as e:
+            self._error(e)
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bytes(row[0]), row[1]
+
+
+    async def aget(self, namespace: str, key) -> tuple:
+        """
+        get() on the store's thread
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), self.get, namespace, key)
+
+
+    def set(self, namespace: str, key, value: bytes, ttl: float, keep: float = None):
+        """
+        store value for ttl seconds, kept for `keep` seconds (default ttl);
+        written in the background
+        """
+        self._executor().submit(self._set, namespace, key, value, ttl, keep, self.clock())
+
+
+    def delete(self, namespace: str, key):
+        self._executor().submit(self._delete, namespace, key)
+
+
+    def flush(self):
+        """
+        wait for queued writes
+        """
+        self._executor().submit(lambda: None).result()
+
+
+    def _set(self, namespace: str, key, value: bytes, ttl: float, keep: float, now: float):
+        try:
+            with self._lock:
+                self._connect().execute(
+                    'INSERT OR REPLACE INTO entries (namespace, key, value, expires, keep_until, size) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (namespace, self._key(key), value, now + ttl, now + max(ttl, keep or 0), len(value)))
+                self._writes += 1
+                if self._writes % MAINTAIN_EVERY == 0:
+                    self._maintain(now)
+        except sqlite3.Error as e:
+            self._error(e)
+
+
+    def _delete(self, namespace: str, key):
+        try:
+            with self._lock:
+                self._connect().execute('DELETE FROM entries WHERE namespace = ? AND key = ?',
+                                        (namespace, self._key(key)))
+        except sqlite3.Error as e:
+            self._error(e)
+
+
+    def _maintain(self, now: float):
+        conn = self._conn
+        conn.execute('DELETE FROM entries WHERE keep_until <= ?', (now,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # down to 90% so this does not run again on the next write
+        excess = total - int(self.max_bytes * 0.9)
+        doomed = []
+        for rowid, size in conn.execute('SELECT rowid, size FROM entries ORDER BY expires'):
+            doomed.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM entries WHERE rowid = ?', doomed)
+        self.evictions += len(doomed)
+
+
+    def _error(self, e: Exception):
+        self.errors += 1
+        logging.error("disk cache %s: %s" % (self.path, str(e)))
+
+
+    def close(self):
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.shutdown(wait=True)
+        self._thread = None
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                'evictions': self.evictions, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+class TieredTTLCache(TTLCache):
+    """
+    TTLCache that writes through to a DiskCache; after a memory miss,
+    load() reads through to it and promotes fresh entries back into memory.
+
+    Values are stored with `encode` and rebuilt with `decode`. A stale
+    disk entry is returned as stale but not promoted; the refresh the
+    caller starts writes the new value to both tiers.
+    """
+    def __init__(self, store: DiskCache, namespace: str, encode, decode, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.l2_hits = 0
+
+
+    async def load(self, key):
+        """
+        read through to disk after a memory miss: (value, fresh) or
+        (None, False)
+        """
+        entry = await self.store.aget(self.namespace, key)
+        if entry is None:
+            return None, False
+        data, expires = entry
+        try:
+            value = self.decode(data)
+        except Exception as e:
+            logging.error("undecodable %s cache entry: %s" % (self.namespace, str(e)))
+            self.store.delete(self.namespace, key)
+            return None, False
+        self.l2_hits += 1
+        remaining = expires - self.store.clock()
+        if remaining > 0:
+            super().set(key, value, remaining)
+        return value, remaining > 0
+
+
+    def set(self, key, value, ttl: float = None):
+        super().set(key, value, ttl)
+        ttl = self.ttl if ttl is None else ttl
+        if ttl > 0:
+            self.store.set(self.namespace, key, self.encode(value), ttl, ttl + self.stale_ttl)
+        else:
+            self.store.delete(self.namespace, key)
+
+
+    def pop(self, key, default=None):
+        self.store.delete(self.namespace, key)
+        return super().pop(key, default)
+
+
+    def stats(self) -> dict:
+        return dict(super().stats(), l2_hits=self.l2_hits)
+
+
+class TieredByteCache(ByteCache):
+    """
+    ByteCache that writes through to a DiskCache; load() reads through
+    after a memory miss and promotes disk hits back into memory
+    """
+    def __init__(self, store: DiskCache, namespace: str, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.namespace = namespace
+        self.l2_hits = 0
+
+
+    async def load(self, key):
+        """
+        read through to disk after a memory miss
+        """
+        entry = await self.store.aget(self.namespace, key)
+        if entry is None:
+            return None
+        value, expires = entry
+        remaining = expires - self.store.clock()
+        if remaining <= 0:
+            return None
+        self.l2_hits += 1
+        super().set(key, value, remaining)
+        return value
+
+
+    def set(self, key, value: bytes, ttl: float = None):
+        super().set(key, value, ttl)
+        ttl = self.ttl if ttl is None else ttl
+        if ttl > 0:
+            self.store.set(self.namespace, key, value, ttl)
+
+
+    def stats(self) -> dict:
+        return dict(super().stats(), l2_hits=self.l2_hits)
+
+
+store = None
+
+
+def get_store() -> DiskCache:
+    """
+    the shared DiskCache at L2_CACHE_PATH, None when it is not set
+    """
+    global store
+    if store is None and L2_CACHE_PATH:
+        store = DiskCache(L2_CACHE_PATH)
+    return store
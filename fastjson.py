@@ -0,0 +1,36 @@
+import json
+import os
+
+try:
+    # optional, parses and serialises several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+ JSON backend for upstream parsing and response serialisation:
+ orjson when installed (and JSON_BACKEND is not 'json'), else the stdlib
+"""
+
+BACKEND = 'orjson' if orjson is not None and os.getenv('JSON_BACKEND', 'orjson') == 'orjson' else 'json'
+
+# both raise a ValueError subclass on invalid input
+JSONDecodeError = orjson.JSONDecodeError if BACKEND == 'orjson' else json.JSONDecodeError
+
+
+if BACKEND == 'orjson':
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    def dumpb(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    loads = json.loads
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    def dumpb(obj) -> bytes:
+        return dumps(obj).encode('utf-8')
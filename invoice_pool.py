@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+
+from bolt11 import decode
+
+"""
+ pool of pre-generated, never-served BOLT11 invoices for hot tip links
+"""
+
+class InvoicePool:
+    """
+    Keeps a small buffer of fresh invoices per (address, amount).
+
+    A pair only gets a buffer once it is requested at least `hot_threshold`
+    times within `window` seconds; the buffer size then follows the recent
+    request rate (`lead_time` seconds of demand), capped at `max_size`.
+    Invoices are discarded `expiry_margin` seconds before they expire, or
+    once older than `max_age`, each invoice is handed out exactly once, and
+    refills are limited to `refill_rate` upstream fetches per second across
+    the whole pool. Pairs not requested recently are dropped first.
+    """
+    def __init__(self, fetch, max_size: int = 5, max_age: float = 600, expiry_margin: float = 60,
+                 window: float = 60, hot_threshold: int = 3, lead_time: float = 10,
+                 refill_rate: float = 5, max_keys: int = 256, clock=time.monotonic):
+        self._fetch = fetch
+        self.max_size = max_size
+        self.max_age = max_age
+        self.expiry_margin = expiry_margin
+        self.window = window
+        self.hot_threshold = hot_threshold
+        self.lead_time = lead_time
+        self.refill_interval = 1.0 / refill_rate if refill_rate > 0 else 0
+        self.max_keys = max_keys
+        self._clock = clock
+        self._invoices = OrderedDict()
+        self._requests = OrderedDict()
+        self._refills = {}
+        self._next_fetch = 0.0
+        self._rate_lock = asyncio.Lock()
+        self.served = 0
+        self.misses = 0
+        self.expired = 0
+        self.fetched = 0
+
+
+    def take(self, address: str, amount):
+        """
+        pop a fresh invoice or return None, scheduling a background refill
+        """
+        key = (address, amount)
+        now = self._clock()
+        self._record(key, now)
+        bolt11 = None
+        buffer = self._invoices.get(key)
+        if buffer is not None:
+            self._invoices.move_to_end(key)
+            while buffer:
+                usable_until, invoice = buffer.popleft()
+                if now < usable_until:
+                    bolt11 = invoice
+                    break
+                self.expired += 1
+        if bolt11 is None:
+            self.misses += 1
+        else:
+            self.served += 1
+        self._schedule_refill(key)
+        return bolt11
+
+
+    def target_size(self, key) -> int:
+        """
+        buffer size for a key from its request rate over the last window
+        """
+        stamps = self._requests.get(key)
+        if not stamps or len(stamps) < self.hot_threshold:
+            return 0
+        rate = len(stamps) / self.window
+        return max(1, min(self.max_size, math.ceil(rate * self.lead_time)))
+
+
+    def _record(self, key, now):
+        stamps = self._requests.get(key)
+        if stamps is None:
+            stamps = self._requests[key] = deque()
+        else:
+            self._requests.move_to_end(key)
+        stamps.append(now)
+        while stamps and now - stamps[0] > self.window:
+            stamps.popleft()
+        while len(self._requests) > self.max_keys:
+            oldest, _ = self._requests.popitem(last=False)
+            self._invoices.pop(oldest, None)
+
+
+    def _schedule_refill(self, key):
+        if key in self._refills or self.target_size(key) == 0:
+            return
+        self._refills[key] = asyncio.ensure_future(self._refill(key))
+
+
+    async def _refill(self, key):
+        address, amount = key
+        try:
+            while True:
+                buffer = self._invoices.get(key)
+                if buffer is None:
+                    buffer = self._invoices[key] = deque()
+                    while len(self._invoices) > self.max_keys:
+                        self._invoices.popitem(last=False)
+                now = self._clock()
+                while buffer and now >= buffer[0][0]:
+                    buffer.popleft()
+                    self.expired += 1
+                if len(buffer) >= self.target_size(key):
+                    return
+                await self._wait_turn()
+                bolt11 = await self._fetch(address, amount)
+                self.fetched += 1
+                usable_until = self._usable_until(bolt11)
+                if usable_until is None:
+                    logging.warning("invoice pool: no invoice for " + str(address) + ", " + str(bolt11))
+                    return
+                if usable_until <= self._clock():
+                    logging.warning("invoice pool: invoice for " + str(address) + " expires too soon to pool")
+                    return
+                buffer.append((usable_until, bolt11))
+        except Exception as e:
+            logging.error("invoice pool refill failed: " + str(e))
+        finally:
+            self._refills.pop(key, None)
+
+
+    def _usable_until(self, bolt11):
+        """
+        pool clock time after which the invoice is no longer handed out,
+        None when it is not an invoice
+        """
+        if not isinstance(bolt11, str):
+            return None
+        try:
+            expires_at = decode(bolt11).expires_at
+        except ValueError:
+            return None
+        now = self._clock()
+        return min(now + self.max_age, now + expires_at - time.time() - self.expiry_margin)
+
+
+    async def _wait_turn(self):
+        """
+        space upstream fetches at least refill_interval apart
+        """
+        async with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_fetch - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now += delay
+            self._next_fetch = now + self.refill_interval
+
+
+    async def close(self):
+        tasks = list(self._refills.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._invoices.clear()
+
+
+    def stats(self) -> dict:
+        return {'keys': len(self._invoices),
+                'buffered': sum(len(b) for b in self._invoices.values()),
+                'refilling': len(self._refills),
+                'served': self.served, 'misses': self.misses,
+                'expired': self.expired, 'fetched': self.fetched}
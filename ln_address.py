@@ -1,8 +1,19 @@
-import json
+import asyncio
 import logging
+import os
+import socket
+import time
 
+from aiohttp import ClientConnectorDNSError
 from aiohttp.client import ClientSession
-from utils import get_url, post_url, post_jurl
+from bolt11 import decode
+from cache import TTLCache, cache_control_ttl
+from disk_cache import TieredTTLCache, get_store
+from fastjson import dumpb, dumps, loads
+from metrics import upstream_in_flight
+from models import Invoice, LNURLError, LNURLReason, PayParams
+from tracing import span
+from utils import SingleFlight, get_url, post_url, request
 
 ###################################
 # Serverless-compatible logging (stdout instead of file)
@@ -11,17 +22,68 @@ logging.getLogger("lnaddress").setLevel(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 ###################################
 
+# LNURL-pay metadata (callback, min/maxSendable, metadata) keyed by lightning address
+METADATA_TTL = float(os.getenv('METADATA_TTL', '300'))
+METADATA_MAX_TTL = float(os.getenv('METADATA_MAX_TTL', '3600'))
+metadata_config = { 'maxsize': int(os.getenv('METADATA_CACHE_SIZE', '4096')),
+                    'ttl': METADATA_TTL,
+                    'stale_ttl': float(os.getenv('METADATA_STALE_TTL', '600')) }
+if get_store() is not None:
+    # shared with other workers and kept across restarts, as the LNURL-pay JSON
+    metadata_cache = TieredTTLCache(get_store(), 'metadata', lambda params: dumpb(params.raw),
+                                    lambda data: PayParams.from_json(loads(data)), **metadata_config)
+else:
+    metadata_cache = TTLCache(**metadata_config)
+_refreshing = {}
+# concurrent well-known fetches for the same url share one upstream call
+metadata_flight = SingleFlight()
+
+# failed well-known lookups, keyed by ('domain', domain) or ('address', lnaddress)
+NEGATIVE_TTL_NXDOMAIN = float(os.getenv('NEGATIVE_TTL_NXDOMAIN', '300'))
+NEGATIVE_TTL_NOT_FOUND = float(os.getenv('NEGATIVE_TTL_NOT_FOUND', '60'))
+NEGATIVE_TTL_MALFORMED = float(os.getenv('NEGATIVE_TTL_MALFORMED', '30'))
+negative_cache = TTLCache(maxsize=int(os.getenv('NEGATIVE_CACHE_SIZE', '65536')), ttl=NEGATIVE_TTL_NOT_FOUND)
+
+
+class LNAddressError(Exception):
+    """
+    the lightning address cannot be resolved to LNURL-pay metadata
+    """
+    pass
+
+
+class LNbitsError(Exception):
+    """
+    LNbits answered with an error status
+    """
+    pass
+
+
+async def drain(timeout: float) -> int:
+    """
+    wait up to timeout seconds for background metadata refreshes and any
+    other upstream request still in flight, returns how many are left
+    """
+    deadline = time.monotonic() + timeout
+    if _refreshing:
+        await asyncio.wait(list(_refreshing.values()), timeout=timeout)
+    while upstream_in_flight.value() > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return len(_refreshing) + upstream_in_flight.value()
+
+
 class LNAddress:
     """
     Async Methods for Payment to a LN Address w/LNBits API
+
+    holds no per-call state, so one instance can serve concurrent requests
     """
-    def __init__(self, config, session: ClientSession = None):
+    def __init__(self, config, session: ClientSession = None, cache: TTLCache = metadata_cache):
         self._session = session
+        self._cache = cache
         self._inv_key = config['invoice_key']
         self._admin_key = config['admin_key']
         self.base_url = config['base_url']
-        self.datablock = {}
-        self.pr_dict = {}
 
 
     def invoice_headers(self):
@@ -47,19 +109,83 @@ class LNAddress:
         data = {"Content-type": "text/html; charset=UTF-8"}
         return data
 
-    async def callback_data(self, lnaddress: str):
+    async def callback_data(self, lnaddress: str) -> dict:
+        """
+        returns the LNURL-pay response of a lightning address as a dict
+        """
+        return (await self.pay_params(lnaddress)).raw
+
+
+    async def pay_params(self, lnaddress: str) -> PayParams:
         """
-        returns datablock from bolt11
+        LNURL-pay parameters of a lightning address
+
+        served from the metadata cache when possible, stale entries
+        are returned immediately and refreshed in the background
+        """
+        with span('metadata'):
+            if self._cache is not None:
+                params, fresh = self._cache.lookup(lnaddress)
+                if params is None:
+                    params, fresh = await self._cache.load(lnaddress)
+                if params is not None:
+                    if not fresh and lnaddress not in _refreshing:
+                        _refreshing[lnaddress] = asyncio.ensure_future(self._refresh(lnaddress))
+                    return params
+
+            domain = lnaddress.rpartition('@')[2].lower()
+            reason = negative_cache.get(('domain', domain)) or negative_cache.get(('address', lnaddress))
+            if reason is not None:
+                raise LNAddressError(reason)
+
+            return await self.fetch_pay_params(lnaddress)
+
+
+    async def fetch_pay_params(self, lnaddress: str) -> PayParams:
+        """
+        GET the well-known lnurlp url and cache the parameters
+        for as long as the upstream Cache-Control allows
         """
         purl = self.get_payurl(lnaddress)
-        json_content = await get_url(session=self._session, path=purl, headers=self.headers())
-        # print("url: " + purl)
+        return await metadata_flight.do(purl, self._fetch_pay_params, lnaddress, purl)
+
+
+    async def _fetch_pay_params(self, lnaddress: str, purl: str) -> PayParams:
+        domain = lnaddress.rpartition('@')[2].lower()
+        try:
+            status, json_content, resp_headers = await request(self._session, 'GET', purl, self.headers(), hedge=True)
+        except ClientConnectorDNSError as e:
+            if getattr(e.os_error, 'errno', None) != socket.EAI_AGAIN:
+                negative_cache.set(('domain', domain), 'Unknown domain ' + domain, NEGATIVE_TTL_NXDOMAIN)
+            raise
+
+        if status in (404, 410):
+            reason = 'No such lightning address ' + lnaddress
+            negative_cache.set(('address', lnaddress), reason, NEGATIVE_TTL_NOT_FOUND)
+            raise LNAddressError(reason)
 
-        datablock = json.loads(json_content)
-        #print("DataBlock from Bolt11: " )
-        #print(datablock)
-        self.datablock = datablock
-        return datablock
+        try:
+            params = PayParams.from_json(loads(json_content))
+        except ValueError as e:
+            if status >= 500:
+                raise LNAddressError('LNURL server error %d for %s' % (status, lnaddress))
+            reason = str(e) if isinstance(e, LNURLReason) else 'Malformed LNURL-pay response for ' + lnaddress
+            negative_cache.set(('address', lnaddress), reason, NEGATIVE_TTL_MALFORMED)
+            raise LNAddressError(reason)
+
+        if self._cache is not None:
+            ttl = cache_control_ttl(resp_headers.get('Cache-Control'), METADATA_TTL, METADATA_MAX_TTL)
+            self._cache.set(lnaddress, params, ttl)
+        return params
+
+
+    async def _refresh(self, lnaddress: str):
+        try:
+            await self.fetch_pay_params(lnaddress)
+        except Exception as e:
+            logging.error("metadata refresh failed for " + lnaddress + ": " + str(e))
+        finally:
+            _refreshing.pop(lnaddress, None)
 
 
     def get_payurl(self, email: str):
@@ -76,85 +202,47 @@ class LNAddress:
             logging.info("Transformed URL:" + transform_url)
             return transform_url
         except Exception as e:
-            logging.error("Exception, possibly malformed LN Address: " + e)
+            logging.error("Exception, possibly malformed LN Address: " + str(e))
             return {'status' : 'error', 'msg' : 'Possibly a malformed LN Address'}
 
 
+    async def fetch_invoice(self, lnaddress: str, amount: int) -> Invoice:
+        """
+        request an invoice for amount sats (None or below minSendable
+        uses the minimum) and check it is for that amount and not expired;
+        raises LNURLReason when the server refuses, LNURLError when the
+        invoice cannot be used
+        """
+        params = await self.pay_params(lnaddress)
+        msat = params.amount_msat(amount)
+        # TODO: check if URL is legit, else return error
+        # get bech32-serialized lightning invoice
+        with span('invoice'):
+            # not hedged: every request to the callback mints a new invoice
+            ln_res = await get_url(session=self._session, path=params.query_url(msat), headers=self.headers())
+        invoice = Invoice.from_json(loads(ln_res))
+        if invoice.amount_msat != msat:
+            raise LNURLError('Invoice amount %s msat does not match requested %d msat' % (invoice.amount_msat, msat))
+        if invoice.expires_at <= time.time():
+            raise LNURLError('Invoice from LNURL server has already expired')
+        return invoice
+
+
     async def get_bolt11(self, email: str, amount: int):
         """
             get Bolt11 Invoice from Lightning Address (variable named email here)
 
-            fail state
-            {'reason': 'Amount 100 is smaller than minimum 100000.', 'status': 'ERROR'}
-
-            success state
-            {'pr': 'lnbc1......azgfe0',
-            'routes': [], 'successAction': {'description': 'Thanks love for the lightning!',
-            'tag': 'url', 'url': 'https:/.......'}}
+            returns the upper case bolt11, the LNURL server's reason when it
+            refuses, e.g. 'Amount 100 is smaller than minimum 100000.', or an
+            error dict {'status': 'error', 'msg': ...}
         """
         try:
-            # purl = self.get_payurl(email)
-            # json_content = await get_url(session=self._session, path=purl, headers=self.headers())
-            # print("url: " + purl)
-
-            # datablock = json.loads(json_content)
-            # print("DataBlock from Bolt11: " )
-            # print(datablock)
-
-            if len(self.datablock) == 0:
-                await self.callback_data(email)
-
-            datablock = self.datablock
-            lnurlpay = datablock["callback"]
-            min_amount = datablock["minSendable"]
-
-            # print("lnurlpay: ")
-            # print(lnurlpay)
-            # print("min amount: " )
-            # print(min_amount)
-            # print("\n\n")
-
-            payquery = lnurlpay + "?amount=" + str(int(min_amount))
-            # print("pay query")
-            # print(payquery)
-
-            if amount is not None:
-                if int(amount*1000) > int(min_amount):
-                    payquery = lnurlpay + "?amount=" + str(int(amount*1000))
-                    # print("amount: " + str(int(amount)))
-
-            # print("post check - payquery: " + str(payquery))
-            # print("\n\n")
-
-            # logging.info("amount: " + str(amount))
-            # logging.info("payquery: " + str(payquery))
-
-            # TODO: check if URL is legit, else return error
-            # get bech32-serialized lightning invoice
-            ln_res =  await get_url(session=self._session, path=payquery, headers=self.headers())
-            # print("\n Type of ln_res:")
-            # print(type(ln_res))
-
-            pr_dict = json.loads(ln_res)
-            # print("\n\n The pr_dict: ")
-            # print(pr_dict)
-            # print("\n\n")
-            self.pr_dict = pr_dict
-
-            if 'pr' in pr_dict:
-                bolt11 = pr_dict['pr']
-                # capitalize bolt11
-                ubolt11 = bolt11.upper()
-                print("\n ubolt11: ")
-                print(ubolt11)
-                return ubolt11
-
-            elif 'reason' in pr_dict:
-                reason = pr_dict['reason']
-                # print("\n reason: " )
-                # print(reason)
-                return reason
-
+            return (await self.fetch_invoice(email, amount)).bolt11
+        except LNURLReason as e:
+            return str(e)
+        except LNURLError as e:
+            logging.error("in get bolt11 : " + str(e))
+            return {'status': 'error', 'msg': str(e)}
         except Exception as e:
             logging.error("in get bolt11 : "  + str(e))
             return {'status': 'error', 'msg': 'Cannot make a Bolt11, are you sure the address is valid?'}
@@ -162,19 +250,14 @@ class LNAddress:
 
     async def get_payhash(self, bolt11):
         """
-        get payment hash from bolt11 - use json on post request
+        get payment hash from bolt11, decoded locally
         """
         try:
-            decode_url = self.base_url + "/decode"
-            payload = {'data': bolt11}
-            decoded =  await post_jurl(session=self._session, path=decode_url, json=payload, headers=self.invoice_headers())
-            # logging.info(decoded)
-            if 'payment_hash' in decoded:
-                payhash = decoded['payment_hash']
-                logging.info('payment hash: ' + payhash)
-                return payhash
+            payhash = decode(bolt11).payment_hash
+            logging.info('payment hash: ' + payhash)
+            return payhash
         except Exception as e:
-            logging.error('Exception in get_payhash() ', str(e))
+            logging.error('Exception in get_payhash() ' + str(e))
             return e
 
 
@@ -185,14 +268,29 @@ class LNAddress:
         try:
             logging.info("LNAddress.check_invoice()")
             payhashurl = self.base_url + "/" + str(payhash)
-            res =  await get_url(session=self._session, path=payhashurl, headers=self.invoice_headers())
-            output = json.loads(res)
+            res =  await get_url(session=self._session, path=payhashurl, headers=self.invoice_headers(), hedge=True)
+            output = loads(res)
             return output
         except Exception as e:
-            logging.error('Exception in get_paystatus() ', str(e))
+            logging.error('Exception in get_paystatus() ' + str(e))
             return str(e)
 
 
+    async def payment(self, payhash: str) -> dict:
+        """
+        LNbits' record of a payment hash, None when it has none;
+        unlike check_invoice, raises on transport and server errors
+        so an unanswered check is never mistaken for a missing payment
+        """
+        status, res, _ = await request(self._session, 'GET', self.base_url + "/" + str(payhash),
+                                       self.invoice_headers(), hedge=True)
+        if status == 404:
+            return None
+        if status >= 300:
+            raise LNbitsError('LNbits payment check failed with %d' % status)
+        return loads(res)
+
+
     async def pay_invoice(self, bolt11):
         """
         pay bolt11 invoice
@@ -203,11 +301,11 @@ class LNAddress:
         try:
             logging.info("LNAddress.pay_invoice()")
             data = {"out": True, "bolt11": bolt11}
-            body = json.dumps(data)
+            body = dumps(data)
             logging.info(f"body: {body}")
             res =  await post_url(session=self._session, path=self.base_url, body=body, headers=self.admin_headers())
             logging.info(res)
             return res
         except Exception as e:
-            logging.error('Exception in pay_invoices(): ', e)
+            logging.error('Exception in pay_invoices(): ' + str(e))
             return e
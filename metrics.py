@@ -0,0 +1,236 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+"""
+ in-process Prometheus metrics, text exposition format 0.0.4.
+
+ recording is a dict lookup and a few integer adds, cheap enough to
+ leave on permanently; nothing is shared across worker processes.
+"""
+
+# per metric, label sets beyond this are folded into one 'other' series
+MAX_SERIES = int(os.getenv('METRICS_MAX_SERIES', '500'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [(n, v) for n, v in zip(names, values)] + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, _escape(v)) for n, v in pairs) + '}'
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    base for labelled metrics, one series per label tuple
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+
+
+    def _key(self, labels) -> tuple:
+        if labels in self._series or len(self._series) < MAX_SERIES:
+            return labels
+        return ('other',) * len(self.labelnames)
+
+
+    def expose(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in sorted(self._series.items()):
+            lines.extend(self._lines(labels, value))
+        return lines
+
+
+    def _lines(self, labels, value) -> list:
+        return ['%s%s %s' % (self.name, _labels(self.labelnames, labels), _number(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+    def set(self, value, *labels):
+        self._series[self._key(labels)] = value
+
+
+    def value(self, *labels):
+        return self._series.get(labels, 0)
+
+
+class Histogram(Metric):
+    """
+    cumulative buckets are only summed at exposition time, so
+    observe() is a bisect and two adds
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # one count per bucket plus +Inf, then the sum
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+    def _lines(self, labels, series) -> list:
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), series):
+            total += count
+            lines.append('%s_bucket%s %d' % (self.name, _labels(self.labelnames, labels, [('le', _number(bound))]), total))
+        lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _number(series[-1])))
+        lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels), total))
+        return lines
+
+
+class Registry:
+    """
+    metrics plus collectors, callables that return sampled
+    gauges as (name, help, {label: value}, value) at scrape time
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+
+    def register(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        sampled = {}
+        for collector in self._collectors:
+            for name, help, labels, value in collector():
+                sampled.setdefault(name, (help, []))[1].append((labels, value))
+        for name, (help, samples) in sampled.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, _labels(labels.keys(), labels.values()), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def stats_samples(prefix: str, stats: dict, labels: dict = None):
+    """
+    numeric entries of a stats() dict as sampled gauges named prefix_key
+    """
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + '_' + key, prefix.replace('_', ' ') + ' ' + key.replace('_', ' '), labels or {}, value
+
+
+registry = Registry()
+
+# page building phases: metadata, invoice, qr_encode, qr_render, template
+phase_seconds = registry.histogram('sendsats_phase_seconds',
+                                   'Time spent per request phase', ('phase',))
+upstream_seconds = registry.histogram('sendsats_upstream_request_seconds',
+                                      'Upstream request latency per domain', ('domain', 'method'))
+upstream_responses = registry.counter('sendsats_upstream_responses_total',
+                                      'Upstream responses per domain and status code, or error class',
+                                      ('domain', 'status'))
+upstream_in_flight = registry.gauge('sendsats_upstream_in_flight',
+                                    'Upstream requests currently in flight')
+http_seconds = registry.histogram('sendsats_http_request_seconds',
+                                  'HTTP request latency per handler', ('handler', 'method', 'status'))
+http_in_flight = registry.gauge('sendsats_http_in_flight',
+                                'HTTP requests currently being served')
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting in-flight requests and timing them per handler
+    """
+    def __init__(self, app):
+        self.app = app
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec()
+            endpoint = scope.get('endpoint')
+            handler = getattr(endpoint, '__name__', 'other')
+            http_seconds.observe(time.perf_counter() - start, handler, scope['method'], str(status[0]))
@@ -0,0 +1,101 @@
+from bolt11 import Bolt11Error, decode
+
+"""
+ compact LNURL-pay response models, built once per upstream response.
+
+ `raw` keeps the parsed JSON for templates and API responses that
+ show it; everything the server itself reads is a slot.
+"""
+
+
+class LNURLError(ValueError):
+    """
+    an LNURL server response that cannot be used
+    """
+    pass
+
+
+class LNURLReason(LNURLError):
+    """
+    the LNURL server refused, with a {"status": "ERROR", "reason": ...} response
+    """
+    pass
+
+
+def _error(data, default: str) -> LNURLError:
+    if isinstance(data, dict) and 'reason' in data:
+        return LNURLReason(str(data['reason']))
+    return LNURLError(default)
+
+
+class PayParams:
+    """
+    LNURL-pay parameters from a lightning address' well-known url (LUD-06)
+    """
+    __slots__ = ('callback', 'min_sendable', 'max_sendable', 'metadata', 'comment_allowed', 'raw')
+
+    def __init__(self, callback: str, min_sendable: int, max_sendable: int, metadata: str = None,
+                 comment_allowed: int = 0, raw: dict = None):
+        self.callback = callback
+        self.min_sendable = min_sendable
+        self.max_sendable = max_sendable
+        self.metadata = metadata
+        self.comment_allowed = comment_allowed
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, data) -> 'PayParams':
+        if not isinstance(data, dict) or 'callback' not in data:
+            raise _error(data, 'no callback')
+        try:
+            return cls(data['callback'], int(data.get('minSendable', 1000)),
+                       int(data.get('maxSendable', data.get('minSendable', 1000))),
+                       data.get('metadata'), int(data.get('commentAllowed') or 0), data)
+        except (TypeError, ValueError) as e:
+            raise LNURLError('invalid amounts: ' + str(e))
+
+    def amount_msat(self, amount) -> int:
+        """
+        millisatoshi to request for `amount` sats, at least minSendable
+        """
+        if amount is not None and int(amount * 1000) > self.min_sendable:
+            return int(amount * 1000)
+        return self.min_sendable
+
+    def query_url(self, msat: int) -> str:
+        separator = '&' if '?' in self.callback else '?'
+        return self.callback + separator + 'amount=' + str(msat)
+
+
+class Invoice:
+    """
+    LNURL-pay callback response: the BOLT11 invoice and its decoded fields
+    """
+    __slots__ = ('pr', 'payment_hash', 'amount_msat', 'expires_at', 'success_action', 'raw')
+
+    def __init__(self, pr: str, payment_hash: str, amount_msat: int, expires_at: int,
+                 success_action: dict = None, raw: dict = None):
+        self.pr = pr
+        self.payment_hash = payment_hash
+        self.amount_msat = amount_msat
+        self.expires_at = expires_at
+        self.success_action = success_action
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, data) -> 'Invoice':
+        if not isinstance(data, dict) or not isinstance(data.get('pr'), str):
+            raise _error(data, 'no invoice')
+        try:
+            decoded = decode(data['pr'])
+        except Bolt11Error as e:
+            raise LNURLError('Invalid invoice from LNURL server: ' + str(e))
+        return cls(data['pr'], decoded.payment_hash, decoded.amount_msat, decoded.expires_at,
+                   data.get('successAction'), data)
+
+    @property
+    def bolt11(self) -> str:
+        """
+        upper case, for compact alphanumeric QR codes
+        """
+        return self.pr.upper()
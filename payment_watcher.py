@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+
+"""
+ payment status watcher: one background poller for every watched
+ payment hash, shared by all clients waiting on the same invoice
+"""
+
+
+class Watch:
+    """
+    one watched payment hash and the queues of its subscribers
+    """
+    __slots__ = ('payment_hash', 'subscribers', 'expires_at', 'next_poll', 'interval', 'status')
+
+    def __init__(self, payment_hash: str, expires_at: float, next_poll: float, interval: float):
+        self.payment_hash = payment_hash
+        self.subscribers = set()
+        self.expires_at = expires_at
+        self.next_poll = next_poll
+        self.interval = interval
+        self.status = None
+
+
+class PaymentWatcher:
+    """
+    Polls `check(payment_hash)` for every watched hash on a shared schedule.
+
+    Each hash is polled at most once per interval however many clients
+    subscribe; the interval grows by `backoff` up to `max_interval` while
+    the invoice stays unpaid. Subscribers get an event dict on their queue
+    whenever the status changes, and a watch ends when the invoice is paid,
+    expires, or loses its last subscriber.
+    """
+    def __init__(self, check, interval: float = 2, max_interval: float = 30, backoff: float = 1.5,
+                 concurrency: int = 10, ttl: float = 3600, clock=time.time):
+        self._check = check
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.ttl = ttl
+        self._clock = clock
+        self._limit = asyncio.Semaphore(concurrency)
+        self._watches = {}
+        self._task = None
+        self._wake = asyncio.Event()
+        self.polls = 0
+        self.ticks = 0
+        self.errors = 0
+
+
+    def subscribe(self, payment_hash: str, expires_at: float = None) -> asyncio.Queue:
+        now = self._clock()
+        watch = self._watches.get(payment_hash)
+        if watch is None:
+            watch = self._watches[payment_hash] = Watch(payment_hash, expires_at or now + self.ttl,
+                                                        now, self.interval)
+        elif expires_at is not None:
+            watch.expires_at = expires_at
+        queue = asyncio.Queue()
+        watch.subscribers.add(queue)
+        if watch.status is not None:
+            queue.put_nowait(self._event(watch))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        self._wake.set()
+        return queue
+
+
+    def unsubscribe(self, payment_hash: str, queue: asyncio.Queue):
+        watch = self._watches.get(payment_hash)
+        if watch is not None:
+            watch.subscribers.discard(queue)
+            if not watch.subscribers:
+                del self._watches[payment_hash]
+
+
+    def _event(self, watch: Watch) -> dict:
+        return {'payment_hash': watch.payment_hash, 'status': watch.status, 'paid': watch.status == 'paid'}
+
+
+    def _publish(self, watch: Watch, status: str):
+        if status == watch.status:
+            return
+        watch.status = status
+        event = self._event(watch)
+        for queue in watch.subscribers:
+            queue.put_nowait(event)
+        if status in ('paid', 'expired'):
+            self._watches.pop(watch.payment_hash, None)
+
+
+    async def _poll(self, watch: Watch):
+        async with self._limit:
+            self.polls += 1
+            try:
+                result = await self._check(watch.payment_hash)
+            except Exception as e:
+                logging.error("payment status check failed: " + str(e))
+                result = None
+        if self._watches.get(watch.payment_hash) is not watch:
+            return
+        if isinstance(result, dict) and result.get('paid'):
+            self._publish(watch, 'paid')
+            return
+        if not isinstance(result, dict) or 'paid' not in result:
+            # no record of the payment (None) or an error body
+            self.errors += 1
+        elif watch.status is None:
+            self._publish(watch, 'pending')
+        watch.interval = min(watch.interval * self.backoff, self.max_interval)
+        watch.next_poll = self._clock() + watch.interval
+
+
+    async def _run(self):
+        try:
+            while self._watches:
+                now = self._clock()
+                for watch in [w for w in self._watches.values() if w.expires_at <= now]:
+                    self._publish(watch, 'expired')
+                due = [w for w in self._watches.values() if w.next_poll <= now]
+                if due:
+                    self.ticks += 1
+                    await asyncio.gather(*[self._poll(watch) for watch in due])
+                    continue
+                if not self._watches:
+                    break
+                wake_at = min(min(w.next_poll, w.expires_at) for w in self._watches.values())
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), max(0, wake_at - now))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._task = None
+
+
+    async def close(self):
+        # with no watches left the poller exits even if the cancel is lost
+        # to a wait_for that is completing at the same moment
+        self._watches.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+    def __len__(self):
+        return len(self._watches)
+
+
+    def stats(self) -> dict:
+        return {'watches': len(self._watches),
+                'subscribers': sum(len(w.subscribers) for w in self._watches.values()),
+                'polls': self.polls, 'ticks': self.ticks, 'errors': self.errors}
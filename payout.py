@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import logging
+import os
+import sys
+import time
+
+from fastjson import dumpb, dumps, loads
+from ln_address import LNAddress
+from models import LNURLError
+
+"""
+ mass payouts: pay a list of (lightning address, amount) through LNbits,
+ fetching invoices and paying them concurrently, resumable from a journal.
+
+ every payout has an idempotency key. the journal records the invoice
+ fetched for a key and, synced to disk before the payment is sent, that
+ it is being paid. after a crash that key is not paid again until LNbits
+ confirms it has no such payment; retries reuse the same invoice, which
+ can only be paid once, and a new one is fetched only after it expired.
+ payouts that failed are confirmed unpaid and are tried again by a rerun.
+
+ usage: python payout.py payouts.csv [--journal payouts.journal]
+            [--fetch-concurrency 20] [--pay-concurrency 5]
+
+ payouts.csv rows are: address,amount[,key]
+"""
+
+FETCH_CONCURRENCY = int(os.getenv('PAYOUT_FETCH_CONCURRENCY', '20'))
+PAY_CONCURRENCY = int(os.getenv('PAYOUT_PAY_CONCURRENCY', '5'))
+RETRIES = int(os.getenv('PAYOUT_RETRIES', '3'))
+BACKOFF = float(os.getenv('PAYOUT_BACKOFF', '1'))
+MAX_BACKOFF = float(os.getenv('PAYOUT_MAX_BACKOFF', '30'))
+# how long to wait for a pending payment before leaving it for the next run
+SETTLE_TIMEOUT = float(os.getenv('PAYOUT_SETTLE_TIMEOUT', '60'))
+# invoices closer than this to expiry are replaced instead of paid
+EXPIRY_MARGIN = float(os.getenv('PAYOUT_EXPIRY_MARGIN', '30'))
+
+INVOICE = 'invoice'
+PAYING = 'paying'
+PAID = 'paid'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+
+class PayoutError(Exception):
+    """
+    a payout attempt failed and may be retried
+    """
+    pass
+
+
+class Payout:
+    """
+    one recipient: lightning address, amount in sats and idempotency key
+    """
+    __slots__ = ('key', 'address', 'amount')
+
+    def __init__(self, key: str, address: str, amount: int):
+        self.key = key
+        self.address = address
+        self.amount = amount
+
+
+def make_payouts(rows) -> list:
+    """
+    (address, amount[, key]) rows to Payouts. rows without a key get one
+    from the address, amount and how often that pair came before, so the
+    same list gets the same keys on every run
+    """
+    seen = {}
+    payouts = []
+    for row in rows:
+        address, amount = row[0].strip(), int(row[1])
+        key = row[2].strip() if len(row) > 2 and row[2].strip() else None
+        if key is None:
+            n = seen[address, amount] = seen.get((address, amount), -1) + 1
+            key = hashlib.sha256(('%s:%d:%d' % (address, amount, n)).encode()).hexdigest()[:32]
+        payouts.append(Payout(key, address, amount))
+    return payouts
+
+
+class Journal:
+    """
+    append-only JSON lines file of payout state changes; reading it back,
+    the last record of each key wins
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = {}
+        self._file = None
+        if path is None:
+            return
+        tail = b'\n'
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    tail = line[-1:]
+                    try:
+                        record = loads(line)
+                    except ValueError:
+                        # a line torn by a crash mid-write
+                        continue
+                    self.entries.setdefault(record['key'], {}).update(record)
+        self._file = open(path, 'ab')
+        if tail != b'\n':
+            self._file.write(b'\n')
+
+
+    def get(self, key: str) -> dict:
+        return self.entries.get(key, {})
+
+
+    def record(self, key: str, state: str, sync: bool = False, **fields):
+        """
+        add a state change; sync=True returns only once it is on disk
+        """
+        record = dict(fields, key=key, state=state, at=round(time.time(), 3))
+        self.entries.setdefault(key, {}).update(record)
+        if self._file is not None:
+            self._file.write(dumpb(record) + b'\n')
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PayoutEngine:
+    """
+    Pays Payouts with separate limits on concurrent invoice fetches
+    (lightning address servers) and payments (the LNbits wallet).
+
+    Failed attempts are retried with exponential backoff. Whether a payment
+    that got no clear answer went out is asked of LNbits by payment hash,
+    and the payout ends as 'unknown' when LNbits cannot say within
+    settle_timeout; the next run over the same journal settles it.
+    """
+    def __init__(self, client: LNAddress, journal: Journal, fetch_concurrency: int = FETCH_CONCURRENCY,
+                 pay_concurrency: int = PAY_CONCURRENCY, retries: int = RETRIES, backoff: float = BACKOFF,
+                 settle_timeout: float = SETTLE_TIMEOUT, expiry_margin: float = EXPIRY_MARGIN):
+        self.client = client
+        self.journal = journal
+        self.retries = retries
+        self.backoff = backoff
+        self.settle_timeout = settle_timeout
+        self.expiry_margin = expiry_margin
+        self._fetch_limit = asyncio.Semaphore(fetch_concurrency)
+        self._pay_limit = asyncio.Semaphore(pay_concurrency)
+
+
+    async def run(self, payouts: list) -> dict:
+        """
+        pay every payout, returns counts per final state and the rate
+        """
+        start = time.monotonic()
+        states = await asyncio.gather(*[self.pay(payout) for payout in payouts])
+        seconds = time.monotonic() - start
+        summary = {state: states.count(state) for state in (PAID, FAILED, UNKNOWN)}
+        summary['seconds'] = round(seconds, 3)
+        summary['payouts_per_second'] = round(summary[PAID] / seconds, 2) if seconds > 0 else None
+        return summary
+
+
+    async def pay(self, payout: Payout) -> str:
+        """
+        pay one payout, returns its final state: paid, failed or unknown
+        """
+        entry = self.journal.get(payout.key)
+        if entry.get('state') == PAID:
+            return PAID
+        if entry.get('state') in (PAYING, UNKNOWN):
+            # an earlier run may have sent it, only LNbits can tell
+            state = await self._settle(payout, entry['payment_hash'])
+            if state is not None:
+                return state
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(min(self.backoff * 2 ** (attempt - 1), MAX_BACKOFF))
+            try:
+                return await self._attempt(payout)
+            except LNURLError as e:
+                # the lightning address server refused or sent an unusable invoice
+                error = str(e)
+                break
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                logging.error("payout " + payout.key + " attempt " + str(attempt + 1) + ": " + error)
+        self.journal.record(payout.key, FAILED, error=error)
+        return FAILED
+
+
+    def _usable(self, entry: dict) -> bool:
+        return entry.get('bolt11') is not None and entry['expires_at'] - self.expiry_margin > time.time()
+
+
+    async def _attempt(self, payout: Payout) -> str:
+        entry = self.journal.get(payout.key)
+        if not self._usable(entry):
+            async with self._fetch_limit:
+                invoice = await self.client.fetch_invoice(payout.address, payout.amount)
+            self.journal.record(payout.key, INVOICE, address=payout.address, amount=payout.amount,
+                                bolt11=invoice.pr, payment_hash=invoice.payment_hash,
+                                expires_at=invoice.expires_at)
+            entry = self.journal.get(payout.key)
+
+        async with self._pay_limit:
+            if not self._usable(entry):
+                raise PayoutError('invoice expired while waiting to be paid')
+            self.journal.record(payout.key, PAYING, sync=True)
+            result = await self.client.pay_invoice(entry['bolt11'])
+
+        if isinstance(result, dict) and result.get('payment_hash'):
+            self.journal.record(payout.key, PAID, checking_id=result.get('checking_id'))
+            return PAID
+        # refused, or the answer was lost: the payment may still have gone out
+        state = await self._settle(payout, entry['payment_hash'])
+        if state is not None:
+            return state
+        detail = result.get('detail') if isinstance(result, dict) else None
+        raise PayoutError('payment failed: ' + str(detail or result))
+
+
+    async def _settle(self, payout: Payout, payment_hash: str) -> str:
+        """
+        paid or unknown (both journaled), or None when LNbits has no
+        payment for the hash or it failed, so it is safe to send again
+        """
+        deadline = time.monotonic() + self.settle_timeout
+        delay = self.backoff
+        while True:
+            try:
+                payment = await self.client.payment(payment_hash)
+                if payment is None:
+                    return None
+                if payment.get('paid'):
+                    self.journal.record(payout.key, PAID)
+                    return PAID
+                if (payment.get('details') or {}).get('status') == 'failed':
+                    return None
+            except Exception as e:
+                logging.error("payout " + payout.key + " status check: " + str(e))
+            if time.monotonic() + delay > deadline:
+                self.journal.record(payout.key, UNKNOWN)
+                return UNKNOWN
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+
+def read_payouts(path: str) -> list:
+    with open(path, newline='') as f:
+        return make_payouts(row for row in csv.reader(f) if row and not row[0].startswith('#'))
+
+
+async def main(args) -> dict:
+    from utils import create_session
+
+    config = { 'invoice_key': os.getenv('INVOICE_KEY'),
+               'admin_key': os.getenv('ADMIN_KEY'),
+               'base_url': os.getenv('BASE_URL') }
+    journal = Journal(args.journal)
+    try:
+        async with create_session() as session:
+            engine = PayoutEngine(LNAddress(config, session), journal, args.fetch_concurrency,
+                                  args.pay_concurrency, args.retries)
+            return await engine.run(read_payouts(args.payouts))
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('payouts', help='csv of address,amount[,key]')
+    parser.add_argument('--journal', default='payouts.journal', help='progress file, reused to resume')
+    parser.add_argument('--fetch-concurrency', type=int, default=FETCH_CONCURRENCY)
+    parser.add_argument('--pay-concurrency', type=int, default=PAY_CONCURRENCY)
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    summary = asyncio.run(main(parser.parse_args()))
+    print(dumps(summary))
+    sys.exit(0 if summary[FAILED] == 0 and summary[UNKNOWN] == 0 else 1)
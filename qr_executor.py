@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import os
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+ executor for CPU-bound QR encoding and image serialisation
+"""
+
+
+class RenderExecutor:
+    """
+    Runs blocking calls in a thread or process pool so the event loop
+    keeps serving I/O while images are generated.
+
+    At most `max_queue` calls are queued or running at once; past that
+    the call runs inline on the loop (using `fallback` when given) rather
+    than waiting behind the queue. kind='inline' disables the pool.
+    """
+    def __init__(self, kind: str = 'thread', workers: int = None, max_queue: int = 64):
+        self.kind = kind
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.max_queue = max_queue
+        self._executor = None
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.fallbacks = 0
+
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                # multiprocessing is only imported when a process pool is used
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='qr-render')
+        return self._executor
+
+
+    async def run(self, fn, *args, fallback=None, **kwargs):
+        if self.kind == 'inline':
+            return fn(*args, **kwargs)
+        if self.pending >= self.max_queue:
+            self.fallbacks += 1
+            return (fallback or fn)(*args, **kwargs)
+        self.pending += 1
+        self.submitted += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), partial(fn, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            logging.info("shutting down %s render executor", self.kind)
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+    def stats(self) -> dict:
+        return {'kind': self.kind, 'workers': self.workers,
+                'queue_depth': self.pending, 'max_queue_depth': self.max_pending,
+                'max_queue': self.max_queue, 'submitted': self.submitted,
+                'fallbacks': self.fallbacks}
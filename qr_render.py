@@ -0,0 +1,187 @@
+import importlib
+import os
+import re
+import struct
+import zlib
+from html import escape
+from io import BytesIO
+
+"""
+ QR code encoding and rendering engines, selected with the
+ QR_ENCODER ('segno' or 'pyqrcode') and QR_RENDERER env variables.
+
+ the encoder libraries are imported on first use, keeping them
+ out of serverless cold starts for requests that never draw a QR code
+"""
+
+QUIET_ZONE = 4
+RUN = re.compile('1+')
+BITS = bytes.maketrans(b'\x00\x01', b'01')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_modules = {}
+
+
+def optional_module(name: str):
+    """
+    import a module on first use, None when it is not installed
+    (segno is optional and encodes several times faster than pyqrcode)
+    """
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
+
+
+class QRMatrix:
+    """
+    Encoded QR code, the module matrix is converted once and shared by renderers
+    """
+    __slots__ = ('code', 'version', '_rows')
+
+    def __init__(self, code, version):
+        self.code = code
+        self.version = version
+        self._rows = None
+
+    @property
+    def size(self) -> int:
+        return len(self.code)
+
+    @property
+    def rows(self) -> tuple:
+        """
+        module rows as '0'/'1' strings, without quiet zone
+        """
+        if self._rows is None:
+            self._rows = tuple(bytes(row).translate(BITS).decode('ascii') for row in self.code)
+        return self._rows
+
+
+def encode(data: str, encoder: str = None) -> QRMatrix:
+    """
+    encode data at error level H, same as pyqrcode.create
+    """
+    encoder = encoder or os.getenv('QR_ENCODER', 'segno')
+    segno = optional_module('segno') if encoder == 'segno' else None
+    if segno is not None:
+        qr = segno.make_qr(data, error='h', boost_error=False)
+        return QRMatrix(qr.matrix, qr.version)
+    qr = optional_module('pyqrcode').create(data)
+    return QRMatrix(qr.code, qr.version)
+
+
+class PyQRCodeRenderer:
+    """
+    Renders through pyqrcode / pypng
+    """
+    name = 'pyqrcode'
+
+    def svg(self, matrix: QRMatrix, scale=3, module_color='black', background='white',
+            xmldecl=True) -> bytes:
+        from pyqrcode import builder
+        stream = BytesIO()
+        builder._svg(matrix.code, matrix.version, stream, scale=scale, background=background,
+                     module_color=module_color, xmldecl=xmldecl, omithw=not xmldecl)
+        return stream.getvalue()
+
+    def png(self, matrix: QRMatrix, scale=3, module_color=(0, 0, 0, 255),
+            background=(255, 255, 255, 255)) -> bytes:
+        from pyqrcode import builder
+        stream = BytesIO()
+        builder._png(matrix.code, matrix.version, stream, scale=scale,
+                     module_color=list(module_color), background=list(background))
+        return stream.getvalue()
+
+
+class FastRenderer:
+    """
+    Renders straight from the module matrix.
+
+    SVG output is one path of merged horizontal runs in module units with
+    a viewBox and no fixed width/height, so `scale` only applies to PNG
+    output. PNG output is a 1-bit image
+    built a whole row at a time.
+    """
+    name = 'fast'
+
+    def svg(self, matrix: QRMatrix, scale=3, module_color='black', background='white',
+            xmldecl=True) -> bytes:
+        width = matrix.size + 2 * QUIET_ZONE
+        parts = []
+        if xmldecl:
+            parts.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+        parts.append('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 %d %d" '
+                     'shape-rendering="crispEdges">' % (width, width))
+        if background is not None:
+            parts.append('<path fill="%s" d="M0 0h%dv%dH0z"/>' % (escape(str(background)), width, width))
+        parts.append('<path stroke="%s" d="%s"/></svg>' % (escape(str(module_color)), self._path(matrix)))
+        return ''.join(parts).encode('utf-8')
+
+    def _path(self, matrix: QRMatrix) -> str:
+        commands = []
+        x = y = None
+        for row_index, row in enumerate(matrix.rows):
+            ry = row_index + QUIET_ZONE
+            for run in RUN.finditer(row):
+                start, end = run.span()
+                sx = start + QUIET_ZONE
+                if x is None:
+                    commands.append('M%d %d.5h%d' % (sx, ry, end - start))
+                else:
+                    commands.append('m%d %dh%d' % (sx - x, ry - y, end - start))
+                x = sx + end - start
+                y = ry
+        return ''.join(commands)
+
+    def png(self, matrix: QRMatrix, scale=3, module_color=(0, 0, 0, 255),
+            background=(255, 255, 255, 255)) -> bytes:
+        scale = int(scale)
+        width = (matrix.size + 2 * QUIET_ZONE) * scale
+        fg, bg = _rgba(module_color), _rgba(background)
+        # same rule as pyqrcode: black on opaque white is written as
+        # 1-bit greyscale, which drops any module alpha
+        greyscale = fg[:3] == (0, 0, 0) and bg == (255, 255, 255, 255)
+        on, off = ('0', '1') if greyscale else ('1', '0')
+
+        pad = off * (-width % 8)
+        widen = str.maketrans({'0': off * scale, '1': on * scale})
+        border = off * (QUIET_ZONE * scale)
+        blank = b'\x00' + int(off * (width + len(pad)), 2).to_bytes((width + len(pad)) // 8, 'big')
+        quiet = blank * (QUIET_ZONE * scale)
+
+        scanlines = [quiet]
+        for row in matrix.rows:
+            bits = border + row.translate(widen) + border + pad
+            line = b'\x00' + int(bits, 2).to_bytes(len(bits) // 8, 'big')
+            scanlines.append(line * scale)
+        scanlines.append(quiet)
+
+        if greyscale:
+            chunks = [_chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 1, 0, 0, 0, 0))]
+        else:
+            chunks = [_chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 1, 3, 0, 0, 0)),
+                      _chunk(b'PLTE', bytes(bg[:3] + fg[:3]))]
+            if bg[3] != 255 or fg[3] != 255:
+                chunks.append(_chunk(b'tRNS', bytes((bg[3], fg[3]))))
+        chunks.append(_chunk(b'IDAT', zlib.compress(b''.join(scanlines), 9)))
+        chunks.append(_chunk(b'IEND', b''))
+        return PNG_SIGNATURE + b''.join(chunks)
+
+
+def _rgba(color) -> tuple:
+    color = tuple(color)
+    return color if len(color) == 4 else color + (255,)
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+RENDERERS = {PyQRCodeRenderer.name: PyQRCodeRenderer, FastRenderer.name: FastRenderer}
+
+
+def get_renderer(name: str = None):
+    name = name or os.getenv('QR_RENDERER', FastRenderer.name)
+    return RENDERERS[name]()
@@ -0,0 +1,217 @@
+import asyncio
+import ipaddress
+import math
+import os
+import time
+
+from fastjson import dumpb
+from metrics import registry
+
+"""
+ admission control: token buckets per client IP and per target LNURL domain.
+
+ a request over its bucket may wait up to RATE_LIMIT_MAX_WAIT seconds for
+ a token; past that it is refused with Retry-After: 429 for a client over
+ its limit, 503 when the lightning address' domain is over its limit.
+ a rate of 0 turns that limit off.
+"""
+
+CLIENT_RATE = float(os.getenv('RATE_LIMIT_CLIENT_RATE', '2'))
+CLIENT_BURST = float(os.getenv('RATE_LIMIT_CLIENT_BURST', '20'))
+DOMAIN_RATE = float(os.getenv('RATE_LIMIT_DOMAIN_RATE', '20'))
+DOMAIN_BURST = float(os.getenv('RATE_LIMIT_DOMAIN_BURST', '40'))
+MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '1'))
+MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+# behind a proxy (e.g. Vercel) the client is the first X-Forwarded-For address
+TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED', '0').lower() in ('1', 'true', 'yes')
+EXEMPT = ('/static', '/metrics', '/favicon.ico')
+
+rate_limited = registry.counter('sendsats_rate_limited_total',
+                                'Requests refused by rate limits', ('limit', 'status'))
+rate_limit_wait = registry.histogram('sendsats_rate_limit_wait_seconds',
+                                     'Time admitted requests waited for rate limit tokens')
+
+
+class RateLimiter:
+    """
+    Token buckets of `burst` tokens refilled at `rate` per second, for any
+    number of keys in bounded memory.
+
+    A bucket is kept as one float, the time at which it is full again. A
+    full bucket is the same as none, so when `max_keys` is reached those
+    are dropped first, then the least recently used ones, which at worst
+    hands those keys a fresh burst.
+    """
+    def __init__(self, rate: float, burst: float, max_wait: float = MAX_WAIT, max_keys: int = MAX_KEYS,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_keys = max_keys
+        self._interval = 1 / rate
+        self._capacity = burst / rate
+        self._clock = clock
+        self._full_at = {}
+        self.allowed = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+
+    def take(self, key) -> tuple:
+        """
+        take a token for key: (True, seconds to wait for it) when admitted,
+        (False, seconds until one is free) when that wait exceeds max_wait
+        """
+        now = self._clock()
+        full_at = self._full_at.pop(key, now)
+        after = max(full_at, now) + self._interval
+        # rounded so a bucket with exactly one token left does not count as a wait
+        wait = round(after - now - self._capacity, 6)
+        if wait > self.max_wait:
+            if full_at > now:
+                self._full_at[key] = full_at
+            self.rejected += 1
+            return False, wait
+        self._full_at[key] = after
+        if len(self._full_at) > self.max_keys:
+            self._evict(now)
+        if wait > 0:
+            self.delayed += 1
+            return True, wait
+        self.allowed += 1
+        return True, 0
+
+
+    def _evict(self, now: float):
+        # down to 90% so the sweep runs once per max_keys / 10 new keys
+        target = int(self.max_keys * 0.9)
+        full = [key for key, full_at in self._full_at.items() if full_at <= now]
+        for key in full:
+            del self._full_at[key]
+        # oldest first: dicts keep insertion order and take() reinserts
+        for key in list(self._full_at):
+            if len(self._full_at) <= target:
+                break
+            del self._full_at[key]
+            self.evicted += 1
+
+
+    def __len__(self):
+        return len(self._full_at)
+
+
+    def stats(self) -> dict:
+        return {'keys': len(self._full_at), 'allowed': self.allowed, 'delayed': self.delayed,
+                'rejected': self.rejected, 'evicted': self.evicted}
+
+
+def make_limiter(rate: float, burst: float):
+    return RateLimiter(rate, burst) if rate > 0 else None
+
+
+def client_key(scope, trust_forwarded: bool = TRUST_FORWARDED) -> str:
+    """
+    client address; IPv6 clients are grouped by /64, the smallest
+    block a single host is usually given
+    """
+    ip = None
+    if trust_forwarded:
+        for name, value in scope['headers']:
+            if name == b'x-forwarded-for':
+                ip = value.decode('latin-1').split(',')[0].strip()
+                break
+    if not ip:
+        ip = (scope.get('client') or ('unknown',))[0]
+    if ':' in ip:
+        try:
+            return str(ipaddress.IPv6Network(ip + '/64', strict=False).network_address) + '/64'
+        except ValueError:
+            pass
+    return ip
+
+
+CLIENT_MESSAGE = 'Too many requests'
+DOMAIN_MESSAGE = 'Too many requests for this lightning address domain'
+
+
+def address_domain(address: str) -> str:
+    return address.rpartition('@')[2].lower() or None
+
+
+def target_domain(path: str) -> str:
+    """
+    domain of the lightning address in a (decoded) request path, None without one
+    """
+    for segment in path.split('/'):
+        if '@' in segment:
+            return address_domain(segment)
+    return None
+
+
+def retry_after(seconds: float) -> int:
+    return max(1, math.ceil(seconds))
+
+
+async def admit(limiter: RateLimiter, key, limit: str, status: int) -> float:
+    """
+    take a token from inside a handler, for lightning addresses that are
+    not in the path (form posts, batches): waits as the middleware would,
+    returns 0 when admitted or the seconds until a token is free
+    """
+    if limiter is None or key is None:
+        return 0
+    admitted, seconds = limiter.take(key)
+    if not admitted:
+        rate_limited.inc(limit, str(status))
+        return seconds
+    if seconds > 0:
+        rate_limit_wait.observe(seconds)
+        await asyncio.sleep(seconds)
+    return 0
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware applying the client and domain limits before a request
+    reaches its handler; exempt paths (static files, metrics) are not limited
+    """
+    def __init__(self, app, clients: RateLimiter = None, domains: RateLimiter = None,
+                 exempt: tuple = EXEMPT, trust_forwarded: bool = TRUST_FORWARDED):
+        self.app = app
+        self.clients = clients
+        self.domains = domains
+        self.exempt = exempt
+        self.trust_forwarded = trust_forwarded
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(self.exempt):
+            return await self.app(scope, receive, send)
+        wait = 0
+        if self.clients is not None:
+            admitted, wait = self.clients.take(client_key(scope, self.trust_forwarded))
+            if not admitted:
+                return await self.refuse(send, 'client', 429, wait)
+        domain = target_domain(scope['path']) if self.domains is not None else None
+        if domain is not None:
+            admitted, seconds = self.domains.take(domain)
+            if not admitted:
+                return await self.refuse(send, 'domain', 503, seconds)
+            wait = max(wait, seconds)
+        if wait > 0:
+            rate_limit_wait.observe(wait)
+            await asyncio.sleep(wait)
+        await self.app(scope, receive, send)
+
+
+    async def refuse(self, send, limit: str, status: int, seconds: float):
+        rate_limited.inc(limit, str(status))
+        seconds = retry_after(seconds)
+        msg = CLIENT_MESSAGE if status == 429 else DOMAIN_MESSAGE
+        body = dumpb({'msg': msg, 'retry_after': seconds})
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode()),
+                                (b'retry-after', str(seconds).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,202 @@
+import argparse
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+"""
+ production server for self-hosting: binds the listening socket once,
+ imports the app and forks a worker per core, all accepting on that
+ socket. uvloop and httptools are used when they are installed.
+
+ SIGTERM or SIGINT drains: workers stop accepting, give open requests up
+ to DRAIN_TIMEOUT seconds, wait for upstream calls still in flight and
+ close their pooled sessions. a worker that dies is replaced.
+
+ usage: python serve.py [--host 0.0.0.0] [--port 8000] [--workers N]
+ python app.py stays the development server, with reload.
+"""
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8000'))
+# 0 is one worker per core available to this process
+WORKERS = int(os.getenv('WEB_CONCURRENCY', '0'))
+BACKLOG = int(os.getenv('BACKLOG', '2048'))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '10'))
+# open connections per worker before new ones get a 503, 0 is unlimited
+LIMIT_CONCURRENCY = int(os.getenv('LIMIT_CONCURRENCY', '0'))
+ACCESS_LOG = os.getenv('ACCESS_LOG', '0').lower() in ('1', 'true', 'yes')
+# uvicorn's exit code when the app fails to start, not worth restarting
+STARTUP_FAILURE = 3
+
+
+def available(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def event_loop() -> str:
+    return 'uvloop' if available('uvloop') else 'asyncio'
+
+
+def http_protocol() -> str:
+    return 'httptools' if available('httptools') else 'h11'
+
+
+def worker_count(workers: int = WORKERS) -> int:
+    if workers > 0:
+        return workers
+    try:
+        # honours taskset and container cpu sets, unlike cpu_count()
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def bind_socket(host: str, port: int, backlog: int = BACKLOG) -> socket.socket:
+    """
+    listening socket inherited by every forked worker, the kernel hands
+    each new connection to one of the workers blocked in accept()
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """
+    Pre-fork process manager: starts `workers` children that each run a
+    uvicorn server on the shared socket, replaces any that die, and on
+    SIGTERM/SIGINT forwards SIGTERM and waits for them to drain.
+
+    Workers that are still running after `kill_after` seconds get SIGKILL.
+    """
+    def __init__(self, sock: socket.socket, app, workers: int, drain_timeout: float = DRAIN_TIMEOUT,
+                 **config):
+        self.sock = sock
+        self.app = app
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        # requests are drained first, then the lifespan drains upstream calls
+        self.kill_after = 2 * drain_timeout + 5
+        self.config = config
+        self.children = {}
+        self.stopping = None
+        self.failed = False
+
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        # the worker: uvicorn installs its own handlers once it is serving
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        code = 1
+        try:
+            code = self.run_worker()
+        except KeyboardInterrupt:
+            code = 0
+        except BaseException:
+            logging.exception("worker " + str(os.getpid()) + " crashed")
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+
+    def run_worker(self) -> int:
+        config = uvicorn.Config(self.app, lifespan='on',
+                                timeout_graceful_shutdown=math.ceil(self.drain_timeout), **self.config)
+        server = uvicorn.Server(config)
+        server.run(sockets=[self.sock])
+        return 0 if server.started else STARTUP_FAILURE
+
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        if self.stopping is None:
+            logging.info("draining " + str(len(self.children)) + " workers")
+            self.stopping = time.monotonic()
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                if self.stopping is not None and time.monotonic() - self.stopping > self.kill_after:
+                    logging.error("workers did not drain in time, killing " + str(list(self.children)))
+                    for pid in self.children:
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    self.stopping = float('inf')
+                time.sleep(0.1)
+                continue
+            started = self.children.pop(pid)
+            if self.stopping is not None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code == STARTUP_FAILURE:
+                logging.error("worker " + str(pid) + " failed to start, stopping")
+                self.failed = True
+                self.stop()
+                continue
+            logging.error("worker " + str(pid) + " exited with " + str(code) + ", restarting")
+            if time.monotonic() - started < 1:
+                # do not spin on a worker that dies straight away
+                time.sleep(1)
+            self.spawn()
+        return 1 if self.failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='sendsats production server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='0 is one per core')
+    parser.add_argument('--loop', default=None, choices=('uvloop', 'asyncio'))
+    parser.add_argument('--http', default=None, choices=('httptools', 'h11'))
+    parser.add_argument('--backlog', type=int, default=BACKLOG)
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT)
+    parser.add_argument('--limit-concurrency', type=int, default=LIMIT_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    sock = bind_socket(args.host, args.port, args.backlog)
+    # imported, and templates compiled, once before forking, so workers
+    # share those pages until written
+    from app import app, precompile_templates
+    precompile_templates()
+    workers = worker_count(args.workers)
+    loop, http = args.loop or event_loop(), args.http or http_protocol()
+    logging.info("serving on %s:%d with %d workers, %s and %s" % (args.host, sock.getsockname()[1],
+                                                                 workers, loop, http))
+    supervisor = Supervisor(sock, app, workers, args.drain_timeout, loop=loop, http=http,
+                            backlog=args.backlog, limit_concurrency=args.limit_concurrency or None,
+                            access_log=ACCESS_LOG)
+    return supervisor.run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
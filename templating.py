@@ -0,0 +1,159 @@
+import asyncio
+import inspect
+import os
+import sys
+import tempfile
+
+import jinja2
+from markupsafe import Markup
+
+"""
+ Jinja environments with a persistent bytecode cache, and streamed rendering.
+
+ compiled templates are kept in TEMPLATE_CACHE_DIR so a new process loads
+ bytecode instead of parsing the sources. the cache is committed, so a
+ serverless deploy ships it; after editing a template, refresh it with the
+ python version the deploy runs:
+
+     python templating.py [templates_dir]
+
+ bytecode only loads in the python version that wrote it, so each version
+ has its own files. when the cache directory is read-only (e.g. a
+ serverless bundle) it is still read, and templates missing from it are
+ cached in the system temp directory, which survives warm restarts only.
+"""
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', os.path.join(BASE_DIR, '.template_cache'))
+PYTHON_TAG = 'py%d%d' % sys.version_info[:2]
+
+
+def cache_directory(directory: str = None) -> str:
+    """
+    first writable directory of TEMPLATE_CACHE_DIR and the temp dir
+    """
+    for candidate in (directory or TEMPLATE_CACHE_DIR,
+                      os.path.join(tempfile.gettempdir(), 'sendsats-templates')):
+        try:
+            os.makedirs(candidate, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(candidate, os.W_OK):
+            return candidate
+    return None
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    FileSystemBytecodeCache keyed by template name alone, as the absolute
+    path differs between the checkout that built the cache and the deploy.
+    `bundled` is a read-only cache looked at before `directory`.
+    """
+    def __init__(self, directory: str, pattern: str, bundled: str = None):
+        super().__init__(directory, pattern)
+        self.bundled = bundled
+
+
+    def get_cache_key(self, name: str, filename: str = None) -> str:
+        return super().get_cache_key(name)
+
+
+    def load_bytecode(self, bucket: jinja2.bccache.Bucket):
+        if self.bundled is not None:
+            try:
+                with open(os.path.join(self.bundled, self.pattern % bucket.key), 'rb') as f:
+                    bucket.load_bytecode(f)
+            except OSError:
+                pass
+            if bucket.code is not None:
+                return
+        super().load_bytecode(bucket)
+
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            # nowhere writable: compiled again by the next process
+            pass
+
+
+async def safe(value):
+    """
+    `safe` filter for the streaming environment: awaits a deferred value
+    (e.g. a QR task) at the point the template prints it
+    """
+    if inspect.isawaitable(value):
+        value = await value
+    return Markup(value)
+
+
+def create_environment(directory: str, enable_async: bool = False, cache_dir: str = None) -> jinja2.Environment:
+    """
+    environment matching Jinja2Templates' defaults, plus the bytecode cache;
+    async environments compile to different code so they get their own files
+    """
+    bundled = cache_dir or TEMPLATE_CACHE_DIR
+    cache_dir = cache_directory(cache_dir)
+    if not os.path.isdir(bundled) or bundled == cache_dir:
+        bundled = None
+    bytecode_cache = None
+    if cache_dir is not None or bundled is not None:
+        pattern = '__jinja2_' + ('async_' if enable_async else '') + PYTHON_TAG + '_%s.cache'
+        bytecode_cache = TemplateBytecodeCache(cache_dir or bundled, pattern, bundled if cache_dir else None)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(directory), autoescape=True,
+                             bytecode_cache=bytecode_cache, enable_async=enable_async)
+    if enable_async:
+        env.filters['safe'] = safe
+    return env
+
+
+def precompile(env: jinja2.Environment) -> list:
+    """
+    compile every template now (writing the bytecode cache), returns the names
+    """
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+async def stream_template(template: jinja2.Template, context: dict):
+    """
+    yield rendered chunks, joining whatever is ready so the page goes out
+    in a few writes: everything up to a deferred value, then the rest
+    """
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for chunk in template.generate_async(**context):
+                queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        finished = False
+        while not finished:
+            chunks = [await queue.get()]
+            while not queue.empty():
+                chunks.append(queue.get_nowait())
+            if chunks[-1] is None:
+                finished = True
+                chunks.pop()
+            if chunks:
+                yield ''.join(chunks)
+        # re-raise a rendering error
+        await producer
+    finally:
+        producer.cancel()
+
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BASE_DIR, 'templates')
+    for enable_async in (False, True):
+        env = create_environment(directory, enable_async=enable_async)
+        names = precompile(env)
+        print("compiled %d templates (%s) into %s" % (len(names), 'async' if enable_async else 'sync',
+                                                     env.bytecode_cache.directory))
@@ -0,0 +1,306 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+import app
+import utils
+from cache import ByteCache
+from conftest import BOLT11, FakeLNAddress, expiring_invoice
+from qr_render import FastRenderer
+from ratelimit import RateLimiter
+
+
+class CountingRenderer(FastRenderer):
+    def __init__(self):
+        self.calls = []
+
+    def svg(self, *args, **kwargs):
+        self.calls.append('svg')
+        return super().svg(*args, **kwargs)
+
+    def png(self, *args, **kwargs):
+        self.calls.append('png')
+        return super().png(*args, **kwargs)
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    renderer = CountingRenderer()
+    monkeypatch.setattr(app, 'get_client', lambda: FakeLNAddress(None))
+    monkeypatch.setattr(app, 'renderer', renderer)
+    monkeypatch.setattr(app, 'get_session', lambda: None)
+    monkeypatch.setattr(app, 'image_cache', ByteCache())
+    return renderer
+
+
+def make_request(path, method='GET', headers=()):
+    return Request({'type': 'http', 'method': method, 'path': path,
+                    'headers': [(k.lower().encode(), v.encode()) for k, v in headers],
+                    'query_string': b'', 'app': app.app})
+
+
+def test_full_page_renders_svg_only(renderer):
+    response = asyncio.run(app.forward_to_QR_Endpoint('alice@example.com', make_request('/alice@example.com'),
+                                                      amount=None, memo=None))
+    assert renderer.calls == ['svg']
+    assert b'<svg' in response.body
+
+
+def test_clean_page_renders_png_only(renderer):
+    response = asyncio.run(app.forward_to_QR_Endpoint('alice@example.com', make_request('/alice@example.com'),
+                                                      amount=100, memo=None))
+    assert renderer.calls == ['png']
+    assert b'data:image/png;base64,' in response.body
+    assert b'<svg xmlns' not in response.body
+
+
+def test_tip_page_renders_png_only(renderer):
+    response = asyncio.run(app.get_Tip_QR_Code('alice@example.com', '100', make_request('/tip')))
+    assert renderer.calls == ['png']
+    assert b'data:image/png;base64,' in response.body
+
+
+def test_post_page_renders_svg_only(renderer):
+    response = asyncio.run(app.post_to_QR_Endpoint('alice@example.com', make_request('/', 'POST'), amount=100))
+    assert renderer.calls == ['svg']
+    assert b'<svg' in response.body
+
+
+def test_qr_image_etag_and_304(renderer):
+    response = asyncio.run(app.get_QR_Code_From_LN_Address('alice@example.com', make_request('/qr')))
+    assert response.status_code == 200
+    assert response.media_type == 'image/png'
+    assert response.body.startswith(b'\x89PNG')
+    max_age = int(response.headers['cache-control'].split('max-age=')[1])
+    assert 0 < max_age <= 600
+    etag = response.headers['etag']
+
+    request = make_request('/qr', headers=[('If-None-Match', etag)])
+    cached = asyncio.run(app.get_QR_Code_From_LN_Address('alice@example.com', request))
+    assert cached.status_code == 304
+    assert cached.body == b''
+    assert cached.headers['etag'] == etag
+
+
+def test_svg_image_response(renderer):
+    response = asyncio.run(app.get_svg_LN_address_amt('alice@example.com', '100', make_request('/svg'),
+                                                      st='red', bg=None))
+    assert response.status_code == 200
+    assert response.media_type == 'image/svg+xml'
+    assert b'stroke="red"' in response.body
+
+    request = make_request('/svg', headers=[('If-None-Match', 'W/"other", ' + response.headers['etag'])])
+    cached = asyncio.run(app.get_svg_LN_address_amt('alice@example.com', '100', request, st='red', bg=None))
+    assert cached.status_code == 304
+
+
+def test_expired_invoice_is_not_cached(renderer, monkeypatch):
+    async def get_bolt(email, amount):
+        return expiring_invoice(expiry=0)
+
+    monkeypatch.setattr(app, 'get_bolt', get_bolt)
+    response = asyncio.run(app.get_QR_Code_From_LN_Address('alice@example.com', make_request('/qr')))
+    assert 'no-store' in response.headers['cache-control']
+
+
+def test_rendered_images_are_cached(renderer):
+    for _ in range(3):
+        asyncio.run(app.get_QR_Code_From_LN_Address('alice@example.com', make_request('/qr')))
+    asyncio.run(app.get_svg_LN_address_amt('alice@example.com', '100', make_request('/svg'), st=None, bg=None))
+    assert renderer.calls == ['png', 'svg']
+    stats = app.image_cache.stats()
+    assert stats['hits'] == 2
+    assert stats['entries'] == 2
+    assert stats['resident_bytes'] > 0
+
+
+def test_batch_streams_ndjson_in_completion_order(monkeypatch):
+    active = {'total': 0, 'max_total': 0, 'slow.com': 0, 'max_slow.com': 0}
+
+    async def get_bolt(email, amount):
+        domain = email.split('@')[1]
+        active['total'] += 1
+        active['max_total'] = max(active['max_total'], active['total'])
+        if domain == 'slow.com':
+            active['slow.com'] += 1
+            active['max_slow.com'] = max(active['max_slow.com'], active['slow.com'])
+            await asyncio.sleep(0.05)
+            active['slow.com'] -= 1
+        active['total'] -= 1
+        if domain == 'bad.com':
+            return {'status': 'error', 'msg': 'Cannot make a Bolt11'}
+        return BOLT11
+
+    monkeypatch.setattr(app, 'get_bolt', get_bolt)
+    monkeypatch.setattr(app, 'client_limiter', None)
+    monkeypatch.setitem(app.batch_config, 'concurrency', 4)
+    monkeypatch.setitem(app.batch_config, 'per_domain', 2)
+    items = [app.BatchItem(address='u%d@slow.com' % i, amount=100) for i in range(6)]
+    items += [app.BatchItem(address='fast@fast.com', amount=100),
+              app.BatchItem(address='x@bad.com', amount=100),
+              app.BatchItem(address='nope', amount=100)]
+
+    async def run():
+        response = await app.post_bolt11_batch(make_request('/bolt11/batch', 'POST'), items)
+        assert response.media_type == 'application/x-ndjson'
+        return [json.loads(line) async for line in response.body_iterator]
+
+    lines = asyncio.run(run())
+    assert len(lines) == len(items)
+    assert sorted(line['index'] for line in lines) == list(range(len(items)))
+    # fast items are not held behind the slow domain
+    assert {line['index'] for line in lines[:3]} == {6, 7, 8}
+    assert all('bolt11' in line for line in lines if line['address'].endswith('.com')
+               and 'bad' not in line['address'])
+    errors = {line['address']: line['error'] for line in lines if 'error' in line}
+    assert set(errors) == {'x@bad.com', 'nope'}
+    assert errors['x@bad.com'] == 'Cannot make a Bolt11'
+    assert active['max_slow.com'] == 2
+    assert active['max_total'] <= 4
+
+
+def test_batch_and_form_posts_take_domain_tokens(renderer, monkeypatch):
+    async def get_bolt(email, amount):
+        return BOLT11
+
+    monkeypatch.setattr(app, 'get_bolt', get_bolt)
+    monkeypatch.setattr(app, 'client_limiter', None)
+    monkeypatch.setattr(app, 'domain_limiter', RateLimiter(1, 3, max_wait=0))
+    items = [app.BatchItem(address='u%d@busy.com' % i, amount=100) for i in range(5)]
+    items.append(app.BatchItem(address='a@quiet.com', amount=100))
+
+    async def run():
+        response = await app.post_bolt11_batch(make_request('/bolt11/batch', 'POST'), items)
+        return [json.loads(line) async for line in response.body_iterator]
+
+    lines = asyncio.run(run())
+    busy = [line for line in lines if line['address'].endswith('busy.com')]
+    assert sum('bolt11' in line for line in busy) == 3
+    assert all(line['retry_after'] >= 1 for line in busy if 'error' in line)
+    assert 'bolt11' in [line for line in lines if line['address'] == 'a@quiet.com'][0]
+
+    response = asyncio.run(app.index_post(make_request('/', 'POST'), amount=100, lnaddress='x@Busy.com'))
+    assert response.status_code == 503 and int(response.headers['retry-after']) >= 1
+
+
+def test_batch_items_take_client_tokens(monkeypatch):
+    async def get_bolt(email, amount):
+        return BOLT11
+
+    monkeypatch.setattr(app, 'get_bolt', get_bolt)
+    monkeypatch.setattr(app, 'client_limiter', RateLimiter(1, 3, max_wait=0))
+    monkeypatch.setattr(app, 'domain_limiter', None)
+    # one request, but a lookup on a different domain per item
+    items = [app.BatchItem(address='u@d%d.com' % i, amount=100) for i in range(5)]
+
+    async def run():
+        response = await app.post_bolt11_batch(make_request('/bolt11/batch', 'POST'), items)
+        return [json.loads(line) async for line in response.body_iterator]
+
+    lines = asyncio.run(run())
+    assert sum('bolt11' in line for line in lines) == 3
+    refused = [line for line in lines if 'error' in line]
+    assert all(line['error'] == 'Too many requests' and line['retry_after'] >= 1 for line in refused)
+
+
+def test_shutdown_stops_background_calls_before_draining(monkeypatch):
+    calls = []
+
+    class Closing:
+        def __init__(self, name):
+            self.name = name
+
+        async def close(self):
+            calls.append(self.name)
+
+        def shutdown(self):
+            calls.append(self.name)
+
+    async def drain(timeout):
+        calls.append('drain')
+        return 0
+
+    monkeypatch.setattr(app, 'invoice_pool', Closing('invoice_pool'))
+    monkeypatch.setattr(app, 'payment_watcher', Closing('payment_watcher'))
+    monkeypatch.setattr(app, 'qr_executor', Closing('qr_executor'))
+    monkeypatch.setattr(app, 'get_store', lambda: None)
+    monkeypatch.setattr(app.ln_address, 'drain', drain)
+
+    async def run():
+        async with app.lifespan(app.app):
+            pass
+
+    asyncio.run(run())
+    assert calls == ['invoice_pool', 'payment_watcher', 'drain', 'qr_executor']
+
+
+def test_batch_rejects_oversized(monkeypatch):
+    monkeypatch.setitem(app.batch_config, 'max_items', 2)
+    items = [app.BatchItem(address='a@b.com', amount=1)] * 3
+    response = asyncio.run(app.post_bolt11_batch(make_request('/bolt11/batch', 'POST'), items))
+    assert 'Too many items' in response[0]['msg']
+
+
+def test_metrics_exposes_phases_and_stats(renderer):
+    asyncio.run(app.forward_to_QR_Endpoint('alice@example.com', make_request('/alice@example.com'),
+                                           amount=None, memo=None))
+    body = asyncio.run(app.get_metrics()).body.decode()
+    for phase in ('qr_encode', 'qr_render', 'template'):
+        assert 'sendsats_phase_seconds_count{phase="%s"}' % phase in body
+    assert 'sendsats_image_cache_misses ' in body
+    assert 'sendsats_cache_hits{cache="metadata"}' in body
+
+
+def test_open_circuit_series_are_capped(monkeypatch):
+    monkeypatch.setattr(utils, 'breakers', utils.tracked())
+    monkeypatch.setattr(app, 'MAX_CIRCUIT_SAMPLES', 3)
+    for i in range(20):
+        breaker = utils.get_breaker('host%d.example:1' % i)
+        for _ in range(utils.BREAKER_THRESHOLD):
+            breaker.failure()
+    body = asyncio.run(app.get_metrics()).body.decode()
+    assert body.count('sendsats_circuit_open{') == 3
+    assert 'sendsats_circuit_open{domain="host19.example:1"} 1' in body
+    assert 'sendsats_circuits_not_closed 20' in body
+
+
+def test_streamed_page_defers_svg(renderer, monkeypatch):
+    monkeypatch.setattr(app, 'template_streaming', True)
+
+    async def run():
+        response = await app.forward_to_QR_Endpoint('alice@example.com', make_request('/alice@example.com'),
+                                                    amount=None, memo=None)
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(run())
+    assert len(chunks) > 1
+    assert '<svg' not in chunks[0] and 'alice@example.com' in chunks[0]
+    assert '<svg' in ''.join(chunks)
+    assert renderer.calls == ['svg']
+
+
+def test_status_events_stream(monkeypatch):
+    from payment_watcher import PaymentWatcher
+    calls = []
+
+    async def check(payment_hash):
+        calls.append(payment_hash)
+        return {'paid': len(calls) > 1}
+
+    async def run():
+        monkeypatch.setattr(app, 'payment_watcher', PaymentWatcher(check, interval=0.01, backoff=1))
+        invalid = await app.get_payment_status('nothex', bolt11=None)
+        response = await app.get_payment_status('AB' * 32, bolt11=BOLT11)
+        return invalid, response.media_type, [chunk async for chunk in response.body_iterator]
+
+    invalid, media_type, chunks = asyncio.run(run())
+    assert invalid[0]['msg'] == 'Please send a valid payment hash'
+    assert media_type == 'text/event-stream'
+    assert chunks[0] == 'retry: 5000\n\n'
+    assert chunks[1].startswith('event: pending\ndata: ')
+    event, data = chunks[2].rstrip('\n').split('\n')
+    assert event == 'event: paid'
+    assert json.loads(data[len('data: '):]) == {'payment_hash': 'ab' * 32, 'status': 'paid', 'paid': True}
+    assert calls == ['ab' * 32] * 2
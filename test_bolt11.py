@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.client import ClientSession
+
+from bolt11 import Bolt11Error, decode, expiry_time, is_invoice
+from cache import TTLCache
+from conftest import CONFIG, TIMESTAMP, local_client, make_invoice, stub_server
+from ln_address import LNAddress
+
+PAYMENT_HASH = '0001020304050607080900010203040506070809000102030405060708090102'
+PAYMENT_SECRET = '11' * 32
+
+# BOLT11 specification examples
+VECTORS = [
+    ('lnbc1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqq'
+     'syqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq9qrsgq357wnc5r2ueh7ck6q93'
+     'dj32dlqnls087fxdwk8qakdyafkq3yap9us6v52vjjsrvywa6rt52cm9r9zqt8r2t7mlcwspyetp5h2tztugp9lfyql',
+     {'amount_msat': None, 'description': 'Please consider supporting this project', 'expiry': 3600}),
+    ('lnbc2500u1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqf'
+     'qqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpu9qrsgquk0rl77nj30yxdy8j9vdx85fkpmdla2087ne0xh8nhedh8w27kyke0'
+     'lp53ut353s06fv3qfegext0eh0ymjpf39tuven09sam30g4vgpfna3rh',
+     {'amount_msat': 250000000, 'description': '1 cup coffee', 'expiry': 60}),
+    ('lnbc20m1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqq'
+     'qsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqs9qrsgq7ea976txfraylvgzuxs8kgcw23ez'
+     'lrszfnh8r6qtfpr6cxga50aj6txm9rxrydzd06dfeawfk6swupvz4erwnyutnjq7x39ymw6j38gp7ynn44',
+     {'amount_msat': 2000000000, 'description': None, 'expiry': 3600,
+      'description_hash': '3925b6f67e2c340036ed12093dd44e0368df1b6ea26c53dbe4811f58fd5db8c1'}),
+]
+
+
+@pytest.mark.parametrize('bolt11, expected', VECTORS)
+def test_spec_vectors(bolt11, expected):
+    for text in (bolt11, bolt11.upper(), 'lightning:' + bolt11):
+        invoice = decode(text)
+        assert invoice.currency == 'bc'
+        assert invoice.timestamp == TIMESTAMP
+        assert invoice.payment_hash == PAYMENT_HASH
+        assert invoice.payment_secret == PAYMENT_SECRET
+        assert invoice.min_final_cltv_expiry == 18
+        for name, value in expected.items():
+            assert getattr(invoice, name) == value
+    assert expiry_time(bolt11) == TIMESTAMP + expected['expiry']
+    assert decode(bolt11).is_expired()
+
+
+@pytest.mark.parametrize('hrp, currency, msat', [
+    ('lnbc', 'bc', None), ('lnbc10', 'bc', 10 ** 12), ('lnbc3m', 'bc', 3 * 10 ** 8),
+    ('lntb25u', 'tb', 25 * 10 ** 5), ('lnbcrt7n', 'bcrt', 700), ('lntbs10p', 'tbs', 1),
+])
+def test_currencies_and_amounts(hrp, currency, msat):
+    invoice = decode(make_invoice(hrp))
+    assert (invoice.currency, invoice.amount_msat) == (currency, msat)
+
+
+def test_tags_with_wrong_length_are_skipped():
+    invoice = decode(make_invoice(fields=[('p', [2] * 51), ('p', [1] * 52), ('h', [3] * 53),
+                                          ('n', [4] * 52), ('c', [1, 0]), ('z', [5] * 10)]))
+    assert invoice.payment_hash == '0842108421' * 6 + '0842'
+    assert invoice.description_hash is None
+    assert invoice.payee is None
+    assert invoice.min_final_cltv_expiry == 32
+
+
+@pytest.mark.parametrize('bolt11', [
+    VECTORS[1][0][:-1] + 'q',                                      # bad checksum
+    VECTORS[1][0][:20] + VECTORS[1][0][20:].upper(),               # mixed case
+    make_invoice('lnbc1p'),                                        # sub-millisatoshi amount
+    make_invoice('lnbc01u'),                                       # leading zero amount
+    make_invoice('bc10u'),                                         # not a lightning prefix
+    make_invoice(fields=[('d', [1] * 8)]),                         # no payment hash
+    make_invoice(fields=[('p', [1] * 52), ('d', [1] * 200)])[:-6],  # truncated
+])
+def test_invalid_invoices(bolt11):
+    with pytest.raises(Bolt11Error):
+        decode(bolt11)
+
+
+def test_is_invoice():
+    assert is_invoice(VECTORS[0][0])
+    assert not is_invoice(VECTORS[0][0][:-1] + 'q')
+    assert not is_invoice(None)
+
+
+def run_get_bolt11(pr, amount):
+    async def lnurlp(request):
+        return web.json_response({'callback': str(request.url.with_path('/cb').with_query(None)),
+                                  'minSendable': 1000, 'maxSendable': 10 ** 9, 'tag': 'payRequest'})
+
+    async def callback(request):
+        calls.append(request.query['amount'])
+        return web.json_response({'pr': pr, 'routes': []})
+
+    async def run():
+        routes = [('GET', '/.well-known/lnurlp/{user}', lnurlp), ('GET', '/cb', callback)]
+        async with stub_server(routes) as url, ClientSession() as session:
+            lnaddy = local_client(CONFIG, session, url, cache=TTLCache())
+            return await lnaddy.get_bolt11('bob@127.0.0.1', amount)
+
+    calls = []
+    return asyncio.run(run()), calls
+
+
+def test_get_bolt11_checks_amount_and_expiry():
+    now = int(time.time())
+    good = make_invoice('lnbc10u', now)
+    result, calls = run_get_bolt11(good, 1000)
+    assert result == good.upper()
+    assert calls == ['1000000']
+
+    result, _ = run_get_bolt11(make_invoice('lnbc20u', now), 1000)
+    assert result['status'] == 'error' and 'does not match' in result['msg']
+
+    result, _ = run_get_bolt11(make_invoice('lnbc10u', now - 7200), 1000)
+    assert result['status'] == 'error' and 'expired' in result['msg']
+
+    # no amount requested: the invoice must be for minSendable
+    result, calls = run_get_bolt11(make_invoice('lnbc10n', now), None)
+    assert result == make_invoice('lnbc10n', now).upper()
+    assert calls == ['1000']
+
+
+def test_get_payhash_is_local():
+    lnaddy = LNAddress(CONFIG)
+    assert asyncio.run(lnaddy.get_payhash(VECTORS[0][0])) == PAYMENT_HASH
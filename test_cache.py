@@ -0,0 +1,169 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.client import ClientSession
+from cache import ByteCache, TTLCache, cache_control_ttl
+import ln_address
+from conftest import CONFIG, Clock, local_client, stub_server
+from ln_address import LNAddress
+
+def test_ttl_cache_expiry_and_stale():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=10, stale_ttl=5, clock=clock)
+    cache.set('a', 1)
+    assert cache.lookup('a') == (1, True)
+    clock.now = 12
+    assert cache.lookup('a') == (1, False)
+    clock.now = 16
+    assert cache.lookup('a') == (None, False)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['stale_hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_cache_control_ttl():
+    assert cache_control_ttl(None, 300, 3600) == 300
+    assert cache_control_ttl('public, max-age=60', 300, 3600) == 60
+    assert cache_control_ttl('max-age=99999', 300, 3600) == 3600
+    assert cache_control_ttl('no-store', 300, 3600) == 0
+
+
+async def run_callback_data(cache_control):
+    calls = []
+
+    async def lnurlp(request):
+        calls.append(request.match_info['user'])
+        return web.json_response({'callback': 'http://localhost/cb', 'minSendable': 1000,
+                                  'maxSendable': 1000000, 'tag': 'payRequest'},
+                                 headers={'Cache-Control': cache_control})
+
+    clock = Clock()
+    cache = TTLCache(ttl=300, stale_ttl=600, clock=clock)
+    address = 'alice@127.0.0.1'
+    async with stub_server([('GET', '/.well-known/lnurlp/{user}', lnurlp)]) as url, ClientSession() as session:
+        lnaddy = local_client(CONFIG, session, url, cache=cache)
+        first = await lnaddy.callback_data(address)
+        second = await lnaddy.callback_data(address)
+        assert first == second
+        fresh_calls = len(calls)
+        # past max-age: stale value served, refresh happens in the background
+        clock.now = 120
+        stale = await lnaddy.callback_data(address)
+        assert stale == first
+        await asyncio.gather(*list(ln_address._refreshing.values()))
+        return fresh_calls, len(calls), cache.stats()
+
+
+def test_callback_data_cached_and_refreshed():
+    fresh_calls, total_calls, stats = asyncio.run(run_callback_data('max-age=60'))
+    assert fresh_calls == 1
+    assert total_calls == 2
+    assert stats['hits'] == 1
+    assert stats['stale_hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_callback_data_no_store_not_cached():
+    fresh_calls, total_calls, stats = asyncio.run(run_callback_data('no-store'))
+    assert fresh_calls == 2
+    assert stats['size'] == 0
+
+
+def test_byte_cache_budget_and_expiry():
+    clock = Clock()
+    cache = ByteCache(max_bytes=10, ttl=5, clock=clock)
+    cache.set('a', b'1234')
+    cache.set('b', b'5678')
+    cache.get('a')
+    cache.set('c', b'90ab')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.stats()['resident_bytes'] == 8
+    assert cache.stats()['evictions'] == 1
+    cache.set('big', b'x' * 11)
+    assert cache.get('big') is None
+    cache.set('short', b'12', ttl=1)
+    clock.now = 2
+    assert cache.get('short') is None
+    assert cache.get('a') == b'1234'
+    cache.set('gone', b'12', ttl=-1)
+    assert cache.get('gone') is None
+    assert cache.stats()['resident_bytes'] == 8
+
+
+async def run_negative(status, body, lookups):
+    calls = []
+
+    async def lnurlp(request):
+        calls.append(request.match_info['user'])
+        return web.Response(status=status, text=body)
+
+    async with stub_server([('GET', '/.well-known/lnurlp/{user}', lnurlp)]) as url, ClientSession() as session:
+        results = []
+        for _ in range(lookups):
+            lnaddy = local_client(CONFIG, session, url, cache=TTLCache())
+            results.append(await lnaddy.get_bolt11('bob@example.com', 100))
+        return results, calls
+
+
+def test_negative_cache_not_found(monkeypatch):
+    monkeypatch.setattr(ln_address, 'negative_cache', TTLCache())
+    results, calls = asyncio.run(run_negative(404, 'not found', 3))
+    assert len(calls) == 1
+    assert all(r['status'] == 'error' for r in results)
+    assert ln_address.negative_cache.get(('address', 'bob@example.com')) is not None
+
+
+def test_negative_cache_malformed_json_uses_own_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ln_address, 'negative_cache', TTLCache(clock=clock))
+    monkeypatch.setattr(ln_address, 'NEGATIVE_TTL_MALFORMED', 5)
+    results, calls = asyncio.run(run_negative(200, '<html>oops</html>', 2))
+    assert len(calls) == 1
+    clock.now = 6
+    assert ln_address.negative_cache.get(('address', 'bob@example.com')) is None
+
+
+def test_negative_cache_nxdomain_covers_domain(monkeypatch):
+    import socket
+    from aiohttp import TCPConnector
+    from aiohttp.abc import AbstractResolver
+
+    resolved = []
+
+    class NXResolver(AbstractResolver):
+        async def resolve(self, host, port=0, family=socket.AF_INET):
+            resolved.append(host)
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+        async def close(self):
+            pass
+
+    async def run():
+        async with ClientSession(connector=TCPConnector(resolver=NXResolver())) as session:
+            results = []
+            for user in ('alice', 'bob', 'carol'):
+                lnaddy = LNAddress(CONFIG, session, cache=TTLCache())
+                results.append(await lnaddy.get_bolt11(user + '@nx.invalid', 100))
+            return results
+
+    monkeypatch.setattr(ln_address, 'negative_cache', TTLCache())
+    results = asyncio.run(run())
+    assert len(resolved) == 1
+    assert all(r['status'] == 'error' for r in results)
+    assert ln_address.negative_cache.get(('domain', 'nx.invalid')) is not None
+
+
+def test_malformed_address_is_reported():
+    assert LNAddress(CONFIG).get_payurl('no-at-sign')['status'] == 'error'
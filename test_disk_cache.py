@@ -0,0 +1,144 @@
+import asyncio
+import multiprocessing
+
+import disk_cache
+from conftest import Clock
+from disk_cache import DiskCache, TieredByteCache, TieredTTLCache
+from fastjson import dumpb, loads
+from models import PayParams
+
+PARAMS = {'callback': 'https://example.com/cb', 'minSendable': 1000, 'maxSendable': 100000000, 'tag': 'payRequest'}
+
+
+def metadata_cache(store, clock):
+    return TieredTTLCache(store, 'metadata', lambda params: dumpb(params.raw),
+                          lambda data: PayParams.from_json(loads(data)), ttl=60, stale_ttl=30, clock=clock)
+
+
+def test_store_expiry_and_keep_window(tmp_path):
+    clock = Clock(1000.0)
+    store = DiskCache(str(tmp_path / 'l2.sqlite3'), clock=clock)
+    store.set('images', ('abc', b'\x00\xff', 'png', 3), b'png bytes', ttl=10, keep=20)
+    store.flush()
+    assert store.get('images', ('abc', b'\x00\xff', 'png', 3)) == (b'png bytes', 1010.0)
+    assert store.get('metadata', ('abc', b'\x00\xff', 'png', 3)) is None
+    clock.now += 15
+    assert store.get('images', ('abc', b'\x00\xff', 'png', 3)) == (b'png bytes', 1010.0)
+    clock.now += 10
+    assert store.get('images', ('abc', b'\x00\xff', 'png', 3)) is None
+    assert store.stats()['hits'] == 2 and store.stats()['misses'] == 2
+
+
+def test_size_bound_evicts_soonest_expiring(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, 'MAINTAIN_EVERY', 10)
+    store = DiskCache(str(tmp_path / 'l2.sqlite3'), max_bytes=20000)
+    for i in range(100):
+        store.set('images', 'k%d' % i, b'x' * 1000, ttl=100 + i)
+    store.flush()
+    total = store._connect().execute('SELECT SUM(size) FROM entries').fetchone()[0]
+    assert total <= 20000 + 10 * 1000
+    assert store.get('images', 'k0') is None
+    assert store.get('images', 'k99') is not None
+    assert store.stats()['evictions'] >= 80
+
+
+def test_cold_start_reads_through_and_promotes(tmp_path):
+    clock = Clock(1000.0)
+    path = str(tmp_path / 'l2.sqlite3')
+    store = DiskCache(path, clock=clock)
+    metadata_cache(store, clock).set('alice@example.com', PayParams.from_json(PARAMS))
+    store.flush()
+
+    # a new process: empty memory, same file
+    cache = metadata_cache(DiskCache(path, clock=clock), clock)
+    assert cache.lookup('alice@example.com') == (None, False)
+    params, fresh = asyncio.run(cache.load('alice@example.com'))
+    assert fresh and params.callback == PARAMS['callback'] and params.raw == PARAMS
+    assert cache.stats()['l2_hits'] == 1
+    assert cache.lookup('alice@example.com')[1] is True
+    assert cache.stats()['l2_hits'] == 1 and cache.stats()['hits'] == 1
+
+    # stale on disk: served as stale for the caller to refresh, not promoted
+    clock.now += 70
+    cache = metadata_cache(DiskCache(path, clock=clock), clock)
+    params, fresh = asyncio.run(cache.load('alice@example.com'))
+    assert params is not None and not fresh
+    assert len(cache) == 0
+    clock.now += 30
+    assert asyncio.run(cache.load('alice@example.com')) == (None, False)
+
+
+def test_image_cache_tier(tmp_path):
+    clock = Clock(1000.0)
+    path = str(tmp_path / 'l2.sqlite3')
+    store = DiskCache(path, clock=clock)
+    TieredByteCache(store, 'images', ttl=60, clock=clock).set(('k', 'svg'), b'<svg/>')
+    store.flush()
+    cache = TieredByteCache(DiskCache(path, clock=clock), 'images', ttl=60, clock=clock)
+    assert cache.get(('k', 'svg')) is None
+    assert asyncio.run(cache.load(('k', 'svg'))) == b'<svg/>'
+    assert cache.get(('k', 'svg')) == b'<svg/>'
+    assert cache.stats()['l2_hits'] == 1 and cache.stats()['hits'] == 1
+    clock.now += 61
+    cache = TieredByteCache(DiskCache(path, clock=clock), 'images', clock=clock)
+    assert asyncio.run(cache.load(('k', 'svg'))) is None
+
+
+def worker(path, n, errors):
+    store = DiskCache(path)
+    for i in range(200):
+        store.set('images', (n, i), b'%d' % i, ttl=60)
+        for other in range(4):
+            entry = store.get('images', (other, i // 2))
+            if entry is not None and entry[0] != b'%d' % (i // 2):
+                errors.put('bad value')
+    store.flush()
+    if store.errors:
+        errors.put('%d errors' % store.errors)
+
+
+def test_concurrent_workers(tmp_path):
+    path = str(tmp_path / 'l2.sqlite3')
+    errors = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(path, n, errors)) for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    assert all(process.exitcode == 0 for process in processes)
+    assert errors.empty()
+    store = DiskCache(path)
+    assert all(store.get('images', (n, 199)) is not None for n in range(4))
+
+
+def test_writes_do_not_block_the_loop(tmp_path):
+    store = DiskCache(str(tmp_path / 'l2.sqlite3'))
+    # another worker holding the write lock
+    other = DiskCache(str(tmp_path / 'l2.sqlite3'))
+    other.set('images', 'warm', b'x', ttl=60)
+    other.flush()
+    lock = other._connect()
+    lock.execute('BEGIN IMMEDIATE')
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        task = asyncio.ensure_future(ticker())
+        for i in range(20):
+            store.set('images', i, b'x', ttl=60)
+        await asyncio.sleep(0.3)
+        task.cancel()
+        return ticks
+
+    ticks = asyncio.run(run())
+    lock.execute('ROLLBACK')
+    store.flush()
+    # 20 writes waiting out the busy timeout did not stall the loop
+    assert ticks > 50
+    assert store.errors > 0
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import time
+
+from conftest import Clock, int_words, make_invoice, to_words
+from invoice_pool import InvoicePool
+
+
+def make_fetch(expiry=3600):
+    fetched = []
+
+    async def fetch(address, amount):
+        fetched.append((address, amount))
+        payment_hash = hashlib.sha256(b'%d' % len(fetched)).digest()
+        return make_invoice('lnbc%dn' % amount, int(time.time()),
+                            [('p', to_words(payment_hash)), ('x', int_words(expiry))]).upper()
+
+    return fetch, fetched
+
+
+async def settle(pool):
+    while pool._refills:
+        await asyncio.gather(*list(pool._refills.values()))
+
+
+def test_cold_pair_is_not_pooled():
+    async def run():
+        fetch, fetched = make_fetch()
+        pool = InvoicePool(fetch, hot_threshold=3, refill_rate=0)
+        assert pool.take('a@b.com', 100) is None
+        await settle(pool)
+        return fetched
+
+    assert asyncio.run(run()) == []
+
+
+def test_invoices_handed_out_once():
+    async def run():
+        fetch, fetched = make_fetch()
+        clock = Clock()
+        pool = InvoicePool(fetch, max_size=3, hot_threshold=1, lead_time=600,
+                           refill_rate=0, clock=clock)
+        assert pool.take('a@b.com', 100) is None
+        await settle(pool)
+        served = []
+        for _ in range(6):
+            bolt11 = pool.take('a@b.com', 100)
+            if bolt11 is not None:
+                served.append(bolt11)
+            await settle(pool)
+        return served, fetched, pool.stats()
+
+    served, fetched, stats = asyncio.run(run())
+    assert len(served) == 6
+    assert len(set(served)) == len(served)
+    assert stats['buffered'] == 3
+    assert len(fetched) == len(served) + stats['buffered']
+
+
+def test_expired_invoices_are_discarded():
+    async def run():
+        fetch, fetched = make_fetch()
+        clock = Clock()
+        pool = InvoicePool(fetch, max_size=2, max_age=100, hot_threshold=1,
+                           lead_time=600, refill_rate=0, window=1000, clock=clock)
+        pool.take('a@b.com', 100)
+        await settle(pool)
+        clock.now = 150
+        bolt11 = pool.take('a@b.com', 100)
+        await settle(pool)
+        return bolt11, pool.stats()
+
+    bolt11, stats = asyncio.run(run())
+    assert bolt11 is None
+    assert stats['expired'] == 1
+    assert stats['buffered'] == 2
+
+
+def test_target_size_follows_request_rate():
+    fetch, fetched = make_fetch()
+    clock = Clock()
+    pool = InvoicePool(fetch, max_size=5, window=10, hot_threshold=2, lead_time=2, clock=clock)
+    key = ('a@b.com', 100)
+    pool._record(key, 0)
+    assert pool.target_size(key) == 0
+    for _ in range(9):
+        pool._record(key, 1)
+    assert pool.target_size(key) == 2
+    for _ in range(100):
+        pool._record(key, 2)
+    assert pool.target_size(key) == 5
+    pool._record(key, 30)
+    assert pool.target_size(key) == 0
+
+
+def test_error_results_are_not_pooled():
+    async def run():
+        async def fetch(address, amount):
+            return 'Amount 1 is smaller than minimum 1000.'
+
+        pool = InvoicePool(fetch, hot_threshold=1, refill_rate=0)
+        pool.take('a@b.com', 1)
+        await settle(pool)
+        return pool.stats()
+
+    assert asyncio.run(run())['buffered'] == 0
+
+
+def test_invoices_expiring_soon_are_discarded():
+    async def run():
+        fetch, fetched = make_fetch(expiry=300)
+        clock = Clock()
+        pool = InvoicePool(fetch, max_size=1, max_age=600, expiry_margin=60, hot_threshold=1,
+                           lead_time=600, refill_rate=0, window=1000, clock=clock)
+        pool.take('a@b.com', 100)
+        await settle(pool)
+        # well within max_age, but inside the margin before the invoice expires
+        clock.now = 250
+        bolt11 = pool.take('a@b.com', 100)
+        await settle(pool)
+        # invoices that expire within the margin are not pooled at all
+        short = InvoicePool(make_fetch(expiry=30)[0], hot_threshold=1, lead_time=600, refill_rate=0)
+        short.take('a@b.com', 100)
+        await settle(short)
+        return bolt11, pool.stats(), short.stats()
+
+    bolt11, stats, short = asyncio.run(run())
+    assert bolt11 is None and stats['expired'] == 1
+    assert short['buffered'] == 0 and short['fetched'] == 1
+
+
+def test_busy_pair_is_evicted_last():
+    async def run():
+        fetch, fetched = make_fetch()
+        clock = Clock()
+        pool = InvoicePool(fetch, max_size=2, hot_threshold=1, lead_time=600, refill_rate=0,
+                           window=1000, max_keys=3, clock=clock)
+        for _ in range(9):
+            pool.take('hot@b.com', 100)
+        await settle(pool)
+        for i in range(4):
+            pool.take('cold%d@b.com' % i, 100)
+            pool.take('hot@b.com', 100)
+            await settle(pool)
+        return pool
+
+    pool = asyncio.run(run())
+    assert len(pool._requests[('hot@b.com', 100)]) == 13
+    assert ('hot@b.com', 100) in pool._invoices
+    assert ('cold0@b.com', 100) not in pool._requests
@@ -0,0 +1,35 @@
+import metrics
+from metrics import Counter, Histogram, Registry
+
+
+def test_histogram_exposition():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'latency', ('domain',), buckets=(0.1, 1))
+    latency.observe(0.05, 'a.com')
+    latency.observe(0.5, 'a.com')
+    latency.observe(5, 'a.com')
+    lines = registry.expose().splitlines()
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{domain="a.com",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{domain="a.com",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{domain="a.com",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{domain="a.com"} 5.55' in lines
+    assert 'latency_seconds_count{domain="a.com"} 3' in lines
+
+
+def test_series_are_capped(monkeypatch):
+    monkeypatch.setattr(metrics, 'MAX_SERIES', 2)
+    counter = Counter('responses_total', 'responses', ('domain', 'status'))
+    for domain in ('a', 'b', 'c', 'd'):
+        counter.inc(domain, '200')
+    counter.inc('a', '200')
+    assert counter._series == {('a', '200'): 2, ('b', '200'): 1, ('other', 'other'): 2}
+
+
+def test_collectors_and_label_escaping():
+    registry = Registry()
+    registry.add_collector(lambda: metrics.stats_samples('pool', {'size': 3, 'kind': 'thread'},
+                                                         {'name': 'say "hi"'}))
+    body = registry.expose()
+    assert 'pool_size{name="say \\"hi\\""} 3' in body
+    assert 'pool_kind' not in body
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import fastjson
+from conftest import BOLT11
+from models import Invoice, LNURLError, LNURLReason, PayParams
+
+PARAMS = {'callback': 'https://example.com/cb', 'minSendable': 1000, 'maxSendable': 100000000,
+          'metadata': '[["text/plain","alice"]]', 'commentAllowed': 32, 'tag': 'payRequest'}
+
+
+def test_pay_params_from_json():
+    params = PayParams.from_json(PARAMS)
+    assert (params.callback, params.min_sendable, params.max_sendable, params.comment_allowed) == \
+        ('https://example.com/cb', 1000, 100000000, 32)
+    assert params.raw is PARAMS
+    assert params.amount_msat(None) == 1000
+    assert params.amount_msat(0.5) == 1000
+    assert params.amount_msat(21) == 21000
+    assert params.query_url(21000) == 'https://example.com/cb?amount=21000'
+    assert PayParams.from_json(dict(PARAMS, callback='https://example.com/cb?id=1')).query_url(1000) == \
+        'https://example.com/cb?id=1&amount=1000'
+    assert not hasattr(params, '__dict__')
+
+
+def test_pay_params_errors():
+    with pytest.raises(LNURLReason, match='unknown user'):
+        PayParams.from_json({'status': 'ERROR', 'reason': 'unknown user'})
+    with pytest.raises(LNURLError):
+        PayParams.from_json(['not', 'a', 'dict'])
+    with pytest.raises(LNURLError, match='invalid amounts'):
+        PayParams.from_json(dict(PARAMS, minSendable='lots'))
+
+
+def test_invoice_from_json():
+    invoice = Invoice.from_json({'pr': BOLT11.lower(), 'routes': []})
+    assert invoice.amount_msat == 1000000
+    assert invoice.payment_hash == '0842108421' * 6 + '0842'
+    assert invoice.bolt11 == BOLT11
+    with pytest.raises(LNURLReason):
+        Invoice.from_json({'status': 'ERROR', 'reason': 'amount too small'})
+    with pytest.raises(LNURLError, match='Invalid invoice'):
+        Invoice.from_json({'pr': 'lnbc1xyz'})
+
+
+def test_fastjson_round_trip():
+    data = {'pr': BOLT11.lower(), 'memo': 'café ⚡', 'amount': 21, 'paid': False, 'routes': []}
+    assert fastjson.loads(fastjson.dumps(data)) == data
+    assert fastjson.loads(fastjson.dumpb(data)) == data
+    assert json.loads(fastjson.dumps(data)) == data
+    with pytest.raises(ValueError):
+        fastjson.loads('{"truncated": ')
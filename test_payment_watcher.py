@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from payment_watcher import PaymentWatcher
+
+HASH = '00' * 32
+
+
+def make_check(paid_after=None):
+    calls = []
+
+    async def check(payment_hash):
+        calls.append(payment_hash)
+        await asyncio.sleep(0)
+        return {'paid': paid_after is not None and len(calls) >= paid_after}
+    return check, calls
+
+
+async def drain(queue, until=('paid', 'expired')):
+    events = []
+    while not events or events[-1]['status'] not in until:
+        events.append(await asyncio.wait_for(queue.get(), 2))
+    return events
+
+
+def test_one_poll_per_interval_for_many_subscribers():
+    async def run():
+        check, calls = make_check(paid_after=3)
+        watcher = PaymentWatcher(check, interval=0.01, backoff=1)
+        queues = [watcher.subscribe(HASH) for _ in range(50)]
+        results = await asyncio.gather(*[drain(queue) for queue in queues])
+        return results, calls, watcher
+
+    results, calls, watcher = asyncio.run(run())
+    assert len(calls) == 3
+    assert all([e['status'] for e in events] == ['pending', 'paid'] for events in results)
+    assert len(watcher) == 0
+
+
+def test_due_hashes_are_polled_together_with_backoff():
+    async def run():
+        check, calls = make_check()
+        watcher = PaymentWatcher(check, interval=0.02, backoff=2, max_interval=0.05)
+        queues = [watcher.subscribe('%064x' % i) for i in range(5)]
+        await asyncio.sleep(0.2)
+        stats = watcher.stats()
+        await watcher.close()
+        return stats, calls
+
+    stats, calls = asyncio.run(run())
+    # polls at 0, 0.02, 0.06, 0.11, 0.16: five hashes per tick
+    assert stats['polls'] == len(calls) == 5 * stats['ticks']
+    assert 3 <= stats['ticks'] <= 6
+
+
+def test_expired_and_abandoned_watches_are_removed():
+    async def run():
+        check, calls = make_check()
+        watcher = PaymentWatcher(check, interval=0.01)
+        expiring = watcher.subscribe(HASH, expires_at=time.time() + 0.05)
+        events = await drain(expiring)
+        other = watcher.subscribe('11' * 32)
+        await asyncio.sleep(0.02)
+        watcher.unsubscribe('11' * 32, other)
+        return events, len(watcher)
+
+    events, remaining = asyncio.run(run())
+    assert events[-1] == {'payment_hash': HASH, 'status': 'expired', 'paid': False}
+    assert remaining == 0
+
+
+def test_late_subscriber_gets_current_status_and_errors_back_off():
+    async def run():
+        calls = []
+
+        async def check(payment_hash):
+            calls.append(payment_hash)
+            return 'connection refused' if len(calls) == 1 else {'paid': False}
+
+        watcher = PaymentWatcher(check, interval=0.01, backoff=1)
+        first = watcher.subscribe(HASH)
+        assert (await asyncio.wait_for(first.get(), 1))['status'] == 'pending'
+        late = watcher.subscribe(HASH)
+        event = late.get_nowait()
+        errors = watcher.errors
+        await watcher.close()
+        return event, errors
+
+    event, errors = asyncio.run(run())
+    assert event['status'] == 'pending'
+    assert errors == 1
+
+
+def test_unknown_payment_is_not_reported_pending():
+    async def run():
+        results = [None, {'detail': 'Payment does not exist.'}, {'paid': True}]
+
+        async def check(payment_hash):
+            return results.pop(0)
+
+        watcher = PaymentWatcher(check, interval=0.01, backoff=1)
+        queue = watcher.subscribe(HASH)
+        events = await drain(queue)
+        errors = watcher.errors
+        await watcher.close()
+        return events, errors
+
+    events, errors = asyncio.run(run())
+    assert [event['status'] for event in events] == ['paid']
+    assert errors == 2
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from aiohttp.client import ClientSession
+
+import utils
+from conftest import lnbits_client, lnbits_routes, stub_server
+from payout import FAILED, PAID, Journal, PayoutEngine, make_payouts
+
+
+@pytest.fixture(autouse=True)
+def upstream(monkeypatch):
+    monkeypatch.setattr(utils, 'breakers', utils.tracked())
+    monkeypatch.setattr(utils, 'latencies', utils.tracked())
+    monkeypatch.setattr(utils, 'BREAKER_THRESHOLD', 1000)
+
+
+def run_engine(payouts, journal, **kwargs):
+    async def run():
+        routes, state = lnbits_routes(**kwargs.pop('lnbits', {}))
+        async with stub_server(routes) as url, ClientSession() as session:
+            engine = PayoutEngine(lnbits_client(session, url), journal, backoff=0.01, **kwargs)
+            return await engine.run(payouts), state
+
+    return asyncio.run(run())
+
+
+def test_keys_are_stable_and_distinct():
+    rows = [('alice@x', '10'), ('bob@x', '10'), ('alice@x', '10'), ('carol@x', '5', 'reward-7')]
+    keys = [p.key for p in make_payouts(rows)]
+    assert keys == [p.key for p in make_payouts(rows)]
+    assert len(set(keys)) == 4
+    assert keys[3] == 'reward-7'
+
+
+def test_pays_concurrently_within_limits(tmp_path):
+    payouts = make_payouts([('user%d@x' % (i % 20), 10) for i in range(60)])
+    summary, state = run_engine(payouts, Journal(str(tmp_path / 'journal')),
+                                fetch_concurrency=8, pay_concurrency=4, lnbits={'latency': 0.01})
+    assert summary[PAID] == 60 and summary[FAILED] == 0
+    assert summary['payouts_per_second'] > 0
+    assert len(state['paid']) == 60 and state['duplicates'] == 0
+    assert 1 < state['max_paying'] <= 4
+
+
+def test_refused_and_lost_payments_are_retried_without_paying_twice(tmp_path):
+    payouts = make_payouts([('user%d@x' % i, 21) for i in range(10)] + [('nobody@x', 21)])
+    summary, state = run_engine(payouts, Journal(str(tmp_path / 'journal')), pay_concurrency=1,
+                                lnbits={'fail': 2, 'lose': 2})
+    assert summary[PAID] == 10 and summary[FAILED] == 1
+    assert len(state['paid']) == 10 and state['duplicates'] == 0
+    # the refused ones were paid on retry, the lost ones confirmed by status check
+    assert state['posts'] == 12
+
+
+def test_resume_after_crash_never_pays_twice(tmp_path):
+    path = str(tmp_path / 'journal')
+    payouts = make_payouts([('user%d@x' % i, 50) for i in range(30)])
+    result = {}
+
+    async def crash():
+        routes, state = lnbits_routes(latency=0.02)
+        async with stub_server(routes) as url, ClientSession() as session:
+            journal = Journal(path)
+            task = asyncio.ensure_future(PayoutEngine(lnbits_client(session, url), journal,
+                                                      pay_concurrency=5, backoff=0.01).run(payouts))
+            while len(state['paid']) < 10:
+                await asyncio.sleep(0.005)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            journal.close()
+            # a crash can leave half a record behind
+            with open(path, 'ab') as f:
+                f.write(b'{"key": "tor')
+            # payments cancelled in flight still reach the wallet
+            await asyncio.sleep(0.05)
+
+            journal = Journal(path)
+            summary = await PayoutEngine(lnbits_client(session, url), journal, pay_concurrency=5,
+                                         backoff=0.01).run(payouts)
+            journal.close()
+        result.update(state)
+        return summary
+
+    summary = asyncio.run(crash())
+    assert summary[PAID] == 30
+    assert len(result['paid']) == 30 and result['duplicates'] == 0
+    # every record of the resumed run is readable again
+    assert len(Journal(path).entries) == 30
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+from qr_executor import RenderExecutor
+from qr_render import FastRenderer, encode
+
+DATA = 'lightning:LNBC1U1PJ9G5QVPP5QQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQYPQ'
+
+
+@pytest.mark.parametrize('kind', ['inline', 'thread', 'process'])
+def test_executor_kinds_render_the_same(kind):
+    async def run():
+        executor = RenderExecutor(kind=kind, workers=1)
+        try:
+            qr = await executor.run(encode, DATA)
+            return await executor.run(FastRenderer().png, qr, scale=2)
+        finally:
+            executor.shutdown()
+
+    assert asyncio.run(run()) == FastRenderer().png(encode(DATA), scale=2)
+
+
+def test_saturated_queue_falls_back_inline():
+    async def run():
+        executor = RenderExecutor(kind='thread', workers=1, max_queue=2)
+        calls = []
+
+        def slow():
+            time.sleep(0.05)
+            return 'pool'
+
+        def fast():
+            calls.append('fallback')
+            return 'inline'
+
+        try:
+            results = await asyncio.gather(*[executor.run(slow, fallback=fast) for _ in range(5)])
+            return results, executor.stats()
+        finally:
+            executor.shutdown()
+
+    results, stats = asyncio.run(run())
+    assert results.count('pool') == 2
+    assert results.count('inline') == 3
+    assert stats['fallbacks'] == 3
+    assert stats['max_queue_depth'] == 2
+    assert stats['queue_depth'] == 0
+
+
+def test_event_loop_keeps_running_while_rendering():
+    async def run():
+        executor = RenderExecutor(kind='thread', workers=1)
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.001)
+
+        task = asyncio.ensure_future(ticker())
+        try:
+            await executor.run(time.sleep, 0.05)
+        finally:
+            task.cancel()
+            executor.shutdown()
+        return ticks
+
+    assert len(asyncio.run(run())) > 5
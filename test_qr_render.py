@@ -0,0 +1,67 @@
+import re
+
+import png
+import pytest
+from qr_render import FastRenderer, PyQRCodeRenderer, QUIET_ZONE, encode, get_renderer
+
+BOLT11 = ('lightning:LNBC1U1PJ9G5QVPP5QQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQQQSYQCYQ5RQWZQFQYPQ'
+          'DQ5XYSXXATSYP3K7ENXV4JSXQZPUSP5ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYG3ZYGS9QRSGQ')
+
+
+def pixels(data):
+    width, height, rows, info = png.Reader(bytes=data).asRGBA8()
+    return width, height, [bytes(row) for row in rows]
+
+
+@pytest.mark.parametrize('scale', [1, 3, 5])
+def test_fast_png_matches_pyqrcode(scale):
+    matrix = encode(BOLT11)
+    colors = {'module_color': (0, 0, 0, 128), 'background': (255, 255, 255, 255)}
+    expected = pixels(PyQRCodeRenderer().png(matrix, scale=scale, **colors))
+    assert pixels(FastRenderer().png(matrix, scale=scale, **colors)) == expected
+
+
+def test_fast_png_opaque_has_no_transparency():
+    data = FastRenderer().png(encode(BOLT11), module_color=(0, 0, 0), background=(255, 255, 255))
+    assert b'tRNS' not in data
+
+
+def test_fast_svg_path_covers_every_module():
+    matrix = encode(BOLT11)
+    svg = FastRenderer().svg(matrix, xmldecl=False).decode()
+    width = matrix.size + 2 * QUIET_ZONE
+    assert svg.startswith('<svg')
+    assert 'viewBox="0 0 %d %d"' % (width, width) in svg
+    assert 'width=' not in svg and 'height=' not in svg
+    assert svg.count('stroke=') == 1
+
+    path = re.search(r'stroke="black" d="([^"]+)"', svg).group(1)
+    grid = [['0'] * matrix.size for _ in range(matrix.size)]
+    x = y = 0.0
+    for cmd, a, b in re.findall(r'([Mmh])(-?[\d.]+)(?: (-?[\d.]+))?', path):
+        if cmd == 'M':
+            x, y = float(a), float(b)
+        elif cmd == 'm':
+            x, y = x + float(a), y + float(b)
+        else:
+            for col in range(int(x), int(x) + int(a)):
+                grid[int(y) - QUIET_ZONE][col - QUIET_ZONE] = '1'
+            x += int(a)
+    assert tuple(''.join(row) for row in grid) == matrix.rows
+
+
+def test_fast_svg_escapes_colors():
+    svg = FastRenderer().svg(encode('hello'), module_color='"/><script>', background='white')
+    assert b'<script>' not in svg
+
+
+def test_get_renderer():
+    assert get_renderer('pyqrcode').name == 'pyqrcode'
+    assert get_renderer('fast').name == 'fast'
+
+
+def test_fast_png_colored_matches_pyqrcode():
+    matrix = encode(BOLT11)
+    colors = {'module_color': (200, 10, 10, 255), 'background': (0, 0, 255, 100)}
+    expected = pixels(PyQRCodeRenderer().png(matrix, scale=2, **colors))
+    assert pixels(FastRenderer().png(matrix, scale=2, **colors)) == expected
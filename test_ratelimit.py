@@ -0,0 +1,112 @@
+import asyncio
+
+from conftest import Clock
+from metrics import registry
+from ratelimit import RateLimiter, RateLimitMiddleware, client_key, target_domain
+
+
+def test_bucket_burst_and_refill():
+    clock = Clock(1000.0)
+    limiter = RateLimiter(rate=2, burst=3, max_wait=0, clock=clock)
+    assert [limiter.take('a')[0] for _ in range(4)] == [True, True, True, False]
+    admitted, retry_after = limiter.take('a')
+    assert not admitted and retry_after == 0.5
+    clock.now += 0.5
+    assert limiter.take('a') == (True, 0)
+    assert limiter.take('b') == (True, 0)
+    # a bucket left alone for burst / rate seconds is full again
+    clock.now += 1.5
+    assert [limiter.take('a')[0] for _ in range(4)] == [True, True, True, False]
+    assert limiter.stats()['rejected'] == 3
+
+
+def test_requests_queue_up_to_max_wait():
+    clock = Clock(1000.0)
+    limiter = RateLimiter(rate=10, burst=1, max_wait=0.25, clock=clock)
+    results = [limiter.take('a') for _ in range(5)]
+    assert [admitted for admitted, _ in results] == [True, True, True, False, False]
+    assert [round(wait, 3) for _, wait in results[:3]] == [0, 0.1, 0.2]
+    assert round(results[3][1], 3) == 0.3
+    assert limiter.stats()['delayed'] == 2
+
+
+def test_memory_is_bounded_and_active_keys_survive():
+    clock = Clock(1000.0)
+    limiter = RateLimiter(rate=1, burst=2, max_wait=0, max_keys=1000, clock=clock)
+    assert [limiter.take('scraper')[0] for _ in range(3)] == [True, True, False]
+    for i in range(200000):
+        limiter.take(i)
+        if i % 500 == 0:
+            limiter.take('scraper')
+    assert len(limiter) <= 1000
+    evicted = limiter.stats()['evicted']
+    assert evicted > 198000
+    # still throttled: recently seen, so its bucket was kept over older ones
+    assert limiter.take('scraper')[0] is False
+    # once refilled, buckets are dropped without losing anything
+    clock.now += 10
+    for i in range(1000):
+        limiter.take(('new', i))
+    assert len(limiter) <= 1000 and limiter.stats()['evicted'] == evicted
+
+
+def test_client_and_domain_keys():
+    scope = {'client': ('2001:db8:1:2:aaaa::1', 5000), 'headers': [(b'x-forwarded-for', b'203.0.113.9, 10.0.0.1')]}
+    assert client_key(scope, trust_forwarded=False) == '2001:db8:1:2::/64'
+    assert client_key(scope, trust_forwarded=True) == '203.0.113.9'
+    assert client_key({'client': None, 'headers': []}, False) == 'unknown'
+    assert target_domain('/svg/alice@Example.com/amt/100') == 'example.com'
+    assert target_domain('/bob@wallet.io') == 'wallet.io'
+    assert target_domain('/status/' + 'ab' * 32) is None
+
+
+def run_load(middleware, requests):
+    """
+    load generator: fire (client ip, path) requests concurrently through
+    the middleware, returns (status, headers) per request in order
+    """
+    async def one(ip, path):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'headers': [], 'client': (ip, 1234)}
+        await middleware(scope, None, send)
+        return sent[0]['status'], dict(sent[0]['headers'])
+
+    async def run():
+        return await asyncio.gather(*[one(ip, path) for ip, path in requests])
+
+    return asyncio.run(run())
+
+
+async def ok_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+
+def test_load_scraper_is_refused_and_others_are_served():
+    middleware = RateLimitMiddleware(ok_app, clients=RateLimiter(5, 10, max_wait=0.5),
+                                     domains=RateLimiter(100, 100, max_wait=0))
+    requests = [('198.51.100.7', '/user%d@wallet.io' % i) for i in range(200)]
+    requests += [('192.0.2.%d' % i, '/alice@other.io') for i in range(20)]
+    results = run_load(middleware, requests)
+    scraper = [status for status, _ in results[:200]]
+    # the burst, then two more queued for up to 0.4s
+    assert scraper.count(200) == 10 + 2 and scraper.count(429) == 188
+    assert all(headers[b'retry-after'] == b'1' for status, headers in results[:200] if status == 429)
+    assert [status for status, _ in results[200:]] == [200] * 20
+    assert 'sendsats_rate_limited_total{limit="client",status="429"}' in registry.expose()
+
+
+def test_load_on_one_domain_gets_503():
+    middleware = RateLimitMiddleware(ok_app, clients=RateLimiter(100, 100),
+                                     domains=RateLimiter(1, 5, max_wait=0))
+    requests = [('192.0.2.%d' % (i % 50), '/qr/tips@popular.example') for i in range(50)]
+    requests += [('192.0.2.1', '/static/style.css'), ('192.0.2.1', '/bob@quiet.example')]
+    results = run_load(middleware, requests)
+    statuses = [status for status, _ in results]
+    assert statuses[:50].count(200) == 5 and statuses[:50].count(503) == 45
+    assert int(results[-3][1][b'retry-after']) >= 1
+    assert statuses[50:] == [200, 200]
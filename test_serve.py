@@ -0,0 +1,87 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+import ln_address
+import serve
+from metrics import upstream_in_flight
+
+
+def test_worker_options(monkeypatch):
+    assert serve.worker_count(3) == 3
+    assert serve.worker_count(0) >= 1
+    monkeypatch.setattr(serve, 'available', lambda module: False)
+    assert (serve.event_loop(), serve.http_protocol()) == ('asyncio', 'h11')
+    monkeypatch.setattr(serve, 'available', lambda module: True)
+    assert (serve.event_loop(), serve.http_protocol()) == ('uvloop', 'httptools')
+
+
+def test_drain_waits_for_upstream_calls(monkeypatch):
+    monkeypatch.setattr(ln_address, '_refreshing', {})
+
+    async def run():
+        refresh = asyncio.ensure_future(asyncio.sleep(0.2))
+        ln_address._refreshing['alice@example.com'] = refresh
+        refresh.add_done_callback(lambda task: ln_address._refreshing.pop('alice@example.com'))
+        assert await ln_address.drain(5) == 0
+        assert refresh.done()
+
+        upstream_in_flight.inc()
+        try:
+            start = time.monotonic()
+            assert await ln_address.drain(0.2) == 1
+            assert time.monotonic() - start < 1
+        finally:
+            upstream_in_flight.dec()
+
+    asyncio.run(run())
+
+
+def children(pid):
+    out = subprocess.run(['pgrep', '-P', str(pid)], capture_output=True, text=True).stdout
+    return set(out.split())
+
+
+def get(url):
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as res:
+                return res.status
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_workers_restart_and_drain_on_sigterm():
+    sock = serve.bind_socket('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    sock.close()
+    env = dict(os.environ, RATE_LIMIT_CLIENT_RATE='0', L2_CACHE_PATH='')
+    server = subprocess.Popen([sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port),
+                               '--workers', '2', '--drain-timeout', '2'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    try:
+        url = 'http://127.0.0.1:%d/metrics' % port
+        assert get(url) == 200
+        workers = children(server.pid)
+        assert len(workers) == 2
+
+        # a dead worker is replaced, the other keeps serving meanwhile
+        os.kill(int(workers.pop()), signal.SIGKILL)
+        deadline = time.monotonic() + 20
+        while len(children(server.pid) - workers) < 1 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert len(children(server.pid)) == 2
+        assert get(url) == 200
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(20) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.client import ClientSession
+import ln_address
+from conftest import CONFIG, local_client, stub_server
+from utils import SingleFlight
+
+def stub_routes(status=200):
+    calls = []
+
+    async def lnurlp(request):
+        calls.append(request.match_info['user'])
+        await asyncio.sleep(0.05)
+        if status != 200:
+            return web.Response(status=status, text='not json')
+        return web.json_response({'callback': 'http://localhost/cb', 'minSendable': 1000,
+                                  'maxSendable': 1000000, 'tag': 'payRequest'})
+
+    return [('GET', '/.well-known/lnurlp/{user}', lnurlp)], calls
+
+
+async def concurrent_callback_data(n, status=200):
+    routes, calls = stub_routes(status)
+    async with stub_server(routes) as url, ClientSession() as session:
+        clients = [local_client(CONFIG, session, url, cache=None) for _ in range(n)]
+        results = await asyncio.gather(*[client.callback_data('bob@localhost') for client in clients],
+                                       return_exceptions=True)
+        return results, calls
+
+
+def test_concurrent_requests_make_one_upstream_call():
+    results, calls = asyncio.run(concurrent_callback_data(50))
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+    assert results[0]['minSendable'] == 1000
+    assert len(ln_address.metadata_flight) == 0
+
+
+def test_errors_are_shared():
+    results, calls = asyncio.run(concurrent_callback_data(20, status=500))
+    assert len(calls) == 1
+    assert all(isinstance(r, ln_address.LNAddressError) for r in results)
+    assert len(ln_address.metadata_flight) == 0
+
+
+def test_slot_clears_after_completion():
+    async def run():
+        flight = SingleFlight()
+        count = []
+
+        async def fetch():
+            count.append(1)
+            await asyncio.sleep(0)
+            return len(count)
+
+        first = await asyncio.gather(flight.do('k', fetch), flight.do('k', fetch))
+        second = await flight.do('k', fetch)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == [1, 1]
+    assert second == 2
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    async def run():
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.02)
+            return 'ok'
+
+        waiter = asyncio.ensure_future(flight.do('k', fetch))
+        other = asyncio.ensure_future(flight.do('k', fetch))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await other
+
+    assert asyncio.run(run()) == 'ok'
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+import templating
+from templating import create_environment, precompile, stream_template
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+CONTEXT = {'lnaddress': 'alice@example.com', 'amount': 5, 'bolt11': 'lnbc1', 'url': 'https://example.com',
+           'min_send': '1', 'max_send': '100', 'callback': {'callback': 'https://example.com/cb'},
+           'pr_dict': {}}
+
+
+def no_compile(env):
+    def compile(*args, **kwargs):
+        raise AssertionError('template compiled instead of loaded from cache')
+
+    env.compile = compile
+    return env
+
+
+def test_bytecode_cache_survives_new_process(tmp_path):
+    names = precompile(create_environment(TEMPLATES, cache_dir=str(tmp_path)))
+    assert 'sats.html' in names
+    assert len(os.listdir(tmp_path)) == len(names)
+
+    # a fresh environment, as after a cold start, must not compile again
+    env = no_compile(create_environment(TEMPLATES, cache_dir=str(tmp_path)))
+    assert 'Send 5 Sats' in env.get_template('sats.html').render(CONTEXT, qrdata='<svg/>')
+
+
+def test_async_templates_use_their_own_cache_files(tmp_path):
+    precompile(create_environment(TEMPLATES, cache_dir=str(tmp_path)))
+    files = set(os.listdir(tmp_path))
+    precompile(create_environment(TEMPLATES, enable_async=True, cache_dir=str(tmp_path)))
+    assert len(os.listdir(tmp_path)) == 2 * len(files)
+
+
+def test_read_only_cache_dir_falls_back_to_temp(monkeypatch, tmp_path):
+    monkeypatch.setattr(templating.os, 'access', lambda path, mode: path != str(tmp_path))
+    assert templating.cache_directory(str(tmp_path)) != str(tmp_path)
+
+
+def test_cache_built_elsewhere_loads_read_only(monkeypatch, tmp_path):
+    # built in the checkout, loaded from another path as in a deploy bundle
+    bundled = str(tmp_path / 'bundled')
+    precompile(create_environment(TEMPLATES, cache_dir=bundled))
+    moved = str(tmp_path / 'deploy' / 'templates')
+    shutil.copytree(TEMPLATES, moved)
+    fallback = str(tmp_path / 'tmp')
+    monkeypatch.setattr(templating.tempfile, 'gettempdir', lambda: fallback)
+    monkeypatch.setattr(templating.os, 'access', lambda path, mode: path != bundled)
+    env = no_compile(create_environment(moved, cache_dir=bundled))
+    assert 'Send 5 Sats' in env.get_template('sats.html').render(CONTEXT, qrdata='<svg/>')
+
+    # a template the bundle lacks is compiled once into the writable directory
+    os.remove(os.path.join(bundled, os.listdir(bundled)[0]))
+    precompile(create_environment(moved, cache_dir=bundled))
+    assert len(os.listdir(os.path.join(fallback, 'sendsats-templates'))) == 1
+    precompile(no_compile(create_environment(moved, cache_dir=bundled)))
+
+
+def test_committed_cache_is_current():
+    env = create_environment(TEMPLATES, cache_dir=templating.TEMPLATE_CACHE_DIR)
+    if not any(templating.PYTHON_TAG in name for name in os.listdir(templating.TEMPLATE_CACHE_DIR)):
+        pytest.skip('no committed cache for ' + templating.PYTHON_TAG)
+    # fails after a template edit until `python templating.py` is run again
+    precompile(no_compile(env))
+    precompile(no_compile(create_environment(TEMPLATES, enable_async=True, cache_dir=templating.TEMPLATE_CACHE_DIR)))
+
+
+def test_stream_sends_head_before_deferred_value():
+    env = create_environment(TEMPLATES, enable_async=True)
+
+    async def run():
+        released = asyncio.Event()
+
+        async def qr():
+            await released.wait()
+            return '<svg id="qr"/>'
+
+        context = dict(CONTEXT, qrdata=asyncio.ensure_future(qr()))
+        stream = stream_template(env.get_template('sats.html'), context)
+        head = await stream.__anext__()
+        released.set()
+        rest = [chunk async for chunk in stream]
+        return head, ''.join(rest)
+
+    head, rest = asyncio.run(run())
+    assert '<head>' in head and 'alice@example.com' in head
+    assert '<svg' not in head
+    assert rest.startswith('<svg id="qr"/>')
+
+
+def test_stream_raises_render_errors():
+    env = create_environment(TEMPLATES, enable_async=True)
+
+    async def run():
+        async def broken():
+            raise ValueError('boom')
+
+        context = dict(CONTEXT, qrdata=asyncio.ensure_future(broken()))
+        return [chunk async for chunk in stream_template(env.get_template('sats.html'), context)]
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+import zipfile
+
+import pytest
+from aiohttp.client import ClientSession
+
+import utils
+from bolt11 import decode
+from conftest import lnbits_client, lnbits_routes, stub_server
+from qr_executor import RenderExecutor
+from tipcards import Card, CardWriter, TipCardPipeline, read_cards
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+@pytest.fixture(autouse=True)
+def upstream(monkeypatch):
+    monkeypatch.setattr(utils, 'breakers', utils.tracked())
+    monkeypatch.setattr(utils, 'latencies', utils.tracked())
+
+
+def generate(cards, output, kind='thread', queue_size=4, on_write=None):
+    async def run():
+        routes, state = lnbits_routes()
+        executor = RenderExecutor(kind=kind, workers=2)
+        writer = CardWriter(output)
+        try:
+            async with stub_server(routes) as url, ClientSession() as session:
+                pipeline = TipCardPipeline(lnbits_client(session, url), executor, ('png', 'svg'), 4,
+                                           metadata_concurrency=2, invoice_concurrency=3, queue_size=queue_size)
+                if on_write is not None:
+                    write = writer.write
+                    writer.write = lambda card: (on_write(pipeline), write(card))
+                return await pipeline.run(cards, writer)
+        finally:
+            writer.close()
+            executor.shutdown()
+
+    return asyncio.run(run())
+
+
+def test_read_cards(tmp_path):
+    path = tmp_path / 'cards.csv'
+    path.write_text('address,amount,name\nalice@x,21,Table 1\n# comment\nbob@x\n')
+    cards = list(read_cards(str(path)))
+    assert [(c.index, c.address, c.amount, c.name) for c in cards] == [(0, 'alice@x', 21, 'Table 1'),
+                                                                      (1, 'bob@x', None, None)]
+    path = tmp_path / 'cards.jsonl'
+    path.write_text('{"address": "alice@x", "amount": 21}\n\n{"address": "bob@x", "name": "b"}\n')
+    assert [(c.address, c.amount, c.name) for c in read_cards(str(path))] == [('alice@x', 21, None),
+                                                                              ('bob@x', None, 'b')]
+
+
+def test_bad_lines_become_card_errors(tmp_path):
+    path = tmp_path / 'cards.csv'
+    path.write_text('user1@x,10\nb@x.com,ten\n,5\nuser2@x,20\n')
+    summary = generate(read_cards(str(path)), str(tmp_path / 'out'))
+    assert summary['cards'] == 4 and summary['errors'] == 2
+    manifest = {m['index']: m for m in map(json.loads, open(tmp_path / 'out' / 'manifest.jsonl'))}
+    assert manifest[1]['address'] == 'b@x.com' and manifest[1]['error'].startswith('input: ')
+    assert manifest[2]['error'] == 'input: no address'
+    assert manifest[3]['bolt11'] is not None
+    path = tmp_path / 'cards.jsonl'
+    path.write_text('{"address": "alice@x"}\n{"address": \n{"amount": 5}\n')
+    errors = [c.error for c in read_cards(str(path))]
+    assert errors[0] is None and errors[1].startswith('input: ') and errors[2].startswith('input: ')
+
+
+def test_cards_to_directory(tmp_path):
+    cards = [Card(i, 'user%d@x' % i, 10 * (i + 1)) for i in range(12)] + [Card(12, 'nobody@x', 10)]
+    summary = generate(iter(cards), str(tmp_path / 'out'))
+    assert summary['cards'] == 13 and summary['errors'] == 1
+    manifest = [json.loads(line) for line in open(tmp_path / 'out' / 'manifest.jsonl')]
+    assert sorted(m['index'] for m in manifest) == list(range(13))
+    for entry in manifest:
+        if entry['address'] == 'nobody@x':
+            assert entry['files'] == [] and 'unknown user' in entry['error']
+            continue
+        assert decode(entry['bolt11']).amount_msat == entry['amount'] * 1000
+        with open(tmp_path / 'out' / entry['files'][0], 'rb') as f:
+            assert f.read(8) == PNG_SIGNATURE
+        assert os.path.getsize(tmp_path / 'out' / entry['files'][1]) > 0
+    assert len(os.listdir(tmp_path / 'out')) == 12 * 2 + 1
+
+
+def test_cards_to_zip_in_process_pool(tmp_path):
+    output = str(tmp_path / 'cards.zip')
+    summary = generate(iter([Card(i, 'user%d@x' % i, 21) for i in range(6)]), output, kind='process')
+    assert summary['cards'] == 6 and summary['errors'] == 0
+    assert summary['executor']['kind'] == 'process'
+    with zipfile.ZipFile(output) as archive:
+        names = archive.namelist()
+        assert names[-1] == 'manifest.jsonl'
+        assert len(names) == 6 * 2 + 1
+        assert archive.read('000000-user0@x.png').startswith(PNG_SIGNATURE)
+        assert len(archive.read('manifest.jsonl').splitlines()) == 6
+
+
+def test_input_is_read_no_faster_than_cards_are_written(tmp_path):
+    ahead = []
+    summary = generate((Card(i, 'user%d@x' % (i % 7), 5) for i in range(80)), str(tmp_path / 'out'),
+                       on_write=lambda pipeline: ahead.append(pipeline.read - pipeline.written))
+    assert summary['cards'] == 80
+    # queues of 4 between 4 stages, plus the cards held by 2 + 3 + 2 workers
+    assert max(ahead) <= 4 * 4 + 2 + 3 + 2 + 1
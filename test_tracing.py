@@ -0,0 +1,94 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.client import ClientSession
+
+import app
+from cache import TTLCache
+from conftest import BOLT11, CONFIG, FakeLNAddress, local_client, stub_server
+from tracing import Trace, TracingMiddleware, _current, span
+
+def test_spans_are_summed_per_name():
+    trace = Trace('abc')
+    token = _current.set(trace)
+    try:
+        with span('metadata'):
+            pass
+        with span('qr_encode'):
+            pass
+        with span('metadata'):
+            pass
+    finally:
+        _current.reset(token)
+    with span('outside'):
+        pass
+    assert [name for name, _ in trace.spans] == ['metadata', 'qr_encode', 'metadata']
+    timing = trace.server_timing()
+    assert timing.startswith('metadata;dur=')
+    assert [part.split(';')[0] for part in timing.split(', ')] == ['metadata', 'qr_encode', 'total']
+
+
+async def call_app(asgi, path, headers=()):
+    messages = []
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(),
+             'headers': [(k.encode(), v.encode()) for k, v in headers], 'query_string': b'',
+             'http_version': '1.1', 'scheme': 'http', 'server': ('test', 80),
+             'client': ('127.0.0.1', 1), 'root_path': ''}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi(scope, receive, send)
+    return dict(messages[0]['headers'])
+
+
+def test_page_carries_server_timing(monkeypatch):
+    monkeypatch.setattr(app, 'get_client', lambda: FakeLNAddress(None))
+    monkeypatch.setattr(app, 'get_session', lambda: None)
+    monkeypatch.setattr(app, 'image_cache', app.ByteCache())
+    headers = asyncio.run(call_app(app.app, '/alice@example.com', [('x-request-id', 'req-42')]))
+    names = [part.split(';')[0] for part in headers[b'server-timing'].decode().split(', ')]
+    assert names == ['qr_encode', 'qr_render', 'template', 'total']
+    assert headers[b'x-request-id'] == b'req-42'
+
+
+def test_json_log_per_request(caplog):
+    async def endpoint(scope, receive, send):
+        with span('invoice'):
+            pass
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    with caplog.at_level('INFO', logger='trace'):
+        headers = asyncio.run(call_app(TracingMiddleware(endpoint, log=True), '/x'))
+    record = [r for r in caplog.records if r.name == 'trace'][-1]
+    assert '"request_id": "%s"' % headers[b'x-request-id'].decode() in record.getMessage()
+    assert '"invoice":' in record.getMessage()
+
+
+def test_ln_address_records_metadata_and_invoice_spans():
+    async def lnurlp(request):
+        return web.json_response({'callback': str(request.url.with_path('/cb').with_query(None)),
+                                  'minSendable': 1000, 'maxSendable': 1000000, 'tag': 'payRequest'})
+
+    async def callback(request):
+        return web.json_response({'pr': BOLT11.lower(), 'routes': []})
+
+    async def run():
+        routes = [('GET', '/.well-known/lnurlp/{user}', lnurlp), ('GET', '/cb', callback)]
+        trace = Trace('t')
+        token = _current.set(trace)
+        try:
+            async with stub_server(routes) as url, ClientSession() as session:
+                lnaddy = local_client(CONFIG, session, url, cache=TTLCache())
+                bolt11 = await lnaddy.get_bolt11('bob@127.0.0.1', 1000)
+        finally:
+            _current.reset(token)
+        return bolt11, trace
+
+    bolt11, trace = asyncio.run(run())
+    assert bolt11 == BOLT11
+    assert [name for name, _ in trace.spans] == ['metadata', 'invoice']
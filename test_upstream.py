@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.client import ClientSession
+import utils
+from conftest import Clock, stub_server
+from utils import CircuitBreaker, CircuitOpenError, ResponseTooLarge, get_url
+
+
+def stub_routes():
+    calls = {'slow': 0, 'error': 0, 'hedge': 0}
+
+    async def slow(request):
+        calls['slow'] += 1
+        await asyncio.sleep(1)
+        return web.Response(text='late')
+
+    async def big(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(100):
+            await response.write(b'x' * 1024)
+        return response
+
+    async def error(request):
+        calls['error'] += 1
+        return web.Response(status=503, text='down')
+
+    async def fast(request):
+        return web.Response(text='ok')
+
+    async def hedge(request):
+        calls['hedge'] += 1
+        # first request hangs, the hedged copy answers
+        if calls['hedge'] == 1:
+            await asyncio.sleep(1)
+        return web.Response(text='hedged %d' % calls['hedge'])
+
+    routes = [('GET', '/slow', slow), ('GET', '/big', big), ('GET', '/error', error),
+              ('GET', '/fast', fast), ('GET', '/hedge', hedge)]
+    return routes, calls
+
+
+@pytest.fixture(autouse=True)
+def upstream(monkeypatch):
+    monkeypatch.setattr(utils, 'breakers', utils.tracked())
+    monkeypatch.setattr(utils, 'latencies', utils.tracked())
+    monkeypatch.setattr(utils, 'FIRST_BYTE_TIMEOUT', 0.2)
+    monkeypatch.setattr(utils, 'MAX_BODY', 10 * 1024)
+    monkeypatch.setattr(utils, 'BREAKER_THRESHOLD', 3)
+    monkeypatch.setattr(utils, 'HEDGE_MIN_SAMPLES', 5)
+    monkeypatch.setattr(utils, 'HEDGE_MIN_DELAY', 0.01)
+
+
+def run_against_stub(scenario):
+    async def run():
+        routes, calls = stub_routes()
+        async with stub_server(routes) as base, ClientSession() as session:
+            return await scenario(session, base, calls)
+    return asyncio.run(run())
+
+
+def test_slow_upstream_times_out():
+    async def scenario(session, base, calls):
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await get_url(session=session, path=base + '/slow', headers={})
+        return time.monotonic() - start
+
+    assert run_against_stub(scenario) < 1
+
+
+def test_body_size_is_bounded():
+    async def scenario(session, base, calls):
+        with pytest.raises(ResponseTooLarge):
+            await get_url(session=session, path=base + '/big', headers={})
+
+    run_against_stub(scenario)
+
+
+def test_breaker_opens_after_repeated_errors():
+    async def scenario(session, base, calls):
+        for _ in range(3):
+            await get_url(session=session, path=base + '/error', headers={})
+        with pytest.raises(CircuitOpenError):
+            await get_url(session=session, path=base + '/error', headers={})
+        with pytest.raises(CircuitOpenError):
+            await get_url(session=session, path=base + '/fast', headers={})
+        return calls['error']
+
+    assert run_against_stub(scenario) == 3
+
+
+def test_hedged_request_beats_slow_first_attempt():
+    async def scenario(session, base, calls):
+        for _ in range(5):
+            await get_url(session=session, path=base + '/fast', headers={})
+        start = time.monotonic()
+        body = await get_url(session=session, path=base + '/hedge', headers={}, hedge=True)
+        return body, time.monotonic() - start, calls['hedge']
+
+    body, elapsed, hedge_calls = run_against_stub(scenario)
+    assert body == b'hedged 2'
+    assert hedge_calls == 2
+    assert elapsed < 0.2
+
+
+def test_gets_are_not_hedged_unless_asked():
+    async def scenario(session, base, calls):
+        for _ in range(5):
+            await get_url(session=session, path=base + '/fast', headers={})
+        with pytest.raises(asyncio.TimeoutError):
+            await get_url(session=session, path=base + '/hedge', headers={})
+        return calls['hedge']
+
+    assert run_against_stub(scenario) == 1
+
+
+def test_refused_port_does_not_open_the_hosts_breaker():
+    async def scenario(session, base, calls):
+        refused = 'http://127.0.0.1:1/.well-known/lnurlp/alice'
+        for _ in range(3):
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await get_url(session=session, path=refused, headers={})
+        with pytest.raises(CircuitOpenError):
+            await get_url(session=session, path=refused, headers={})
+        return await get_url(session=session, path=base + '/fast', headers={})
+
+    assert run_against_stub(scenario) == b'ok'
+    assert utils.upstream('https://Example.com/x') == 'example.com'
+    assert utils.upstream('https://example.com:8443/x') == 'example.com:8443'
+
+
+def test_tracked_upstreams_are_bounded(monkeypatch):
+    monkeypatch.setattr(utils, 'TRACKED_UPSTREAMS', 10)
+    monkeypatch.setattr(utils, 'breakers', utils.tracked())
+    for i in range(100):
+        utils.get_breaker('host%d.example' % i).failure()
+    assert len(utils.breakers) == 10
+    assert utils.breakers.get('host99.example').failures == 1
+
+
+def test_breaker_half_open_trial():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, cooldown=10, clock=clock)
+    breaker.failure()
+    breaker.before('d')
+    breaker.failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before('d')
+    clock.now = 11
+    assert breaker.state == 'half-open'
+    breaker.before('d')
+    with pytest.raises(CircuitOpenError):
+        breaker.before('d')
+    breaker.failure()
+    assert breaker.state == 'open'
+    clock.now = 22
+    breaker.before('d')
+    breaker.success()
+    assert breaker.state == 'closed'
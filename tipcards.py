@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import zipfile
+
+from fastjson import dumpb, dumps, loads
+from ln_address import LNAddress
+from qr_executor import RenderExecutor
+from qr_render import FastRenderer, encode
+
+"""
+ bulk tip cards: QR codes for a list of lightning addresses and amounts,
+ generated offline instead of one /qr or /svg request per card.
+
+ cards stream through bounded stages (metadata fetch, invoice fetch, QR
+ render in a process pool, write) so memory stays flat for any input size.
+ images go to a directory or a zip, with a manifest.jsonl of the invoices.
+
+ usage: python tipcards.py cards.csv out/ [--formats png,svg] [--scale 8]
+        python tipcards.py cards.jsonl cards.zip
+
+ csv rows are address[,amount[,name]], jsonl lines {"address", "amount", "name"};
+ a card without an amount gets an invoice for the address' minimum
+"""
+
+METADATA_CONCURRENCY = int(os.getenv('TIPCARDS_METADATA_CONCURRENCY', '8'))
+INVOICE_CONCURRENCY = int(os.getenv('TIPCARDS_INVOICE_CONCURRENCY', '16'))
+QUEUE_SIZE = int(os.getenv('TIPCARDS_QUEUE_SIZE', '32'))
+FORMATS = ('png', 'svg')
+UNSAFE = re.compile(r'[^A-Za-z0-9@._-]')
+
+
+class Card:
+    """
+    one tip card as it moves through the pipeline
+    """
+    __slots__ = ('index', 'address', 'amount', 'name', 'bolt11', 'payment_hash', 'images', 'error')
+
+    def __init__(self, index: int, address: str, amount: int = None, name: str = None):
+        self.index = index
+        self.address = address
+        self.amount = amount
+        self.name = name
+        self.bolt11 = None
+        self.payment_hash = None
+        self.images = None
+        self.error = None
+
+    @property
+    def filename(self) -> str:
+        return '%06d-%s' % (self.index, UNSAFE.sub('_', self.name or self.address))
+
+    def manifest(self, files: list) -> dict:
+        return {'index': self.index, 'address': self.address, 'amount': self.amount, 'name': self.name,
+                'bolt11': self.bolt11, 'payment_hash': self.payment_hash, 'files': files, 'error': self.error}
+
+
+def parse_row(row) -> tuple:
+    """
+    (address, amount, name) from a jsonl line or a csv row
+    """
+    if isinstance(row, str):
+        record = loads(row)
+        address, amount, name = record['address'], record.get('amount'), record.get('name')
+    else:
+        address, amount, name = row + [None] * (3 - len(row))
+    if not isinstance(address, str) or not address.strip():
+        raise ValueError('no address')
+    amount = int(amount) if amount not in (None, '') else None
+    return address.strip(), amount, name or None
+
+
+def read_cards(path: str):
+    """
+    yield Cards from a csv or jsonl file, one line at a time; a line that
+    cannot be parsed becomes a card with an error
+    """
+    with open(path, newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            rows = (line for line in f if line.strip())
+        else:
+            rows = (row for row in csv.reader(f)
+                    if row and not row[0].startswith('#') and row[0].strip() != 'address')
+        for index, row in enumerate(rows):
+            try:
+                card = Card(index, *parse_row(row))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                card = Card(index, row[0].strip() if isinstance(row, list) else '')
+                card.error = 'input: %s' % (str(e) or type(e).__name__)
+            yield card
+
+
+def render_card(payload: str, formats: tuple, scale: int) -> dict:
+    """
+    encode and render one QR code; runs in a worker process
+    """
+    matrix = encode(payload)
+    renderer = FastRenderer()
+    images = {}
+    if 'png' in formats:
+        images['png'] = renderer.png(matrix, scale=scale)
+    if 'svg' in formats:
+        images['svg'] = renderer.svg(matrix)
+    return images
+
+
+class CardWriter:
+    """
+    writes card images and the manifest to a directory, or to a zip
+    when the path ends in .zip
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.files = 0
+        if path.endswith('.zip'):
+            self._zip = zipfile.ZipFile(path, 'w')
+            # zip entries cannot be interleaved, the manifest is added on close
+            self._manifest = tempfile.TemporaryFile()
+        else:
+            self._zip = None
+            os.makedirs(path, exist_ok=True)
+            self._manifest = open(os.path.join(path, 'manifest.jsonl'), 'wb')
+
+
+    def write(self, card: Card):
+        files = []
+        for fmt, image in (card.images or {}).items():
+            name = card.filename + '.' + fmt
+            if self._zip is not None:
+                # PNG data is already deflated
+                compress = zipfile.ZIP_STORED if fmt == 'png' else zipfile.ZIP_DEFLATED
+                self._zip.writestr(name, image, compress_type=compress)
+            else:
+                with open(os.path.join(self.path, name), 'wb') as f:
+                    f.write(image)
+            files.append(name)
+        self.files += len(files)
+        self._manifest.write(dumpb(card.manifest(files)) + b'\n')
+
+
+    def close(self):
+        if self._zip is not None:
+            self._manifest.seek(0)
+            with self._zip.open('manifest.jsonl', 'w') as entry:
+                while True:
+                    chunk = self._manifest.read(64 * 1024)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+            self._zip.close()
+        self._manifest.close()
+
+
+class TipCardPipeline:
+    """
+    Streams Cards through metadata fetch, invoice fetch, QR render and
+    write stages joined by bounded queues.
+
+    Each stage runs a fixed number of workers, so at most `queue_size`
+    cards wait between two stages and the input is read only as fast as
+    cards are written. A card that fails at any stage is written to the
+    manifest with its error and no images.
+    """
+    def __init__(self, client: LNAddress, executor: RenderExecutor, formats: tuple = FORMATS, scale: int = 8,
+                 metadata_concurrency: int = METADATA_CONCURRENCY,
+                 invoice_concurrency: int = INVOICE_CONCURRENCY, queue_size: int = QUEUE_SIZE):
+        self.client = client
+        self.executor = executor
+        self.formats = tuple(formats)
+        self.scale = scale
+        self.stages = [('metadata', self._metadata, metadata_concurrency),
+                       ('invoice', self._invoice, invoice_concurrency),
+                       ('render', self._render, executor.workers)]
+        self.queues = [asyncio.Queue(queue_size) for _ in range(len(self.stages) + 1)]
+        self.read = 0
+        self.written = 0
+        self.errors = 0
+        self.start = time.monotonic()
+
+
+    async def _metadata(self, card: Card):
+        await self.client.pay_params(card.address)
+
+
+    async def _invoice(self, card: Card):
+        invoice = await self.client.fetch_invoice(card.address, card.amount)
+        card.bolt11, card.payment_hash = invoice.bolt11, invoice.payment_hash
+
+
+    async def _render(self, card: Card):
+        card.images = await self.executor.run(render_card, card.bolt11, self.formats, self.scale)
+
+
+    async def _stage(self, name, fn, workers, inbox, outbox, next_workers):
+        async def worker():
+            while True:
+                card = await inbox.get()
+                if card is None:
+                    return
+                if card.error is None:
+                    try:
+                        await fn(card)
+                    except Exception as e:
+                        card.error = '%s: %s' % (name, str(e) or type(e).__name__)
+                await outbox.put(card)
+
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        for _ in range(next_workers):
+            await outbox.put(None)
+
+
+    async def _feed(self, cards, outbox, workers):
+        for card in cards:
+            self.read += 1
+            await outbox.put(card)
+        for _ in range(workers):
+            await outbox.put(None)
+
+
+    async def _drain(self, inbox, writer: CardWriter):
+        while True:
+            card = await inbox.get()
+            if card is None:
+                return
+            if card.error is not None:
+                self.errors += 1
+                logging.error("card %d (%s) %s" % (card.index, card.address, card.error))
+            writer.write(card)
+            self.written += 1
+
+
+    async def run(self, cards, writer: CardWriter) -> dict:
+        """
+        process every card from the `cards` iterable, returns the summary
+        """
+        self.start = time.monotonic()
+        queues = self.queues
+        tasks = [self._feed(cards, queues[0], self.stages[0][2])]
+        for i, (name, fn, workers) in enumerate(self.stages):
+            next_workers = self.stages[i + 1][2] if i + 1 < len(self.stages) else 1
+            tasks.append(self._stage(name, fn, workers, queues[i], queues[i + 1], next_workers))
+        tasks.append(self._drain(queues[-1], writer))
+        await asyncio.gather(*tasks)
+        return self.summary()
+
+
+    def summary(self) -> dict:
+        seconds = time.monotonic() - self.start
+        return {'cards': self.written, 'errors': self.errors, 'seconds': round(seconds, 3),
+                'cards_per_second': round(self.written / seconds, 2) if seconds > 0 else None,
+                'executor': self.executor.stats()}
+
+
+    def progress(self) -> str:
+        seconds = time.monotonic() - self.start
+        queued = ' '.join('%s %d' % (name, q.qsize()) for (name, _, _), q in zip(self.stages, self.queues))
+        return '%d cards (%d failed), %.1f cards/s, queued: %s' % (
+            self.written, self.errors, self.written / seconds if seconds > 0 else 0, queued)
+
+
+async def report(pipeline: TipCardPipeline, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        print(pipeline.progress(), file=sys.stderr, flush=True)
+
+
+async def main(args) -> dict:
+    from utils import create_session
+
+    config = { 'invoice_key': os.getenv('INVOICE_KEY'),
+               'admin_key': os.getenv('ADMIN_KEY'),
+               'base_url': os.getenv('BASE_URL') }
+    executor = RenderExecutor(kind=args.executor, workers=args.workers or os.cpu_count())
+    writer = CardWriter(args.output)
+    try:
+        async with create_session() as session:
+            pipeline = TipCardPipeline(LNAddress(config, session), executor, args.formats.split(','), args.scale,
+                                       args.metadata_concurrency, args.invoice_concurrency, args.queue_size)
+            reporter = None
+            if args.progress > 0:
+                reporter = asyncio.ensure_future(report(pipeline, args.progress))
+            try:
+                return await pipeline.run(read_cards(args.cards), writer)
+            finally:
+                if reporter is not None:
+                    reporter.cancel()
+    finally:
+        writer.close()
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cards', help='csv or jsonl of address, amount, name')
+    parser.add_argument('output', help='output directory, or a .zip file')
+    parser.add_argument('--formats', default='png,svg', help='comma separated: png, svg')
+    parser.add_argument('--scale', type=int, default=8, help='PNG pixels per module')
+    parser.add_argument('--executor', default='process', choices=('process', 'thread', 'inline'))
+    parser.add_argument('--workers', type=int, default=None, help='render workers, default one per cpu')
+    parser.add_argument('--metadata-concurrency', type=int, default=METADATA_CONCURRENCY)
+    parser.add_argument('--invoice-concurrency', type=int, default=INVOICE_CONCURRENCY)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='cards buffered between stages')
+    parser.add_argument('--progress', type=float, default=1, help='seconds between progress lines, 0 for none')
+    summary = asyncio.run(main(parser.parse_args()))
+    print(dumps(summary))
+    sys.exit(0 if summary['errors'] == 0 else 1)
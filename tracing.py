@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from metrics import phase_seconds
+
+"""
+ request-scoped spans, reported as a Server-Timing header and
+ optionally as one JSON log line per request keyed by request id.
+
+ span() also feeds the per-phase latency histogram, so it is safe
+ to use outside a request (background refreshes, benchmarks).
+"""
+
+# emit one structured JSON log line per request
+TRACE_LOG = os.getenv('TRACE_LOG', '0').lower() in ('1', 'true', 'yes')
+REQUEST_ID_HEADER = 'x-request-id'
+
+trace_logger = logging.getLogger('trace')
+_current = ContextVar('trace', default=None)
+
+
+class Trace:
+    """
+    spans recorded while serving one request
+    """
+    __slots__ = ('request_id', 'start', 'spans')
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+    def add(self, name: str, seconds: float):
+        self.spans.append((name, seconds))
+
+
+    def totals(self) -> dict:
+        """
+        milliseconds per span name, repeated spans summed, in first-seen order
+        """
+        totals = {}
+        for name, seconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + seconds * 1000
+        return totals
+
+
+    def server_timing(self) -> str:
+        totals = self.totals()
+        totals['total'] = (time.perf_counter() - self.start) * 1000
+        return ', '.join('%s;dur=%.1f' % (name, ms) for name, ms in totals.items())
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def span(name: str):
+    """
+    time a block as phase `name` of the current request, if any
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        phase_seconds.observe(seconds, name)
+        trace = _current.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+
+def request_id(headers) -> str:
+    """
+    the caller's X-Request-ID when it looks sane, else a new one
+    """
+    for key, value in headers:
+        if key == REQUEST_ID_HEADER.encode():
+            value = value.decode('latin-1')
+            if 0 < len(value) <= 128 and value.isprintable():
+                return value
+    return uuid.uuid4().hex
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware: opens a Trace per request, adds Server-Timing and
+    X-Request-ID response headers and, with TRACE_LOG, logs the spans as JSON
+    """
+    def __init__(self, app, log: bool = None):
+        self.app = app
+        self.log = TRACE_LOG if log is None else log
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        trace = Trace(request_id(scope['headers']))
+        token = _current.set(trace)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', trace.server_timing().encode('latin-1')))
+                headers.append((REQUEST_ID_HEADER.encode(), trace.request_id.encode('latin-1')))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if self.log:
+                trace_logger.info(json.dumps({
+                    'request_id': trace.request_id, 'method': scope['method'], 'path': scope['path'],
+                    'status': status[0], 'total_ms': round((time.perf_counter() - trace.start) * 1000, 3),
+                    'spans': {name: round(ms, 3) for name, ms in trace.totals().items()}}))
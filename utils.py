@@ -1,40 +1,322 @@
-import json
+import asyncio
+import os
+import ssl
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from aiohttp import ClientTimeout, TCPConnector
+from aiohttp.client import ClientSession
+from cache import TTLCache
+from fastjson import loads
+from metrics import upstream_in_flight, upstream_responses, upstream_seconds
 
 """
  utils for aiohttp. 
 """
 
-async def get_url(session, path, headers) -> str:
+# post_jurl's json argument shadows the name
+_loads = loads
+
+
+def create_session(limit=100, limit_per_host=20, keepalive_timeout=30,
+                   ttl_dns_cache=300) -> ClientSession:
+    """
+    aiohttp: build a pooled ClientSession meant to live for the app lifespan
+
+    connections are kept alive and reused per host, DNS lookups are cached
+    and one SSL context is shared so TLS state is not rebuilt per request.
+    """
+    connector = TCPConnector(limit=limit,
+                             limit_per_host=limit_per_host,
+                             keepalive_timeout=keepalive_timeout,
+                             ttl_dns_cache=ttl_dns_cache,
+                             use_dns_cache=True,
+                             ssl=ssl.create_default_context())
+    return ClientSession(connector=connector)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into one in-flight call.
+
+    Every caller awaiting a key gets the same result or exception, and
+    the slot is cleared as soon as the call finishes.
+    """
+    def __init__(self):
+        self._calls = {}
+
+
+    async def do(self, key, fn, *args, **kwargs):
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._finish(key, f))
+        # shield: one cancelled caller must not cancel the shared call
+        return await asyncio.shield(fut)
+
+
+    def _finish(self, key, fut):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            fut.exception()
+
+
+    def __len__(self):
+        return len(self._calls)
+
+
+# Upstream request limits, in seconds and bytes
+CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '3'))
+FIRST_BYTE_TIMEOUT = float(os.getenv('UPSTREAM_FIRST_BYTE_TIMEOUT', '5'))
+TOTAL_TIMEOUT = float(os.getenv('UPSTREAM_TOTAL_TIMEOUT', '10'))
+MAX_BODY = int(os.getenv('UPSTREAM_MAX_BODY', str(1024 * 1024)))
+# GETs get a second, hedged request once they run past this latency percentile
+HEDGE_PERCENTILE = float(os.getenv('UPSTREAM_HEDGE_PERCENTILE', '0.95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('UPSTREAM_HEDGE_MIN_SAMPLES', '20'))
+HEDGE_MIN_DELAY = float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY', '0.05'))
+# consecutive failures before an upstream's circuit opens, and for how long
+BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', '5'))
+BREAKER_COOLDOWN = float(os.getenv('UPSTREAM_BREAKER_COOLDOWN', '30'))
+# upstream hosts come from user input: breakers and latency trackers are
+# kept for the most recently used ones only, and forgotten when idle
+TRACKED_UPSTREAMS = int(os.getenv('UPSTREAM_TRACKED', '4096'))
+TRACKED_TTL = float(os.getenv('UPSTREAM_TRACKED_TTL', '3600'))
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class ResponseTooLarge(UpstreamError):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Per-upstream breaker: opens after `threshold` consecutive failures,
+    fails fast for `cooldown` seconds, then lets one trial request through.
+    """
+    def __init__(self, threshold: int, cooldown: float, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if self._clock() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+
+    def before(self, domain):
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.trial):
+            raise CircuitOpenError("circuit open for " + str(domain))
+        if state == 'half-open':
+            self.trial = True
+
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = self._clock()
+
+
+class LatencyTracker:
+    """
+    Recent request latencies for one upstream
+    """
+    def __init__(self, size: int = 100):
+        self.samples = deque(maxlen=size)
+
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+
+    def percentile(self, p: float):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def tracked():
+    return TTLCache(maxsize=TRACKED_UPSTREAMS, ttl=TRACKED_TTL)
+
+
+# keyed by upstream() so a refused port cannot open the breaker of the real host
+breakers = tracked()
+latencies = tracked()
+
+
+def upstream(url: str) -> str:
+    """
+    host, or host:port when the url names a port
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    return host if port is None else '%s:%d' % (host, port)
+
+
+def get_breaker(key) -> CircuitBreaker:
+    breaker = breakers.get(key)
+    if breaker is None:
+        breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        breakers.set(key, breaker)
+    return breaker
+
+
+def hedge_delay(key):
+    """
+    seconds to wait before hedging a GET to an upstream, None to not hedge
+    """
+    tracker = latencies.get(key)
+    if tracker is None or HEDGE_PERCENTILE <= 0:
+        return None
+    delay = tracker.percentile(HEDGE_PERCENTILE)
+    return None if delay is None else max(delay, HEDGE_MIN_DELAY)
+
+
+async def read_limited(resp, limit: int) -> bytes:
+    """
+    read a response body in chunks, refusing more than limit bytes
+    """
+    if resp.content_length is not None and resp.content_length > limit:
+        raise ResponseTooLarge("response of %d bytes exceeds %d" % (resp.content_length, limit))
+    body = bytearray()
+    async for chunk in resp.content.iter_chunked(64 * 1024):
+        body.extend(chunk)
+        if len(body) > limit:
+            raise ResponseTooLarge("response exceeds %d bytes" % limit)
+    return bytes(body)
+
+
+async def _request(session, method, path, headers, **kwargs) -> tuple:
+    timeout = ClientTimeout(total=TOTAL_TIMEOUT, sock_connect=CONNECT_TIMEOUT,
+                            sock_read=FIRST_BYTE_TIMEOUT)
+    async with session.request(method, path, headers=headers, timeout=timeout, **kwargs) as resp:
+        body = await read_limited(resp, MAX_BODY)
+        return resp.status, body, resp.headers
+
+
+async def _hedged(delay, call):
+    """
+    run call(), starting a second copy if the first takes longer than delay;
+    the first successful result wins and the other request is cancelled
+    """
+    first = asyncio.ensure_future(call())
+    if delay is None:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    pending = {first, asyncio.ensure_future(call())}
+    try:
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def request(session, method, path, headers, hedge=False, **kwargs) -> tuple:
+    """
+    aiohttp: request with timeouts, a bounded body, an optional hedged
+    retry and the target upstream's circuit breaker.
+    only hedge requests that are safe to send twice.
+    returns (status, body, response headers)
+    """
+    domain = urlsplit(path).hostname
+    key = upstream(path)
+    breaker = get_breaker(key)
+    breaker.before(key)
+    delay = hedge_delay(key) if hedge else None
+    start = time.monotonic()
+    upstream_in_flight.inc()
+    try:
+        status, body, resp_headers = await _hedged(delay, lambda: _request(session, method, path, headers, **kwargs))
+    except asyncio.CancelledError:
+        breaker.trial = False
+        raise
+    except Exception as e:
+        breaker.failure()
+        upstream_responses.inc(domain or '', type(e).__name__)
+        raise
+    finally:
+        upstream_in_flight.dec()
+        upstream_seconds.observe(time.monotonic() - start, domain or '', method)
+    upstream_responses.inc(domain or '', str(status))
+    if status >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+        tracker = latencies.get(key)
+        if tracker is None:
+            tracker = LatencyTracker()
+            latencies.set(key, tracker)
+        tracker.add(time.monotonic() - start)
+    return status, body, resp_headers
+
+
+async def get_url(session, path, headers, hedge=False) -> str:
     """
     aiohttp: for use with GET requests
     """
-    async with session.get(path, headers=headers) as resp:
-        res = await resp.read()
-        return res
+    status, res, _ = await request(session, 'GET', path, headers, hedge=hedge)
+    return res
 
 
-async def post_jurl(session, path, headers, json) -> json:
+async def post_jurl(session, path, headers, json) -> dict:
     """
     aiohttp: for use with JSON in POST requests
     """
-    async with session.post(url=path, headers=headers, json=json) as resp:
-        res = await resp.json()
-        return res
+    status, res, _ = await request(session, 'POST', path, headers, json=json)
+    return _loads(res)
 
 
-async def post_url(session, path, headers, body) -> json:
+async def post_url(session, path, headers, body) -> dict:
     """
     aiohttp: for use with BODY in POST requests
     """
-    async with session.post(url=path, headers=headers, data=body) as resp:
-        res = await resp.json()
-        return res
+    status, res, _ = await request(session, 'POST', path, headers, data=body)
+    return _loads(res)
 
 
 async def delete_url(session, path, headers) -> str:
     """
     aiohttp: for use with DELETE requests
     """
-    async with session.delete(path, headers=headers) as resp:
-        res = await resp.text()
-        return res
+    status, res, _ = await request(session, 'DELETE', path, headers)
+    return res.decode('utf-8', errors='replace')
+